@@ -1,19 +1,213 @@
 import os
+import logging
+import asyncio
 import base64
+import binascii
+import codecs
+import hashlib
+import json
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Optional, Tuple
 
-TMP_DIR = Path("/tmp/llm_deployer_attachments")
+from json_stream import IncrementalJSONParser
+
+logger = logging.getLogger(__name__)
+
+# Put this on a volume shared by all replicas, so a replica that takes over another's build
+# (see job_queue) finds the attachments it spooled.
+TMP_DIR = Path(os.getenv("ATTACHMENT_DIR", "/tmp/llm_deployer_attachments"))
 TMP_DIR.mkdir(parents=True, exist_ok=True)
 
-def save_attachments_to_disk(attachments: list) -> list:
+# Attachments are stored once per distinct content, as objects/<sha256>. Each job gets a
+# manifest mapping its attachment names to objects, so jobs never see each other's files.
+STORE_DIR = TMP_DIR / "objects"
+MANIFEST_DIR = TMP_DIR / "manifests"
+STORE_DIR.mkdir(parents=True, exist_ok=True)
+MANIFEST_DIR.mkdir(parents=True, exist_ok=True)
+# Unreferenced objects are evicted, least recently used first, above this total size.
+STORE_MAX_BYTES = int(os.getenv("ATTACHMENT_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Objects used this recently are never evicted, as other worker processes may hold them.
+STORE_EVICTION_GRACE_SECONDS = int(os.getenv("ATTACHMENT_STORE_EVICTION_GRACE_SECONDS", "600"))
+MAX_MANIFESTS = int(os.getenv("ATTACHMENT_MAX_MANIFESTS", "1000"))
+_PREVIEW_CACHE_SIZE = 256
+
+# Size limits for streamed build requests: decoded bytes per attachment and raw body bytes.
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(25 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(100 * 1024 * 1024)))
+# Longest accepted data URI header (the part before the comma).
+_MAX_DATA_URI_HEADER = 1024
+_BASE64_IGNORED = str.maketrans("", "", " \t\r\n")
+# Base64 text collected before each decode-and-write step.
+_DECODE_BATCH_CHARS = 256 * 1024
+
+# In-process index of stored objects in least-recently-used order: sha256 -> entry.
+_objects: "OrderedDict[str, dict]" = OrderedDict()
+_objects_loaded = False
+_store_lock = threading.Lock()
+_previews: "OrderedDict[tuple, str]" = OrderedDict()
+
+class PayloadTooLargeError(ValueError):
+    """Raised when a streamed request or one of its attachments exceeds its size limit."""
+
+class UnauthorizedError(Exception):
+    """Raised when a streamed request's secret is missing or rejected."""
+
+def _load_index():
+    """Indexes objects left on disk by earlier runs, oldest first. Call with _store_lock held."""
+    global _objects_loaded
+    if _objects_loaded:
+        return
+    existing = []
+    for path in STORE_DIR.iterdir():
+        if len(path.name) == 64:
+            stat = path.stat()
+            existing.append((stat.st_mtime, path.name, stat.st_size))
+    for _, sha256, size in sorted(existing):
+        _objects[sha256] = {"size": size, "refs": 0, "git_sha": None}
+    _objects_loaded = True
+
+def _store_object(tmp_path: str, sha256: str, size: int, name: str) -> dict:
+    """Moves a fully written temporary file into the store and takes a reference to it.
+
+    If the content is already stored, the temporary file is dropped and the existing
+    object is reused. Returns the attachment's metadata dictionary.
     """
-    Decodes base64 attachments and saves them to a temporary directory on disk.
+    object_path = STORE_DIR / sha256
+    with _store_lock:
+        _load_index()
+        entry = _objects.get(sha256)
+        if entry and object_path.exists():
+            os.remove(tmp_path)
+            os.utime(object_path)
+        else:
+            os.replace(tmp_path, object_path)
+            entry = {"size": size, "refs": 0, "git_sha": None}
+            _objects[sha256] = entry
+        entry["refs"] += 1
+        _objects.move_to_end(sha256)
+        _evict()
+    return {
+        "name": name,
+        "path": str(object_path),
+        "size": size,
+        "sha256": sha256
+    }
+
+def _acquire_object(sha256: str, name: str) -> Optional[dict]:
+    """Takes a reference to an object that is already stored, if it still exists."""
+    object_path = STORE_DIR / sha256
+    with _store_lock:
+        _load_index()
+        entry = _objects.get(sha256)
+        if not entry or not object_path.exists():
+            return None
+        entry["refs"] += 1
+        _objects.move_to_end(sha256)
+        os.utime(object_path)
+        return {"name": name, "path": str(object_path), "size": entry["size"], "sha256": sha256}
+
+def _evict():
+    """Removes unreferenced objects, least recently used first, until the store fits its budget.
+    Call with _store_lock held."""
+    total = sum(entry["size"] for entry in _objects.values())
+    if total <= STORE_MAX_BYTES:
+        return
+    cutoff = time.time() - STORE_EVICTION_GRACE_SECONDS
+    for sha256, entry in list(_objects.items()):
+        if total <= STORE_MAX_BYTES:
+            break
+        if entry["refs"] > 0:
+            continue
+        object_path = STORE_DIR / sha256
+        try:
+            if object_path.stat().st_mtime > cutoff:
+                continue
+            os.remove(object_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not evict attachment object '{object_path}': {e}")
+            continue
+        del _objects[sha256]
+        total -= entry["size"]
+
+def get_git_blob_sha(meta: dict) -> str:
+    """Returns the git blob SHA of a stored attachment, computing it once per object."""
+    sha256 = meta["sha256"]
+    with _store_lock:
+        entry = _objects.get(sha256)
+        if entry and entry["git_sha"]:
+            return entry["git_sha"]
+    git_hash = hashlib.sha1(b"blob %d\0" % meta["size"])
+    with open(meta["path"], "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            git_hash.update(chunk)
+    with _store_lock:
+        if sha256 in _objects:
+            _objects[sha256]["git_sha"] = git_hash.hexdigest()
+    return git_hash.hexdigest()
+
+def get_text_preview(meta: dict, limit: int = 500) -> str:
+    """Returns the first characters of a text attachment, cached per stored object."""
+    key = (meta.get("sha256") or meta["path"], limit)
+    with _store_lock:
+        if key in _previews:
+            _previews.move_to_end(key)
+            return _previews[key]
+    with open(meta["path"], "r", encoding="utf-8", errors="ignore") as f:
+        preview = f.read(limit)
+    with _store_lock:
+        _previews[key] = preview
+        if len(_previews) > _PREVIEW_CACHE_SIZE:
+            _previews.popitem(last=False)
+    return preview
+
+def write_manifest(task_id: str, round_number: int, saved_files_meta: list):
+    """Records which stored objects a job's attachment names refer to."""
+    manifest = {meta["name"]: meta["sha256"] for meta in saved_files_meta if meta.get("sha256")}
+    path = MANIFEST_DIR / f"{_manifest_id(task_id)}-{round_number}.json"
+    try:
+        with tempfile.NamedTemporaryFile("w", dir=MANIFEST_DIR, suffix=".tmp", delete=False) as f:
+            json.dump(manifest, f)
+        os.replace(f.name, path)
+        manifests = sorted(MANIFEST_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for stale in manifests[MAX_MANIFESTS:]:
+            stale.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not write attachment manifest '{path}': {e}")
+
+def _find_previous_attachment(task_id: str, round_number: int, name: str) -> Optional[dict]:
+    """Looks up an attachment by name in the manifests of a task's earlier rounds."""
+    for previous_round in range(round_number - 1, 0, -1):
+        path = MANIFEST_DIR / f"{_manifest_id(task_id)}-{previous_round}.json"
+        try:
+            with open(path, "r") as f:
+                sha256 = json.load(f).get(name)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if sha256:
+            return _acquire_object(sha256, name)
+    return None
+
+def _manifest_id(task_id: str) -> str:
+    return hashlib.sha256(str(task_id).encode("utf-8")).hexdigest()[:32]
+
+def save_attachments_to_disk(attachments: list, task_id: Optional[str] = None, round_number: int = 1) -> list:
+    """
+    Decodes base64 attachments and saves them to the content-addressed attachment store.
 
     Args:
         attachments: A list of attachment dictionaries from the request.
+        task_id: The task the attachments belong to. When given, attachments that only carry
+            a name are looked up in the manifests of the task's earlier rounds.
+        round_number: The round the attachments belong to.
 
     Returns:
-        A list of metadata dictionaries for the saved files, including their temp path.
+        A list of metadata dictionaries for the saved files, including their store path.
     """
     saved_files_meta = []
     if not attachments:
@@ -22,33 +216,203 @@ def save_attachments_to_disk(attachments: list) -> list:
     for att in attachments:
         name = att.get("name")
         url = att.get("url")
+        if name and not url and task_id is not None:
+            meta = _find_previous_attachment(task_id, round_number, name)
+            if meta:
+                logger.info(f"Reusing attachment '{name}' from an earlier round.")
+                saved_files_meta.append(meta)
+            continue
         if not name or not url or not url.startswith("data:"):
             continue
         try:
             header, b64data = url.split(",", 1)
             data = base64.b64decode(b64data)
-            path = TMP_DIR / name
-            with open(path, "wb") as f:
+            fd, tmp_path = tempfile.mkstemp(dir=TMP_DIR, prefix="upload-")
+            with os.fdopen(fd, "wb") as f:
                 f.write(data)
-            saved_files_meta.append({
-                "name": name,
-                "path": str(path),
-                "size": len(data)
-            })
+            saved_files_meta.append(_store_object(tmp_path, hashlib.sha256(data).hexdigest(), len(data), name))
         except Exception as e:
-            print(f"Warning: Failed to decode and save attachment '{name}': {e}")
+            logger.warning(f"Failed to decode and save attachment '{name}': {e}")
     return saved_files_meta
 
 def cleanup_attachments(saved_files_meta: list):
     """
-    Deletes the temporary files created for attachments.
+    Releases a job's references to its stored attachments.
+
+    Unreferenced objects stay in the store for reuse until they are evicted.
     """
     if not saved_files_meta:
         return
 
-    print("Cleaning up temporary attachment files...")
-    for meta in saved_files_meta:
+    with _store_lock:
+        for meta in saved_files_meta:
+            entry = _objects.get(meta.get("sha256"))
+            if entry and entry["refs"] > 0:
+                entry["refs"] -= 1
+        _evict()
+
+async def save_attachments_to_disk_async(attachments: list, task_id: Optional[str] = None, round_number: int = 1) -> list:
+    """Runs save_attachments_to_disk in a worker thread so decoding and disk writes don't block the event loop."""
+    return await asyncio.to_thread(save_attachments_to_disk, attachments, task_id, round_number)
+
+async def cleanup_attachments_async(saved_files_meta: list):
+    """Runs cleanup_attachments in a worker thread."""
+    await asyncio.to_thread(cleanup_attachments, saved_files_meta)
+
+class _Base64AttachmentSink:
+    """Receives the characters of an attachment's data URI and decodes the base64 payload to a
+    temporary file in small pieces, so the attachment is never held in memory as a whole."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.header = ""
+        self.path = None
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self._file = None
+        self._pending = [] # base64 text not decoded yet
+        self._pending_chars = 0
+        self._passthrough = None
+
+    def write(self, text: str):
+        if self._passthrough is not None:
+            self._passthrough.append(text)
+            return
+        if self._file is None:
+            self.header += text
+            if "," not in self.header:
+                if len(self.header) > _MAX_DATA_URI_HEADER:
+                    self._start_passthrough()
+                return
+            header, text = self.header.split(",", 1)
+            if not header.startswith("data:") or not header.endswith(";base64"):
+                self._start_passthrough()
+                return
+            self.header = header
+            fd, self.path = tempfile.mkstemp(dir=TMP_DIR, prefix="upload-")
+            self._file = os.fdopen(fd, "wb")
+
+        self._pending.append(text)
+        self._pending_chars += len(text)
+        if self._pending_chars >= _DECODE_BATCH_CHARS:
+            self._flush()
+
+    def close(self):
+        """Finishes decoding. Returns None for a spooled data URI, or the original string otherwise."""
+        if self._passthrough is not None:
+            return "".join(self._passthrough)
+        if self._file is None:
+            return self.header
         try:
-            os.remove(meta["path"])
-        except OSError as e:
-            print(f"Warning: Could not remove temp file '{meta['path']}': {e}")
\ No newline at end of file
+            self._flush(final=True)
+        finally:
+            self._file.close()
+        return None
+
+    def discard(self):
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _start_passthrough(self):
+        # Not a base64 data URI: keep it as an ordinary string.
+        self._passthrough = [self.header]
+
+    def _flush(self, final: bool = False):
+        data = "".join(self._pending).translate(_BASE64_IGNORED)
+        # Only complete 4-character groups can be decoded; the rest waits for more text.
+        usable = len(data) if final else len(data) - len(data) % 4
+        remainder = data[usable:]
+        self._pending = [remainder] if remainder else []
+        self._pending_chars = len(remainder)
+        if usable:
+            if final:
+                data += "=" * (-len(data) % 4)
+            self._write_bytes(data if final else data[:usable])
+
+    def _write_bytes(self, b64text: str):
+        try:
+            chunk = base64.b64decode(b64text)
+        except binascii.Error as e:
+            raise ValueError(f"Invalid base64 data in attachment: {e}") from e
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise PayloadTooLargeError(f"Attachment exceeds the limit of {self.max_bytes} bytes.")
+        self.sha256.update(chunk)
+        self._file.write(chunk)
+
+async def read_build_request(chunks: AsyncIterator[bytes], max_request_bytes: int = MAX_REQUEST_BYTES,
+                             max_attachment_bytes: int = MAX_ATTACHMENT_BYTES,
+                             authorize: Optional[Callable[[Any], bool]] = None) -> Tuple[dict, list]:
+    """Parses a build request body as it arrives, decoding attachment data URIs straight to disk.
+
+    Memory use stays flat regardless of attachment size: only the non-attachment fields are
+    kept in memory. Spooled attachments are added to the attachment store and lose their
+    'url' field in the returned data.
+
+    Returns the request data and a list of metadata dictionaries for the spooled attachments,
+    in the same format as save_attachments_to_disk. Raises PayloadTooLargeError when a size
+    limit is exceeded and ValueError when the body is not valid JSON; spooled files are
+    removed in both cases.
+
+    If authorize is given, it is called with the top-level "secret" value as soon as that
+    field has been parsed, and UnauthorizedError is raised right away if it returns False,
+    so a request that sends its secret first is rejected before any attachment is spooled.
+    Attachments that arrive before the secret only reach temporary files; nothing is added
+    to the attachment store until the request is authorized.
+    """
+    sinks = {}
+    authorized = authorize is None
+
+    def on_value(path: tuple, value):
+        nonlocal authorized
+        if path == ("secret",) and authorize is not None:
+            authorized = bool(authorize(value))
+            if not authorized:
+                raise UnauthorizedError("Invalid secret provided")
+
+    def string_sink(path: tuple):
+        if len(path) == 3 and path[0] == "attachments" and isinstance(path[1], int) and path[2] == "url":
+            sinks[path[1]] = _Base64AttachmentSink(max_attachment_bytes)
+            return sinks[path[1]]
+        return None
+
+    parser = IncrementalJSONParser(on_value=on_value, string_sink=string_sink)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    received = 0
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            if received > max_request_bytes:
+                raise PayloadTooLargeError(f"Request body exceeds the limit of {max_request_bytes} bytes.")
+            parser.feed(decoder.decode(chunk))
+        parser.feed(decoder.decode(b"", final=True))
+        data = parser.close()
+        if not isinstance(data, dict):
+            raise ValueError("Request body must be a JSON object.")
+        if not authorized:
+            raise UnauthorizedError("Invalid secret provided")
+    except BaseException:
+        for sink in sinks.values():
+            sink.discard()
+        raise
+
+    saved_files_meta = []
+    attachments = data.get("attachments")
+    for index, sink in sinks.items():
+        if sink.path is None:
+            continue
+        att = attachments[index] if isinstance(attachments, list) and index < len(attachments) else None
+        name = att.get("name") if isinstance(att, dict) else None
+        if not name:
+            sink.discard()
+            continue
+        att.pop("url", None)
+        saved_files_meta.append(
+            await asyncio.to_thread(_store_object, sink.path, sink.sha256.hexdigest(), sink.size, name)
+        )
+    return data, saved_files_meta
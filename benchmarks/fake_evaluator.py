@@ -0,0 +1,42 @@
+import asyncio
+import random
+import time
+from typing import Optional
+
+from fastapi import FastAPI, Request, Response
+
+# The evaluation server that builds notify when they are done. It records every payload it
+# accepts; a share of calls can be failed with a 503 to exercise notification retries.
+
+class FakeEvaluator:
+    def __init__(self, latency: float = 0.05, failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.received = [] # (time received, payload)
+        self.attempts = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self.app = FastAPI()
+        self._add_routes()
+
+    def stats(self) -> dict:
+        return {"attempts": self.attempts, "failures": self.failures, "delivered": len(self.received)}
+
+    def _add_routes(self):
+        app = self.app
+        fake = self
+
+        @app.post("/notify")
+        async def notify(request: Request):
+            payload = await request.json()
+            fake.attempts += 1
+            await asyncio.sleep(fake.latency)
+            if fake._random.random() < fake.failure_rate:
+                fake.failures += 1
+                return Response(status_code=503)
+            fake.received.append((time.time(), payload))
+            return {"status": "ok"}
+
+        @app.get("/_benchmark/stats")
+        def benchmark_stats():
+            return fake.stats()
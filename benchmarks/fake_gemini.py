@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import json
+import random
+from typing import Optional
+
+# A stand-in for genai.GenerativeModel. The benchmark assigns an instance to
+# llm_generator.model, so generation goes through the real streaming, repair and
+# hedging code without calling the Gemini API.
+
+class _Usage:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+class _Chunk:
+    def __init__(self, text: str):
+        self.text = text
+
+class _StreamedResponse:
+    """Yields the response text in chunks spread over the generation latency."""
+
+    def __init__(self, text: str, latency: float, chunks: int, usage: _Usage):
+        self._text = text
+        self._latency = latency
+        self._chunks = max(1, chunks)
+        self.usage_metadata = usage
+
+    async def __aiter__(self):
+        size = max(1, -(-len(self._text) // self._chunks))
+        for start in range(0, len(self._text), size):
+            await asyncio.sleep(self._latency / self._chunks)
+            yield _Chunk(self._text[start:start + size])
+
+class _Response:
+    def __init__(self, text: str, usage: _Usage):
+        self.text = text
+        self.usage_metadata = usage
+
+class FakeGeminiModel:
+    """Generates a small app for any prompt after a configurable delay.
+
+    latency and jitter are in seconds. failure_rate is the share of calls that raise, as
+    a quota or server error would, and malformed_rate the share that return JSON with
+    unescaped quotes, which exercises the repair path.
+    """
+
+    def __init__(self, latency: float = 2.0, jitter: float = 0.5, failure_rate: float = 0.0,
+                 malformed_rate: float = 0.0, app_kb: int = 8, chunks: int = 20, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.app_kb = app_kb
+        self.chunks = chunks
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+
+    async def generate_content_async(self, prompt: str, generation_config=None, stream: bool = False, **kwargs):
+        self.calls += 1
+        latency = max(0.0, self._random.gauss(self.latency, self.jitter))
+        if self._random.random() < self.failure_rate:
+            self.failures += 1
+            await asyncio.sleep(latency / 4)
+            raise RuntimeError("429 Resource has been exhausted (fake quota error)")
+
+        files = self._files(prompt)
+        if self._random.random() < self.malformed_rate:
+            text = "{" + ", ".join(f'"{name}": "{content}"' for name, content in files.items()) + "}"
+        else:
+            text = json.dumps(files)
+        usage = _Usage(len(prompt) // 4, len(text) // 4)
+        if stream:
+            return _StreamedResponse(text, latency, self.chunks, usage)
+        await asyncio.sleep(latency)
+        return _Response(text, usage)
+
+    def _files(self, prompt: str) -> dict:
+        digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+        filler = ("<p>Lorem ipsum dolor sit amet.</p>\n" * (self.app_kb * 1024 // 36 + 1))[:self.app_kb * 1024]
+        return {
+            "index.html": f'<!DOCTYPE html>\n<html>\n<head><title>App {digest[:8]}</title>\n'
+                          f'<script src="script.js"></script></head>\n<body>\n{filler}</body>\n</html>\n',
+            "script.js": f'console.log("build {digest}");\n',
+            "README.md": f"# App {digest[:8]}\n\nGenerated for the benchmark.\n\n## License\n\nMIT\n",
+        }
@@ -0,0 +1,281 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import random
+import re
+import tarfile
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from fastapi import FastAPI, HTTPException, Request, Response
+
+# An in-memory GitHub REST API covering what github_manager uses: repositories, the
+# contents API, git data (refs, commits, trees, blobs), tarballs and Pages. The benchmark
+# points GITHUB_API_URL at it. Every response is delayed by a configurable latency, and a
+# share of calls can fail with a 502 or be rejected by a rate limit.
+
+def git_blob_sha(data: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+class FakeGitHub:
+    def __init__(self, login: str = "benchmark", latency: float = 0.05, jitter: float = 0.02,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, ready_delay: float = 0.0,
+                 seed: Optional[int] = None):
+        self.login = login
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        # Seconds after creation before a repository's main branch becomes visible.
+        self.ready_delay = ready_delay
+        self.repos: Dict[str, dict] = {}
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self.app = FastAPI()
+        self._add_routes()
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "total": sum(self.calls.values()), "repos": len(self.repos)}
+
+    # --- Repository model ---
+
+    def _repo(self, owner: str, name: str) -> dict:
+        repo = self.repos.get(f"{owner}/{name}")
+        if not repo:
+            raise HTTPException(404, "Not Found")
+        return repo
+
+    def _head(self, repo: dict, branch: str = "main") -> str:
+        sha = repo["refs"].get(f"heads/{branch}")
+        if not sha or time.monotonic() < repo["ready_at"]:
+            raise HTTPException(404, "Branch not found")
+        return sha
+
+    def _store_tree(self, repo: dict, files: Dict[str, str]) -> str:
+        sha = hashlib.sha1(json.dumps(sorted(files.items())).encode("utf-8")).hexdigest()
+        repo["trees"][sha] = dict(files)
+        return sha
+
+    def _store_commit(self, repo: dict, tree: str, parents: list, message: str) -> str:
+        sha = hashlib.sha1(f"{tree}{parents}{message}{len(repo['commits'])}".encode("utf-8")).hexdigest()
+        repo["commits"][sha] = {"tree": tree, "parents": list(parents), "message": message}
+        return sha
+
+    def _store_blob(self, repo: dict, data: bytes) -> str:
+        sha = git_blob_sha(data)
+        repo["blobs"][sha] = data
+        return sha
+
+    def _ancestors(self, repo: dict, sha: str) -> set:
+        seen, stack = set(), [sha]
+        while stack:
+            current = stack.pop()
+            if current in seen or current not in repo["commits"]:
+                continue
+            seen.add(current)
+            stack.extend(repo["commits"][current]["parents"])
+        return seen
+
+    def _repo_json(self, repo: dict) -> dict:
+        return {key: repo[key] for key in ("name", "full_name", "html_url")}
+
+    # --- Routes ---
+
+    def _add_routes(self):
+        app = self.app
+        fake = self
+
+        @app.middleware("http")
+        async def simulate_network(request: Request, call_next):
+            if request.url.path.startswith("/_benchmark"):
+                return await call_next(request)
+            route = _route(request.method, request.url.path)
+            await asyncio.sleep(max(0.0, fake._random.gauss(fake.latency, fake.jitter)))
+            if fake._random.random() < fake.rate_limit_rate:
+                fake.calls[f"{route} 429"] += 1
+                return Response(json.dumps({"message": "API rate limit exceeded"}), status_code=429,
+                                headers={"Retry-After": "1"}, media_type="application/json")
+            if fake._random.random() < fake.error_rate:
+                fake.calls[f"{route} 502"] += 1
+                return Response(json.dumps({"message": "Bad Gateway"}), status_code=502, media_type="application/json")
+
+            response = await call_next(request)
+            headers = {"X-RateLimit-Remaining": "5000", "X-RateLimit-Reset": str(int(time.time()) + 3600)}
+            if request.method == "GET" and response.status_code == 200 and "/tarball/" not in request.url.path:
+                body = b"".join([chunk async for chunk in response.body_iterator])
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if request.headers.get("if-none-match") == etag:
+                    fake.calls[f"{route} 304"] += 1
+                    return Response(status_code=304, headers={"ETag": etag, **headers})
+                response = Response(body, headers={"ETag": etag, **headers}, media_type="application/json")
+            else:
+                response.headers.update(headers)
+            fake.calls[f"{route} {response.status_code}"] += 1
+            return response
+
+        @app.get("/_benchmark/stats")
+        def benchmark_stats():
+            return fake.stats()
+
+        @app.get("/user")
+        def user():
+            return {"login": fake.login}
+
+        @app.post("/user/repos", status_code=201)
+        async def create_repo(request: Request):
+            body = await request.json()
+            full_name = f"{fake.login}/{body['name']}"
+            if full_name in fake.repos:
+                raise HTTPException(422, "name already exists on this account")
+            repo = {
+                "name": body["name"], "full_name": full_name, "html_url": f"https://github.com/{full_name}",
+                "blobs": {}, "trees": {}, "commits": {}, "refs": {}, "pages": False,
+                "ready_at": time.monotonic() + fake.ready_delay,
+            }
+            fake.repos[full_name] = repo
+            if body.get("auto_init"):
+                license_sha = fake._store_blob(repo, b"MIT License\n")
+                tree = fake._store_tree(repo, {"LICENSE": license_sha})
+                repo["refs"]["heads/main"] = fake._store_commit(repo, tree, [], "Initial commit")
+            return fake._repo_json(repo)
+
+        @app.get("/repos/{owner}/{name}")
+        def get_repo(owner: str, name: str):
+            return fake._repo_json(fake._repo(owner, name))
+
+        @app.delete("/repos/{owner}/{name}", status_code=204)
+        def delete_repo(owner: str, name: str):
+            fake._repo(owner, name)
+            del fake.repos[f"{owner}/{name}"]
+            return Response(status_code=204)
+
+        @app.get("/repos/{owner}/{name}/branches/{branch}")
+        def get_branch(owner: str, name: str, branch: str):
+            repo = fake._repo(owner, name)
+            sha = fake._head(repo, branch)
+            return {"name": branch, "commit": {"sha": sha, "commit": {"tree": {"sha": repo["commits"][sha]["tree"]}}}}
+
+        @app.get("/repos/{owner}/{name}/git/ref/heads/{branch}")
+        def get_ref(owner: str, name: str, branch: str):
+            sha = fake._head(fake._repo(owner, name), branch)
+            return {"ref": f"refs/heads/{branch}", "object": {"sha": sha, "type": "commit"}}
+
+        @app.post("/repos/{owner}/{name}/git/refs", status_code=201)
+        async def create_ref(owner: str, name: str, request: Request):
+            repo = fake._repo(owner, name)
+            body = await request.json()
+            repo["refs"][body["ref"][len("refs/"):]] = body["sha"]
+            return {"ref": body["ref"], "object": {"sha": body["sha"], "type": "commit"}}
+
+        @app.patch("/repos/{owner}/{name}/git/refs/heads/{branch}")
+        async def update_ref(owner: str, name: str, branch: str, request: Request):
+            repo = fake._repo(owner, name)
+            body = await request.json()
+            current = repo["refs"].get(f"heads/{branch}")
+            if not current:
+                raise HTTPException(422, "Reference does not exist")
+            if not body.get("force") and current not in fake._ancestors(repo, body["sha"]):
+                raise HTTPException(422, "Update is not a fast forward")
+            repo["refs"][f"heads/{branch}"] = body["sha"]
+            return {"ref": f"refs/heads/{branch}", "object": {"sha": body["sha"], "type": "commit"}}
+
+        @app.get("/repos/{owner}/{name}/git/commits/{sha}")
+        def get_commit(owner: str, name: str, sha: str):
+            commit = fake._repo(owner, name)["commits"].get(sha)
+            if not commit:
+                raise HTTPException(404, "Not Found")
+            return {"sha": sha, "tree": {"sha": commit["tree"]}, "message": commit["message"],
+                    "parents": [{"sha": parent} for parent in commit["parents"]]}
+
+        @app.post("/repos/{owner}/{name}/git/commits", status_code=201)
+        async def create_commit(owner: str, name: str, request: Request):
+            repo = fake._repo(owner, name)
+            body = await request.json()
+            if body["tree"] not in repo["trees"]:
+                raise HTTPException(422, "Tree not found")
+            return {"sha": fake._store_commit(repo, body["tree"], body.get("parents", []), body["message"])}
+
+        @app.get("/repos/{owner}/{name}/git/trees/{sha}")
+        def get_tree(owner: str, name: str, sha: str):
+            tree = fake._repo(owner, name)["trees"].get(sha)
+            if tree is None:
+                raise HTTPException(404, "Not Found")
+            entries = [{"path": path, "mode": "100644", "type": "blob", "sha": blob} for path, blob in tree.items()]
+            return {"sha": sha, "tree": entries, "truncated": False}
+
+        @app.post("/repos/{owner}/{name}/git/trees", status_code=201)
+        async def create_tree(owner: str, name: str, request: Request):
+            repo = fake._repo(owner, name)
+            body = await request.json()
+            files = dict(repo["trees"].get(body.get("base_tree"), {}))
+            for entry in body["tree"]:
+                if "content" in entry:
+                    files[entry["path"]] = fake._store_blob(repo, entry["content"].encode("utf-8"))
+                elif entry.get("sha") is None:
+                    files.pop(entry["path"], None)
+                else:
+                    files[entry["path"]] = entry["sha"]
+            return {"sha": fake._store_tree(repo, files)}
+
+        @app.post("/repos/{owner}/{name}/git/blobs", status_code=201)
+        async def create_blob(owner: str, name: str, request: Request):
+            repo = fake._repo(owner, name)
+            body = await request.json()
+            if body.get("encoding") == "base64":
+                data = base64.b64decode(body["content"])
+            else:
+                data = body["content"].encode("utf-8")
+            return {"sha": fake._store_blob(repo, data)}
+
+        @app.get("/repos/{owner}/{name}/tarball/{ref}")
+        def get_tarball(owner: str, name: str, ref: str):
+            repo = fake._repo(owner, name)
+            commit = repo["commits"].get(ref) or repo["commits"].get(repo["refs"].get(f"heads/{ref}"))
+            if not commit:
+                raise HTTPException(404, "Not Found")
+            buffer = io.BytesIO()
+            with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+                for path, sha in repo["trees"][commit["tree"]].items():
+                    data = repo["blobs"][sha]
+                    info = tarfile.TarInfo(f"{owner}-{name}-{ref[:7]}/{path}")
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+            return Response(buffer.getvalue(), media_type="application/x-gzip")
+
+        @app.get("/repos/{owner}/{name}/contents/{path:path}")
+        def get_contents(owner: str, name: str, path: str, ref: str = "main"):
+            repo = fake._repo(owner, name)
+            files = repo["trees"][repo["commits"][fake._head(repo, ref)]["tree"]]
+            if path not in files:
+                raise HTTPException(404, "Not Found")
+            return {"path": path, "sha": files[path]}
+
+        @app.put("/repos/{owner}/{name}/contents/{path:path}")
+        async def put_contents(owner: str, name: str, path: str, request: Request):
+            repo = fake._repo(owner, name)
+            body = await request.json()
+            head = fake._head(repo, body.get("branch", "main"))
+            files = dict(repo["trees"][repo["commits"][head]["tree"]])
+            files[path] = fake._store_blob(repo, base64.b64decode(body["content"]))
+            commit = fake._store_commit(repo, fake._store_tree(repo, files), [head], body["message"])
+            repo["refs"][f"heads/{body.get('branch', 'main')}"] = commit
+            return {"content": {"path": path, "sha": files[path]}, "commit": {"sha": commit}}
+
+        @app.post("/repos/{owner}/{name}/pages", status_code=201)
+        def enable_pages(owner: str, name: str):
+            repo = fake._repo(owner, name)
+            fake._head(repo) # Pages needs the branch to exist
+            if repo["pages"]:
+                raise HTTPException(409, "GitHub Pages is already enabled.")
+            repo["pages"] = True
+            return {"url": f"https://{fake.login}.github.io/{name}/", "status": "queued"}
+
+def _route(method: str, path: str) -> str:
+    """Reduces a request to its route, so call counts are not split per repository or SHA."""
+    path = re.sub(r"^/repos/[^/]+/[^/]+", "/repos/{repo}", path)
+    path = re.sub(r"/[0-9a-f]{40}\b", "/{sha}", path)
+    path = re.sub(r"/(git/refs?|contents|branches)/.*$", r"/\1/{path}", path)
+    return f"{method} {path}"
@@ -0,0 +1,285 @@
+"""Offline end-to-end benchmark of the build service.
+
+Drives main.app with concurrent /api/build requests against local fakes for Gemini,
+GitHub and the evaluation server, then reports throughput, build and per-phase latency
+percentiles, GitHub call counts and peak RSS. Run from the repository root:
+
+    python -m benchmarks.run_benchmark --builds 50 --round2-ratio 0.5
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+
+SECRET = "benchmark-secret"
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--builds", type=int, default=20, help="Number of tasks to build (round 1 requests).")
+    parser.add_argument("--round2-ratio", type=float, default=0.5, help="Share of tasks that also get a round 2 request.")
+    parser.add_argument("--attachment-kb", type=int, default=0, help="Size of an attachment sent with every request.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for all builds to finish.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", help="Also write the report to this file as JSON.")
+    # Fake Gemini
+    parser.add_argument("--llm-latency", type=float, default=2.0)
+    parser.add_argument("--llm-jitter", type=float, default=0.5)
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--llm-malformed-rate", type=float, default=0.0)
+    parser.add_argument("--app-kb", type=int, default=8, help="Size of the generated index.html.")
+    # Fake GitHub
+    parser.add_argument("--github-latency", type=float, default=0.05)
+    parser.add_argument("--github-jitter", type=float, default=0.02)
+    parser.add_argument("--github-error-rate", type=float, default=0.0)
+    parser.add_argument("--github-rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--github-ready-delay", type=float, default=0.0,
+                        help="Seconds before a new repository's main branch is visible.")
+    # Fake evaluator
+    parser.add_argument("--evaluator-latency", type=float, default=0.05)
+    parser.add_argument("--evaluator-failure-rate", type=float, default=0.0)
+    return parser.parse_args(argv)
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _serve_fakes(options: Dict, github_port: int, evaluator_port: int):
+    """Runs the fake GitHub and evaluator servers. Started in a child process, so their
+    memory and CPU are not counted against the service."""
+    import uvicorn
+    from benchmarks.fake_evaluator import FakeEvaluator
+    from benchmarks.fake_github import FakeGitHub
+
+    github = FakeGitHub(latency=options["github_latency"], jitter=options["github_jitter"],
+                        error_rate=options["github_error_rate"], rate_limit_rate=options["github_rate_limit_rate"],
+                        ready_delay=options["github_ready_delay"], seed=options["seed"])
+    evaluator = FakeEvaluator(latency=options["evaluator_latency"], failure_rate=options["evaluator_failure_rate"],
+                              seed=options["seed"])
+    servers = [
+        uvicorn.Server(uvicorn.Config(github.app, host="127.0.0.1", port=github_port, log_level="warning")),
+        uvicorn.Server(uvicorn.Config(evaluator.app, host="127.0.0.1", port=evaluator_port, log_level="warning")),
+    ]
+
+    async def serve():
+        await asyncio.gather(*(server.serve() for server in servers))
+
+    asyncio.run(serve())
+
+async def _wait_for_server(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+def _build_request(task: str, round_number: int, evaluation_url: str, attachment_kb: int) -> dict:
+    request = {
+        "email": "benchmark@example.com",
+        "secret": SECRET,
+        "task": task,
+        "round": round_number,
+        "nonce": f"{task}-nonce",
+        "brief": f"Build a page for {task}." if round_number == 1 else f"Add a footer to the {task} page.",
+        "checks": ["index.html exists"],
+        "evaluation_url": evaluation_url,
+        "attachments": [],
+    }
+    if attachment_kb:
+        data = base64.b64encode(os.urandom(attachment_kb * 1024)).decode("ascii")
+        request["attachments"].append({"name": "data.bin", "url": f"data:application/octet-stream;base64,{data}"})
+    return request
+
+async def run(args: argparse.Namespace, github_url: str, evaluator_url: str) -> Dict:
+    import main
+    from benchmarks.fake_gemini import FakeGeminiModel
+
+    model = FakeGeminiModel(latency=args.llm_latency, jitter=args.llm_jitter, failure_rate=args.llm_failure_rate,
+                            malformed_rate=args.llm_malformed_rate, app_kb=args.app_kb, seed=args.seed)
+    main.llm_generator.model = model
+
+    tasks = [f"bench-{index:04d}" for index in range(args.builds)]
+    round2_tasks = tasks[:int(round(args.builds * args.round2_ratio))]
+    requests = [(task, 1) for task in tasks] + [(task, 2) for task in round2_tasks]
+    evaluation_url = f"{evaluator_url}/notify"
+
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://service", timeout=60) as client:
+            started = time.time()
+            # Round 1 requests go first so each round 2 is queued behind its task's first round.
+            responses = await asyncio.gather(*(
+                client.post("/api/build", json=_build_request(task, round_number, evaluation_url, args.attachment_kb))
+                for task, round_number in requests if round_number == 1
+            ))
+            responses += await asyncio.gather(*(
+                client.post("/api/build", json=_build_request(task, round_number, evaluation_url, args.attachment_kb))
+                for task, round_number in requests if round_number == 2
+            ))
+            rejected = sum(1 for response in responses if response.status_code != 200)
+
+            jobs = {}
+            deadline = time.monotonic() + args.timeout
+            pending = [key for key, response in zip(requests, responses) if response.status_code == 200]
+            while pending and time.monotonic() < deadline:
+                await asyncio.sleep(0.25)
+                for task, round_number in list(pending):
+                    job = (await client.get(f"/api/jobs/{task}/{round_number}", params={"breakdown": "true"})).json()
+                    if job.get("status") in ("succeeded", "failed"):
+                        jobs[(task, round_number)] = job
+                        pending.remove((task, round_number))
+            finished = time.time()
+
+            # Queued notifications are delivered in the background; give them a moment.
+            succeeded = sum(1 for job in jobs.values() if job["status"] == "succeeded")
+            async with httpx.AsyncClient() as plain_client:
+                notify_deadline = time.monotonic() + 30
+                while True:
+                    evaluator_stats = (await plain_client.get(f"{evaluator_url}/_benchmark/stats")).json()
+                    if evaluator_stats["delivered"] >= succeeded or time.monotonic() > notify_deadline:
+                        break
+                    await asyncio.sleep(0.25)
+                github_stats = (await plain_client.get(f"{github_url}/_benchmark/stats")).json()
+            metrics_text = (await client.get("/metrics")).text
+
+    return _report(args, requests, jobs, rejected, pending, started, finished, model, github_stats,
+                   evaluator_stats, metrics_text)
+
+def _report(args, requests, jobs, rejected, timed_out, started, finished, model, github_stats,
+            evaluator_stats, metrics_text) -> Dict:
+    build_seconds = [job["finished_at"] - job["queued_at"] for job in jobs.values()]
+    queue_seconds = [job["started_at"] - job["queued_at"] for job in jobs.values() if job.get("started_at")]
+    phase_seconds = defaultdict(list)
+    for job in jobs.values():
+        for name, phase in job["phases"].items():
+            if phase.get("started_at") and phase.get("finished_at"):
+                phase_seconds[name].append(phase["finished_at"] - phase["started_at"])
+    span_seconds = defaultdict(list)
+    for job in jobs.values():
+        for span, entry in (job.get("breakdown") or {}).items():
+            span_seconds[span].append(entry["seconds"])
+
+    def summary(values: List[float]) -> Dict:
+        return {
+            "count": len(values),
+            "p50": round(percentile(values, 0.50), 4),
+            "p95": round(percentile(values, 0.95), 4),
+            "p99": round(percentile(values, 0.99), 4),
+            "max": round(max(values), 4) if values else 0.0,
+        }
+
+    statuses = defaultdict(int)
+    for job in jobs.values():
+        statuses[job["status"]] += 1
+    wall_seconds = max(finished - started, 1e-9)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+    github_calls = github_stats["calls"]
+    return {
+        "config": vars(args),
+        "requests": len(requests),
+        "rejected": rejected,
+        "timed_out": len(timed_out),
+        "statuses": dict(statuses),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_builds_per_second": round(statuses["succeeded"] / wall_seconds, 4),
+        "build_seconds": summary(build_seconds),
+        "queue_wait_seconds": summary(queue_seconds),
+        "phase_seconds": {name: summary(values) for name, values in sorted(phase_seconds.items())},
+        "span_seconds": {name: summary(values) for name, values in sorted(span_seconds.items())},
+        "github_calls": dict(sorted(github_calls.items(), key=lambda item: -item[1])),
+        "github_calls_total": github_stats["total"],
+        "github_calls_per_build": round(github_stats["total"] / max(1, len(jobs)), 2),
+        "llm_calls": model.calls,
+        "llm_failures": model.failures,
+        "notifications": evaluator_stats,
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "metrics_bytes": len(metrics_text),
+    }
+
+def print_report(report: Dict):
+    print(f"Requests: {report['requests']} (rejected {report['rejected']}, timed out {report['timed_out']})")
+    print(f"Statuses: {report['statuses']}")
+    print(f"Wall time: {report['wall_seconds']}s, throughput: {report['throughput_builds_per_second']} builds/s")
+    print(f"Peak RSS: {report['peak_rss_mb']} MB")
+    print(f"LLM calls: {report['llm_calls']} ({report['llm_failures']} failed)")
+    print(f"Notifications: {report['notifications']}")
+    print()
+    print(f"{'latency (s)':<48}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    rows = [("build (queued to finished)", report["build_seconds"]), ("queue wait", report["queue_wait_seconds"])]
+    rows += [(f"phase {name}", values) for name, values in report["phase_seconds"].items()]
+    rows += [(name, values) for name, values in report["span_seconds"].items() if not name.startswith("phase ")]
+    for name, values in rows:
+        print(f"{name[:47]:<48}{values['count']:>7}{values['p50']:>10}{values['p95']:>10}{values['p99']:>10}{values['max']:>10}")
+    print()
+    print(f"GitHub calls: {report['github_calls_total']} ({report['github_calls_per_build']} per build)")
+    for route, count in report["github_calls"].items():
+        print(f"  {count:>6}  {route}")
+
+def main_entry(argv=None):
+    args = parse_args(argv)
+    github_port, evaluator_port = _free_port(), _free_port()
+    github_url = f"http://127.0.0.1:{github_port}"
+    evaluator_url = f"http://127.0.0.1:{evaluator_port}"
+
+    workdir = tempfile.mkdtemp(prefix="llm-deployer-benchmark-")
+    # The service reads its configuration at import time, so this must happen before main is imported.
+    os.environ.update({
+        "MY_SHARED_SECRET": SECRET,
+        "GITHUB_PAT": "benchmark-token",
+        "GITHUB_API_URL": github_url,
+        "STATE_DB_PATH": os.path.join(workdir, "state.db"),
+        "GITHUB_SNAPSHOT_CACHE_DIR": os.path.join(workdir, "snapshots"),
+        "LLM_CACHE_DIR": os.path.join(workdir, "llm_cache"),
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("NOTIFY_RETRY_BASE_DELAY_SECONDS", "0.2")
+
+    options = {key: value for key, value in vars(args).items() if key.startswith(("github_", "evaluator_"))}
+    options["seed"] = args.seed
+    fakes = multiprocessing.get_context("spawn").Process(
+        target=_serve_fakes, args=(options, github_port, evaluator_port), daemon=True
+    )
+    fakes.start()
+    try:
+        asyncio.run(_wait_for_server(f"{github_url}/_benchmark/stats"))
+        asyncio.run(_wait_for_server(f"{evaluator_url}/_benchmark/stats"))
+        report = asyncio.run(run(args, github_url, evaluator_url))
+    finally:
+        fakes.terminate()
+        fakes.join(5)
+
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+    print(f"\nState and caches of this run are in {workdir}")
+    return report
+
+if __name__ == "__main__":
+    main_entry()
@@ -0,0 +1,125 @@
+import math
+import os
+import re
+from typing import Dict, Tuple
+
+# Token budget for the existing code shown to the LLM in a revision prompt.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("LLM_CONTEXT_TOKEN_BUDGET", "60000"))
+# Files above this size are summarized unless they are clearly relevant to the brief.
+LARGE_FILE_TOKENS = int(os.getenv("LLM_CONTEXT_LARGE_FILE_TOKENS", "6000"))
+# Lines kept from the start and end of a summarized file.
+SUMMARY_HEAD_LINES = 40
+SUMMARY_TAIL_LINES = 10
+
+# Files that are never sent: licenses, CI config, vendored and generated assets.
+_EXCLUDED_NAMES = {"license", "license.md", "license.txt", "copying", "package-lock.json", "yarn.lock", "pnpm-lock.yaml"}
+_EXCLUDED_DIRS = (".github/", "node_modules/", "vendor/", "vendors/", "third_party/", "dist/")
+_EXCLUDED_SUFFIXES = (".min.js", ".min.css", ".map")
+# Files the model must always see in full, since every revision updates them.
+_ALWAYS_FULL = {"index.html", "readme.md"}
+_CODE_SUFFIXES = (".html", ".js", ".css", ".ts", ".jsx", ".tsx", ".py")
+_WORD = re.compile(r"[a-z0-9_]{3,}")
+_STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "are", "should", "must", "page", "app",
+    "use", "using", "has", "have", "into", "when", "then", "will", "its", "not", "all", "any",
+    "your", "you", "code", "file", "files", "new", "add", "show", "make", "each", "which",
+}
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the token count of text at about four characters per token."""
+    return math.ceil(len(text) / 4)
+
+def is_excluded(path: str) -> bool:
+    lowered = path.lower()
+    return (
+        lowered.rsplit("/", 1)[-1] in _EXCLUDED_NAMES
+        or lowered.startswith(_EXCLUDED_DIRS)
+        or any(f"/{d}" in lowered for d in _EXCLUDED_DIRS)
+        or lowered.endswith(_EXCLUDED_SUFFIXES)
+    )
+
+def _keywords(brief: str, checks: list) -> set:
+    text = " ".join([brief or ""] + [str(check) for check in checks or []]).lower()
+    return {word for word in _WORD.findall(text) if word not in _STOPWORDS}
+
+def _relevance(path: str, content: str, keywords: set) -> float:
+    """Scores how relevant a file is to the brief and checks."""
+    lowered_path = path.lower()
+    score = 0.0
+    if lowered_path in _ALWAYS_FULL:
+        score += 100
+    if lowered_path.endswith(_CODE_SUFFIXES):
+        score += 5
+    if keywords:
+        score += 10 * sum(1 for word in keywords if word in lowered_path)
+        words = _WORD.findall(content.lower())
+        if words:
+            hits = sum(1 for word in words if word in keywords)
+            score += min(20.0, 1000.0 * hits / len(words))
+    return score
+
+def _summarize(content: str) -> str:
+    lines = content.splitlines()
+    if len(lines) <= SUMMARY_HEAD_LINES + SUMMARY_TAIL_LINES:
+        # Few but very long lines (minified or data): keep a prefix only.
+        return content[:SUMMARY_HEAD_LINES * 120] + "\n[... rest of file elided ...]"
+    elided = len(lines) - SUMMARY_HEAD_LINES - SUMMARY_TAIL_LINES
+    return "\n".join(
+        lines[:SUMMARY_HEAD_LINES]
+        + [f"[... {elided} lines elided ...]"]
+        + lines[-SUMMARY_TAIL_LINES:]
+    )
+
+def build_revision_context(existing_code: Dict[str, str], brief: str, checks: list,
+                           token_budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[str, Dict]:
+    """Packs the existing files of a repository into a prompt section within a token budget.
+
+    Files are taken in order of relevance to the brief and checks. index.html and README.md
+    are always shown in full; other files are shown in full while they fit, summarized when
+    they are large and not clearly relevant or when the budget runs low, and otherwise only
+    listed by name. Licenses, CI config and vendored or minified assets are never sent.
+
+    Returns the prompt section and a dict of statistics about what was packed.
+    """
+    keywords = _keywords(brief, checks)
+    candidates = []
+    excluded = []
+    for path, content in existing_code.items():
+        if is_excluded(path):
+            excluded.append(path)
+            continue
+        candidates.append((_relevance(path, content, keywords), path, content))
+    candidates.sort(key=lambda item: (-item[0], item[1]))
+
+    remaining = token_budget
+    sections = []
+    stats = {"full": [], "summarized": [], "omitted": [], "excluded": sorted(excluded), "tokens": 0}
+    for score, path, content in candidates:
+        tokens = estimate_tokens(content)
+        must_show = path.lower() in _ALWAYS_FULL
+        relevant = score >= 15
+        if must_show or (tokens <= remaining and (tokens <= LARGE_FILE_TOKENS or relevant)):
+            sections.append(f"--- START FILE: {path} ---\n{content}\n--- END FILE: {path} ---\n\n")
+            stats["full"].append(path)
+            remaining -= tokens
+            continue
+        summary = _summarize(content)
+        summary_tokens = estimate_tokens(summary)
+        if summary_tokens <= remaining:
+            sections.append(
+                f"--- START FILE (SUMMARIZED, {tokens} tokens in full): {path} ---\n"
+                f"{summary}\n--- END FILE: {path} ---\n\n"
+            )
+            stats["summarized"].append(path)
+            remaining -= summary_tokens
+        else:
+            stats["omitted"].append(path)
+
+    if stats["omitted"]:
+        sections.append(
+            "The following files also exist but are not shown: "
+            + ", ".join(stats["omitted"]) + "\n\n"
+        )
+    text = "".join(sections)
+    stats["tokens"] = estimate_tokens(text)
+    return text, stats
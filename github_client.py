@@ -0,0 +1,304 @@
+import os
+import logging
+import random
+import re
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# One GitHub REST client layer for the whole process: keep-alive connections are pooled per
+# event loop, the authenticated login is looked up once per token, GET responses are
+# revalidated with ETags (a 304 does not count against the rate limit), and calls are paced
+# by the X-RateLimit-* and Retry-After headers instead of failing halfway through a build.
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+MAX_CONNECTIONS = int(os.getenv("GITHUB_MAX_CONNECTIONS", "20"))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("GITHUB_MAX_CONCURRENT_REQUESTS", "8"))
+ETAG_CACHE_ENTRIES = int(os.getenv("GITHUB_ETAG_CACHE_ENTRIES", "512"))
+# Total size of the cached response bodies; a body larger than a quarter of this is not cached.
+ETAG_CACHE_MAX_BYTES = int(os.getenv("GITHUB_ETAG_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Below this many remaining calls in the rate-limit window, calls are spread out until the reset.
+RATE_LIMIT_RESERVE = int(os.getenv("GITHUB_RATE_LIMIT_RESERVE", "100"))
+# Retries of a call rejected by a primary or secondary rate limit.
+RATE_LIMIT_RETRIES = int(os.getenv("GITHUB_RATE_LIMIT_RETRIES", "3"))
+# Longest single wait for a rate limit; beyond this the call fails instead.
+MAX_RATE_LIMIT_WAIT_SECONDS = float(os.getenv("GITHUB_MAX_RATE_LIMIT_WAIT_SECONDS", "120"))
+# Retries of an idempotent call after a 502/503/504 or a connection error, with jittered
+# exponential backoff starting at TRANSIENT_BACKOFF_SECONDS.
+TRANSIENT_RETRIES = int(os.getenv("GITHUB_TRANSIENT_RETRIES", "3"))
+TRANSIENT_BACKOFF_SECONDS = float(os.getenv("GITHUB_TRANSIENT_BACKOFF_SECONDS", "0.5"))
+_TRANSIENT_STATUSES = (502, 503, 504)
+# Creating a blob or tree is safe to repeat: the same content always gets the same SHA. A
+# repeated commit only leaves an unreferenced object, as no ref points at it until PATCHed.
+_IDEMPOTENT_POSTS = ("/repos/{repo}/git/blobs", "/repos/{repo}/git/trees", "/repos/{repo}/git/commits")
+
+class GitHubAPIError(Exception):
+    """Raised when the GitHub REST API answers with an error status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"GitHub API error {status}: {message}")
+        self.status = status
+
+class _LoopState:
+    """The pooled client and concurrency limit of one event loop and token."""
+
+    def __init__(self, token: str):
+        self.client = _new_client(token)
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+_states: Dict[tuple, _LoopState] = {}
+_logins: Dict[str, str] = {}
+_login_lookups: Dict[tuple, asyncio.Task] = {} # (token, loop) -> the /user call in flight
+_etags: "OrderedDict[tuple, tuple]" = OrderedDict() # (token, url) -> (etag, body, size)
+_etag_bytes = 0
+_rate_limits: Dict[str, dict] = {} # token -> {"remaining", "reset", "blocked_until"}
+_stats = {"requests": 0, "not_modified": 0, "rate_limit_waits": 0, "rate_limit_retries": 0, "transient_retries": 0,
+          "clients": 0}
+
+def _new_client(token: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=GITHUB_API_URL,
+        headers={
+            "Authorization": f"token {token}",
+            "Accept": "application/vnd.github.v3+json",
+        },
+        timeout=30,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+    )
+
+def _token(token: Optional[str]) -> str:
+    return token or os.getenv("GITHUB_PAT")
+
+def _state(token: str) -> _LoopState:
+    loop = asyncio.get_running_loop()
+    key = (token, loop)
+    state = _states.get(key)
+    if state is None:
+        # Clients are bound to their event loop; forget those of loops that have ended.
+        for stale in [k for k in _states if k[1].is_closed()]:
+            del _states[stale]
+        state = _states[key] = _LoopState(token)
+        _stats["clients"] += 1
+    return state
+
+def get_client(token: Optional[str] = None) -> httpx.AsyncClient:
+    """Returns the pooled client for the running event loop. Do not close it."""
+    return _state(_token(token)).client
+
+async def get_login(token: Optional[str] = None) -> str:
+    """Returns the login of the token's user, asking GitHub only the first time.
+
+    Concurrent callers share one lookup; a failed lookup is not cached, so the next call retries.
+    """
+    token = _token(token)
+    login = _logins.get(token)
+    if login is not None:
+        return login
+    key = (token, asyncio.get_running_loop())
+    lookup = _login_lookups.get(key)
+    if lookup is None:
+        lookup = _login_lookups[key] = asyncio.ensure_future(_lookup_login(token))
+        lookup.add_done_callback(lambda task: _forget_lookup(key, task))
+    # Shielded, so a caller that is cancelled does not cancel the lookup for the others.
+    return await asyncio.shield(lookup)
+
+async def _lookup_login(token: str) -> str:
+    login = _logins[token] = (await request("GET", "/user", token=token))["login"]
+    return login
+
+def _forget_lookup(key: tuple, task: asyncio.Task):
+    _login_lookups.pop(key, None)
+    if not task.cancelled():
+        task.exception() # Marks the error as retrieved even if every caller has gone
+
+@asynccontextmanager
+async def slot(token: Optional[str] = None):
+    """Waits for a free request slot and for the rate limit, then yields the pooled client.
+
+    request() uses this for every call; use it directly for streamed downloads.
+    """
+    token = _token(token)
+    state = _state(token)
+    # Pacing waits do not hold a slot, so they do not hold up calls for other work. A rate
+    # limit hit while waiting for the slot is still respected before the call goes out.
+    await _pace(token)
+    async with state.semaphore:
+        await _pace(token, spread=False)
+        yield state.client
+
+async def request(method: str, path: str, token: Optional[str] = None, **kwargs) -> dict:
+    """Sends a REST API request and returns the decoded JSON body.
+
+    GET requests are made conditional on the ETag of the last response for the same URL.
+    Calls rejected by a rate limit are retried after the time GitHub asks for. Idempotent
+    calls (GETs, ref updates and git object creation) are also retried after a 502, 503
+    or 504 or a connection error; other calls are not, as they may have taken effect.
+    """
+    token = _token(token)
+    cache_key = None
+    if method == "GET":
+        cache_key = (token, str(httpx.URL(path, params=kwargs.get("params"))))
+
+    base_headers = kwargs.pop("headers", None) or {}
+    endpoint = _endpoint(path)
+    retry_transient = _is_idempotent(method, endpoint)
+    rate_limit_retries = 0
+    transient_retries = 0
+    while True:
+        headers = dict(base_headers)
+        cached = _etags.get(cache_key) if cache_key else None
+        if cached:
+            headers["If-None-Match"] = cached[0]
+        try:
+            async with slot(token) as client:
+                with metrics.GITHUB_REQUEST_SECONDS.time(span=f"github {method} {endpoint}", method=method, endpoint=endpoint):
+                    response = await client.request(method, path, headers=headers, **kwargs)
+        except httpx.TransportError as e:
+            if not retry_transient or transient_retries >= TRANSIENT_RETRIES:
+                raise
+            transient_retries += 1
+            await transient_backoff(method, path, transient_retries, f"{type(e).__name__}: {e}")
+            continue
+        metrics.GITHUB_REQUESTS.inc(method=method, endpoint=endpoint, status=response.status_code)
+        _stats["requests"] += 1
+        _update_rate_limit(token, response)
+
+        if response.status_code == 304 and cached:
+            _stats["not_modified"] += 1
+            _etags.move_to_end(cache_key)
+            return cached[1]
+        if _is_rate_limited(response) and rate_limit_retries < RATE_LIMIT_RETRIES:
+            rate_limit_retries += 1
+            _stats["rate_limit_retries"] += 1
+            metrics.GITHUB_RETRIES.inc()
+            logger.warning(f"GitHub rate limit hit on {method} {path}. Retrying after {_wait_seconds(token):.1f}s.")
+            continue
+        if (response.status_code in _TRANSIENT_STATUSES and retry_transient
+                and transient_retries < TRANSIENT_RETRIES):
+            transient_retries += 1
+            await transient_backoff(method, path, transient_retries, f"status {response.status_code}")
+            continue
+        if response.status_code >= 400:
+            raise GitHubAPIError(response.status_code, response.text)
+
+        body = response.json() if response.content else {}
+        etag = response.headers.get("ETag")
+        if cache_key and etag:
+            _cache_etag(cache_key, etag, body, len(response.content))
+        return body
+
+def _cache_etag(cache_key: tuple, etag: str, body, size: int):
+    """Stores a response for revalidation, evicting the least recently used ones over the limits."""
+    global _etag_bytes
+    old = _etags.pop(cache_key, None)
+    if old:
+        _etag_bytes -= old[2]
+    if size > ETAG_CACHE_MAX_BYTES // 4:
+        return
+    _etags[cache_key] = (etag, body, size)
+    _etag_bytes += size
+    while len(_etags) > ETAG_CACHE_ENTRIES or _etag_bytes > ETAG_CACHE_MAX_BYTES:
+        _etag_bytes -= _etags.popitem(last=False)[1][2]
+
+def is_transient(error: Exception) -> bool:
+    """Returns whether a call failed in transit (a 502, 503 or 504 or a connection error), in
+    which case it may still have taken effect."""
+    if isinstance(error, GitHubAPIError):
+        return error.status in _TRANSIENT_STATUSES
+    return isinstance(error, httpx.TransportError)
+
+def _is_idempotent(method: str, endpoint: str) -> bool:
+    if method in ("GET", "HEAD"):
+        return True
+    if method == "PATCH":
+        return endpoint == "/repos/{repo}/git/refs/{path}"
+    return method == "POST" and endpoint in _IDEMPOTENT_POSTS
+
+async def transient_backoff(method: str, path: str, attempt: int, reason: str):
+    """Logs a failed idempotent call and waits before its retry number attempt."""
+    delay = random.uniform(0.5, 1.0) * TRANSIENT_BACKOFF_SECONDS * 2 ** (attempt - 1)
+    _stats["transient_retries"] += 1
+    metrics.GITHUB_TRANSIENT_RETRIES.inc()
+    logger.warning(f"GitHub {method} {path} failed ({reason}). Retry {attempt}/{TRANSIENT_RETRIES} in {delay:.1f}s.")
+    await asyncio.sleep(delay)
+
+def _endpoint(path: str) -> str:
+    """Reduces a request path to its route, so metrics are not labelled per repository or SHA."""
+    path = re.sub(r"^/repos/[^/]+/[^/]+", "/repos/{repo}", path.split("?")[0])
+    path = re.sub(r"/[0-9a-f]{40}\b", "/{sha}", path)
+    return re.sub(r"/(git/refs?|contents)/.*$", r"/\1/{path}", path)
+
+def _update_rate_limit(token: str, response: httpx.Response):
+    limits = _rate_limits.setdefault(token, {"remaining": None, "reset": 0.0, "blocked_until": 0.0})
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is not None and remaining.isdigit():
+        limits["remaining"] = int(remaining)
+    if reset is not None and reset.isdigit():
+        limits["reset"] = float(reset)
+    if _is_rate_limited(response):
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            blocked_until = time.time() + int(retry_after)
+        elif limits["remaining"] == 0 and limits["reset"]:
+            blocked_until = limits["reset"]
+        else:
+            blocked_until = time.time() + 60 # Secondary limit without a hint: GitHub asks for a minute
+        limits["blocked_until"] = max(limits["blocked_until"], blocked_until)
+
+def _is_rate_limited(response: httpx.Response) -> bool:
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    return (
+        "Retry-After" in response.headers
+        or response.headers.get("X-RateLimit-Remaining") == "0"
+        or "rate limit" in response.text.lower()
+    )
+
+def _wait_seconds(token: str, spread: bool = True) -> float:
+    """Returns how long the next call should wait to respect the rate limit.
+
+    With spread=False only a rate limit GitHub has rejected calls for counts, not the
+    spreading of the last calls of the window.
+    """
+    limits = _rate_limits.get(token)
+    if not limits:
+        return 0.0
+    now = time.time()
+    if limits["blocked_until"] > now:
+        return limits["blocked_until"] - now
+    remaining = limits["remaining"]
+    if spread and remaining is not None and remaining < RATE_LIMIT_RESERVE and limits["reset"] > now:
+        # Spread the calls that are left over the rest of the window.
+        return (limits["reset"] - now) / max(remaining, 1)
+    return 0.0
+
+async def _pace(token: str, spread: bool = True):
+    wait = _wait_seconds(token, spread)
+    if wait <= 0:
+        return
+    if wait > MAX_RATE_LIMIT_WAIT_SECONDS:
+        raise GitHubAPIError(429, f"Rate limited for another {wait:.0f}s")
+    _stats["rate_limit_waits"] += 1
+    await asyncio.sleep(wait)
+
+def stats() -> dict:
+    """Returns request, conditional-hit and rate-limit counters."""
+    result = dict(_stats)
+    result["etag_entries"] = len(_etags)
+    result["etag_bytes"] = _etag_bytes
+    return result
+
+async def aclose():
+    """Closes the pooled clients of the running event loop."""
+    loop = asyncio.get_running_loop()
+    for key in [k for k in _states if k[1] is loop]:
+        await _states.pop(key).client.aclose()
@@ -1,141 +1,637 @@
 import os
+import logging
+import json
+import re
 import time
-import requests
-from github import Github, GithubException
+import asyncio
+import hashlib
+import tarfile
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
 import base64
+from typing import Optional
 
-def create_or_update_repo(request_data: dict, generated_files: dict, attachment_meta: list) -> dict:
-    """Creates or updates a GitHub repository, enables Pages, and populates it with files."""
-    github_pat = os.getenv("GITHUB_PAT")
-    g = Github(github_pat)
-    user = g.get_user()
-    
-    task_id = request_data.get("task")
-    round_number = request_data.get("round", 1)
-    
-    repo_name = request_data.get("repo_name") 
-    if not repo_name: 
-        nonce = request_data.get("nonce")
-        repo_name = f"llm-app-{task_id}-{nonce}"
+import attachment_manager
+import github_client
+import metrics
+from github_client import GitHubAPIError
 
-    # Create a lookup map from filename to its temporary disk path
-    attachment_paths = {meta['name']: meta['path'] for meta in attachment_meta}
+logger = logging.getLogger(__name__)
 
-    repo = None
-    commit_sha = None
+# When enabled, all files for a round are published as one commit through the
+# Git Data API instead of one Contents API commit per file.
+BATCH_PUBLISH = os.getenv("GITHUB_BATCH_PUBLISH", "true").lower() != "false"
+
+# Repository snapshots for revision rounds, keyed by git tree SHA.
+SNAPSHOT_CACHE_DIR = Path(os.getenv("GITHUB_SNAPSHOT_CACHE_DIR", "/tmp/llm_deployer_snapshots"))
+SNAPSHOT_CACHE_MAX_ENTRIES = int(os.getenv("GITHUB_SNAPSHOT_CACHE_MAX_ENTRIES", "64"))
+
+# What round 1 does when the repository already exists: "reset" reuses it and force-points
+# main at a fresh root commit, "recreate" deletes and recreates it.
+ROUND1_MODE = os.getenv("GITHUB_ROUND1_MODE", "reset").lower()
+# How long to poll for a repository, branch or Pages site to become ready.
+READINESS_TIMEOUT_SECONDS = float(os.getenv("GITHUB_READINESS_TIMEOUT_SECONDS", "60"))
+# The 422 messages of POST /pages that mean "not yet" and "nothing to do"; any other 422 is final.
+_PAGES_BRANCH_MISSING = re.compile(r"branch must exist|branch .*(not found|does not exist|doesn't exist)", re.IGNORECASE)
+_PAGES_ALREADY_ENABLED = re.compile(r"already (enabled|exists)", re.IGNORECASE)
+
+def _run(coro):
+    """Runs a coroutine from synchronous code and closes the pooled clients of its event loop."""
+    async def run_and_close():
+        try:
+            return await coro
+        finally:
+            await github_client.aclose()
+    return asyncio.run(run_and_close())
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+async def create_or_update_repo_async(request_data: dict, generated_files: dict, attachment_meta: list,
+                                      uploaded_blobs: Optional[dict] = None) -> dict:
+    """Creates or updates a GitHub repository, enables Pages, and populates it with files.
 
+    uploaded_blobs maps paths to blob SHAs already uploaded by a BlobUploader; those files are
+    referenced by SHA instead of being sent again.
+    """
+    provisioned = await provision_repo_async(request_data)
+    return await publish_to_repo_async(request_data, provisioned, generated_files, attachment_meta, uploaded_blobs)
+
+def get_repo_name(request_data: dict) -> str:
+    """Returns the repository name of a build request."""
+    repo_name = request_data.get("repo_name")
+    if not repo_name:
+        repo_name = f"llm-app-{request_data.get('task')}-{request_data.get('nonce')}"
+    return repo_name
+
+async def provision_repo_async(request_data: dict) -> dict:
+    """Gets the repository of a build request ready for its files.
+
+    In round 1 the repository is created (or reused) and Pages is enabled; neither needs the
+    generated files, so this can run while they are being generated. Nothing is deleted or
+    overwritten here: an existing repository that "recreate" mode replaces is only marked
+    for recreation, which publish_to_repo_async does once the files exist. In later rounds
+    the existing repository is looked up.
+
+    Returns a dict with the owner's 'login', the 'repo' as returned by the API, whether an
+    existing repository was 'reused' for round 1 and whether it is still to be 'recreate'd.
+    """
+    login = await github_client.get_login()
+    round_number = request_data.get("round", 1)
+    repo_name = get_repo_name(request_data)
+    reused = False
+    recreate = False
     try:
         if round_number == 1:
-            try:
-                existing_repo = user.get_repo(repo_name)
-                print(f"Repo '{repo_name}' already exists. Deleting for a fresh start.")
-                existing_repo.delete()
-                time.sleep(2)
-            except GithubException as e:
-                if e.status != 404: raise
-            
-            print(f"Creating new public repository '{repo_name}' with MIT license...")
-            # Use auto_init and license_template to create the repo with a license from the start.
-            repo = user.create_repo(repo_name, private=False, auto_init=True, license_template="mit")
-            time.sleep(2)
+            repo, reused, recreate = await _prepare_round1_repo(login, repo_name)
+            if not recreate:
+                # --- NEW: Enable GitHub Pages via API ---
+                logger.info("Enabling GitHub Pages programmatically...")
+                await _enable_github_pages(repo["full_name"])
         else:
-            print(f"Fetching existing repository: '{repo_name}' for update.")
-            repo = user.get_repo(repo_name)
+            logger.info(f"Fetching existing repository: '{repo_name}' for update.")
+            repo = await github_client.request("GET", f"/repos/{login}/{repo_name}")
+    except Exception as e:
+        logger.error(f"An unexpected error occurred in github_manager: {e}")
+        raise
+    return {"login": login, "repo": repo, "reused": reused, "recreate": recreate}
+
+async def publish_to_repo_async(request_data: dict, provisioned: dict, generated_files: dict, attachment_meta: list,
+                                uploaded_blobs: Optional[dict] = None) -> dict:
+    """Commits the generated files to a repository returned by provision_repo_async."""
+    round_number = request_data.get("round", 1)
+    login = provisioned["login"]
+    repo = provisioned["repo"]
+    reused = provisioned["reused"]
+    commit_sha = None
+    if provisioned.get("recreate"):
+        # Only now that the files exist is the previous deployment deleted.
+        repo = await _recreate_repo(login, repo["name"])
+        logger.info("Enabling GitHub Pages programmatically...")
+        await _enable_github_pages(repo["full_name"])
+        uploaded_blobs = None # they went to the deleted repository
 
-        print("Preparing to commit files...")
+    # Create a lookup map from filename to its stored attachment
+    attachments_by_name = {meta['name']: meta for meta in attachment_meta}
 
+    try:
+        logger.info("Preparing to commit files...")
+
+        files_to_commit = {}
+        known_shas = {}
         for filename, content in generated_files.items():
             commit_content = content
 
-            # If this file was an original attachment, read its content from disk.
-            if filename in attachment_paths:
+            # If this file was an original attachment, commit its content from the attachment store.
+            # It is only read from disk if it differs from what is already in the repository.
+            if filename in attachments_by_name:
+                meta = attachments_by_name[filename]
                 try:
-                    with open(attachment_paths[filename], "rb") as f:
-                        commit_content = f.read()
+                    known_shas[filename] = await asyncio.to_thread(attachment_manager.get_git_blob_sha, meta)
                 except Exception as e:
-                    print(f"ERROR: Could not read attachment file from disk: {attachment_paths[filename]}. Skipping. Error: {e}")
+                    logger.error(f"Could not read attachment file from disk: {meta['path']}. Skipping. Error: {e}")
                     continue # Skip this file
-            
-            commit_message = f"feat: Add/update {filename} for round {round_number}"
-            commit_sha = commit_file(repo, filename, commit_content, commit_message)
-            print(f"  - Committed '{filename}'")
+                commit_content = Path(meta['path'])
+            files_to_commit[filename] = commit_content
 
         if round_number == 1:
-            # The LICENSE is now created automatically, so we only need to add the workflow.
-            workflow_content = get_deploy_workflow_content()
-            commit_sha = commit_file(repo, ".github/workflows/deploy.yml", workflow_content, "ci: Add GitHub Pages deployment workflow")
-            print("  - Committed deployment workflow")
-        
-        # --- NEW: Enable GitHub Pages via API ---
-        if round_number == 1:
-            print("Enabling GitHub Pages programmatically...")
-            enable_github_pages(github_pat, repo.full_name)
-            
-        repo_url = repo.html_url
-        pages_url = f"https://{user.login}.github.io/{repo.name}/"
-        
-        print(f"Successfully configured repo. URL: {repo_url}")
-        
+            # A new repository gets its LICENSE from GitHub; a reused one starts over from a
+            # root commit, so the LICENSE is written here.
+            if reused:
+                files_to_commit["LICENSE"] = get_mit_license_content(login)
+            files_to_commit[".github/workflows/deploy.yml"] = get_deploy_workflow_content()
+
+        changes = None
+        if BATCH_PUBLISH:
+            commit_message = f"feat: Deploy app for round {round_number}"
+            result = await _publish_files(repo["full_name"], files_to_commit, commit_message,
+                                          base_snapshot=request_data.get("base_snapshot"), known_shas=known_shas,
+                                          uploaded_blobs=uploaded_blobs, replace=reused)
+            commit_sha = result["commit_sha"]
+            changes = {key: result[key] for key in ("added", "modified", "unchanged")}
+            if changes["added"] or changes["modified"]:
+                logger.info(f"  - Committed {changes['added']} added and {changes['modified']} modified files in a single commit ({commit_sha})")
+            logger.info(f"  - Skipped {changes['unchanged']} unchanged files")
+        else:
+            if reused:
+                await _publish_files(repo["full_name"], {"LICENSE": files_to_commit.pop("LICENSE")},
+                                     "Initial commit", replace=True)
+            for filename, commit_content in files_to_commit.items():
+                if filename == ".github/workflows/deploy.yml":
+                    commit_message = "ci: Add GitHub Pages deployment workflow"
+                else:
+                    commit_message = f"feat: Add/update {filename} for round {round_number}"
+                commit_sha = await _commit_file(repo["full_name"], filename, commit_content, commit_message)
+                logger.info(f"  - Committed '{filename}'")
+
+        repo_url = repo["html_url"]
+        pages_url = f"https://{login}.github.io/{repo['name']}/"
+
+        logger.info(f"Successfully configured repo. URL: {repo_url}")
+
         return {
-            "repo_name": repo.name,
+            "repo_name": repo["name"],
             "repo_url": repo_url,
             "pages_url": pages_url,
-            "commit_sha": commit_sha
+            "commit_sha": commit_sha,
+            "changes": changes
         }
 
     except Exception as e:
-        print(f"ERROR: An unexpected error occurred in github_manager: {e}")
+        logger.error(f"An unexpected error occurred in github_manager: {e}")
         raise
 
-def enable_github_pages(github_pat: str, repo_full_name: str):
+async def _prepare_round1_repo(login: str, repo_name: str) -> tuple:
+    """Gets the repository for a first round ready. Returns it with whether it was reused and
+    whether it still has to be recreated.
+
+    A missing repository is created. An existing one is reused in "reset" mode; otherwise it
+    is returned as is, to be recreated by _recreate_repo. Instead of sleeping, this polls
+    until GitHub reports each step as done.
+    """
+    repo_full_name = f"{login}/{repo_name}"
+    repo = await _find_repo(repo_full_name)
+
+    if repo and ROUND1_MODE == "reset":
+        logger.info(f"Repo '{repo_name}' already exists. Reusing it; main will be reset to a fresh root commit.")
+        return repo, True, False
+    if repo:
+        logger.info(f"Repo '{repo_name}' already exists. It will be recreated once the app is generated.")
+        return repo, False, True
+    return await _create_repo(login, repo_name), False, False
+
+async def _recreate_repo(login: str, repo_name: str) -> dict:
+    """Deletes a repository and creates it again."""
+    repo_full_name = f"{login}/{repo_name}"
+    logger.info(f"Deleting repo '{repo_name}' for a fresh start.")
+    await github_client.request("DELETE", f"/repos/{repo_full_name}")
+    await _wait_until(lambda: _exists(f"/repos/{repo_full_name}", expected=False), f"'{repo_name}' to be deleted")
+    return await _create_repo(login, repo_name)
+
+async def _create_repo(login: str, repo_name: str) -> dict:
+    repo_full_name = f"{login}/{repo_name}"
+    logger.info(f"Creating new public repository '{repo_name}' with MIT license...")
+    for attempt in range(github_client.TRANSIENT_RETRIES + 1):
+        try:
+            # Use auto_init and license_template to create the repo with a license from the start.
+            repo = await github_client.request("POST", "/user/repos", json={
+                "name": repo_name,
+                "private": False,
+                "auto_init": True,
+                "license_template": "mit",
+            })
+            break
+        except Exception as e:
+            # Creating a repository is not idempotent, so after a failure in transit (or a 422
+            # for the name on a retry) check whether the earlier call created it before retrying.
+            name_taken = attempt > 0 and isinstance(e, GitHubAPIError) and e.status == 422
+            if not (github_client.is_transient(e) or name_taken):
+                raise
+            repo = await _find_repo(repo_full_name)
+            if repo:
+                break
+            if attempt == github_client.TRANSIENT_RETRIES:
+                raise
+            logger.warning(f"Creating '{repo_name}' failed ({e}). Retrying.")
+    await _wait_until(lambda: _exists(f"/repos/{repo_full_name}/branches/main"), f"the main branch of '{repo_name}'")
+    return repo
+
+async def _find_repo(repo_full_name: str) -> Optional[dict]:
+    """Returns a repository, or None if it does not exist."""
+    try:
+        return await github_client.request("GET", f"/repos/{repo_full_name}")
+    except GitHubAPIError as e:
+        if e.status != 404: raise
+        return None
+
+async def _exists(path: str, expected: bool = True) -> bool:
+    """Returns whether a GET of path succeeding matches expected."""
+    try:
+        await github_client.request("GET", path)
+        return expected
+    except GitHubAPIError as e:
+        if e.status not in (404, 409): raise # 409: the repository is still empty
+        return not expected
+
+async def _wait_until(check, what: str, timeout: float = READINESS_TIMEOUT_SECONDS):
+    """Polls the async check() with exponential backoff until it returns True."""
+    delay = 0.25
+    deadline = time.monotonic() + timeout
+    while not await check():
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Timed out after {timeout:.0f}s waiting for {what}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 4)
+
+def create_or_update_repo(request_data: dict, generated_files: dict, attachment_meta: list,
+                          uploaded_blobs: Optional[dict] = None) -> dict:
+    """Synchronous wrapper around create_or_update_repo_async."""
+    return _run(create_or_update_repo_async(request_data, generated_files, attachment_meta, uploaded_blobs))
+
+async def enable_github_pages_async(github_pat: str, repo_full_name: str):
     """Enables GitHub Pages for the main branch using the REST API."""
-    headers = {
-        "Authorization": f"token {github_pat}",
-        "Accept": "application/vnd.github.v3+json",
-    }
-    url = f"https://api.github.com/repos/{repo_full_name}/pages"
+    await _enable_github_pages(repo_full_name, token=github_pat)
+
+def enable_github_pages(github_pat: str, repo_full_name: str):
+    """Synchronous wrapper around enable_github_pages_async."""
+    _run(enable_github_pages_async(github_pat, repo_full_name))
+
+async def _enable_github_pages(repo_full_name: str, token: Optional[str] = None):
     data = {
         "source": {"branch": "main", "path": "/"}
     }
-    
-    # Give GitHub a moment for the main branch to be fully ready
-    time.sleep(5) 
-    
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code == 201:
-        print("GitHub Pages enabled successfully.")
-    else:
-        print(f"Warning: Could not enable GitHub Pages via API. Status: {response.status_code}, Response: {response.text}")
-        print("The GitHub Actions workflow will act as a backup.")
 
-def commit_file(repo, path: str, content: str or bytes, message: str) -> str:
-    """Commits a file to the repository, creating or updating it."""
+    async def try_enable() -> bool:
+        try:
+            await github_client.request("POST", f"/repos/{repo_full_name}/pages", token=token, json=data)
+            logger.info("GitHub Pages enabled successfully.")
+            return True
+        except GitHubAPIError as e:
+            # A reused repository keeps its Pages site.
+            if e.status == 409 or (e.status == 422 and _PAGES_ALREADY_ENABLED.search(str(e))):
+                logger.info("GitHub Pages is already enabled.")
+                return True
+            if e.status == 404 or e.status >= 500 or (e.status == 422 and _PAGES_BRANCH_MISSING.search(str(e))):
+                return False # The branch is not visible to Pages yet
+            raise
+
     try:
-        existing_file = repo.get_contents(path, ref="main")
-        result = repo.update_file(path, message, content, existing_file.sha, branch="main")
-        return result['commit'].sha
-    except GithubException as e:
-        if e.status == 404: # File does not exist, create it
-            result = repo.create_file(path, message, content, branch="main")
-            return result['commit'].sha
-        else:
+        with metrics.GITHUB_PAGES_SECONDS.time(span="github pages"):
+            await _wait_until(try_enable, "GitHub Pages to accept the main branch")
+    except (GitHubAPIError, TimeoutError) as e:
+        logger.warning(f"Could not enable GitHub Pages via API. {e}")
+        logger.warning("The GitHub Actions workflow will act as a backup.")
+
+async def _commit_file(repo_full_name: str, path: str, content, message: str) -> str:
+    """Commits a file to the repository through the Contents API, creating or updating it."""
+    if isinstance(content, Path):
+        content = await asyncio.to_thread(_read_file, content)
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    body = {
+        "message": message,
+        "content": base64.b64encode(data).decode("ascii"),
+        "branch": "main",
+    }
+    try:
+        existing_file = await github_client.request("GET", f"/repos/{repo_full_name}/contents/{path}", params={"ref": "main"})
+        body["sha"] = existing_file["sha"]
+    except GitHubAPIError as e:
+        if e.status != 404: # A 404 means the file does not exist yet and will be created
             raise
+    result = await github_client.request("PUT", f"/repos/{repo_full_name}/contents/{path}", json=body)
+    metrics.GITHUB_UPLOAD_BYTES.inc(len(data))
+    return result["commit"]["sha"]
 
-def get_repo_contents(repo_name: str) -> dict:
-    github_pat = os.getenv("GITHUB_PAT")
-    g = Github(github_pat)
-    user = g.get_user()
-    repo = user.get_repo(repo_name)
-    tree = repo.get_git_tree("main", recursive=True).tree
-    file_contents = {}
-    for element in tree:
-        if element.type == 'blob':
+class BlobUploader:
+    """Uploads files to a repository as git blobs while the rest of the app is still being generated.
+
+    Files that match the base snapshot or are listed in skip_paths (such as attachments, whose
+    real content comes from disk) are skipped. If the repository is still being provisioned,
+    pass the awaitable that provisions it as ready; uploads wait for it, and are skipped if the
+    repository is still to be recreated. Call finish() to wait
+    for the uploads and get the blob SHA of every file that was uploaded, to pass on to
+    create_or_update_repo_async.
+    """
+
+    def __init__(self, repo_name: str, base_snapshot: Optional[dict] = None, skip_paths=(), max_concurrency: int = 4,
+                 ready: Optional[asyncio.Future] = None):
+        self.repo_name = repo_name
+        self._ready = ready
+        self._skip_paths = set(skip_paths)
+        self._known_shas = dict(base_snapshot["blob_shas"]) if base_snapshot else {}
+        self._tasks = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def submit(self, path: str, content):
+        """Starts uploading a file in the background unless it is unchanged."""
+        if not isinstance(content, str) or path in self._skip_paths:
+            return
+        blob_sha = git_blob_sha(content)
+        if self._known_shas.get(path) == blob_sha:
+            return
+        self._tasks[path] = asyncio.create_task(self._upload(content, blob_sha))
+
+    async def finish(self) -> dict:
+        """Waits for all uploads and returns the uploaded blob SHAs (path -> sha)."""
+        results = await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        uploaded = {}
+        for path, result in zip(self._tasks, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Early upload of '{path}' failed, it will be sent with the commit: {result}")
+            elif result:
+                uploaded[path] = result
+        return uploaded
+
+    async def _upload(self, content: str, blob_sha: str) -> Optional[str]:
+        if self._ready is not None:
+            provisioned = await asyncio.shield(self._ready)
+            if isinstance(provisioned, dict) and provisioned.get("recreate"):
+                return None
+        async with self._semaphore:
+            repo_full_name = f"{await github_client.get_login()}/{self.repo_name}"
+            blob = await github_client.request("POST", f"/repos/{repo_full_name}/git/blobs", json={
+                "content": content,
+                "encoding": "utf-8",
+            })
+            metrics.GITHUB_UPLOAD_BYTES.inc(len(content.encode("utf-8")))
+            return blob["sha"] if blob["sha"] == blob_sha else None
+
+def git_blob_sha(content) -> str:
+    """Computes the git blob SHA-1 of text or binary content, as git itself would."""
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+async def publish_files_async(repo_full_name: str, files: dict, message: str, branch: str = "main",
+                              base_snapshot: Optional[dict] = None, known_shas: Optional[dict] = None) -> dict:
+    """Commits the changed files to the branch as a single commit using the Git Data API.
+
+    Blob SHAs are computed locally and compared against the current tree, so only added
+    or modified files are uploaded. If nothing changed, no commit is created at all.
+    Text content is sent inline with the tree; only binary content needs its own blob upload.
+
+    base_snapshot may carry the 'commit_sha' and 'blob_shas' of an earlier snapshot; it is
+    used instead of fetching the tree again when the branch has not moved since.
+
+    File content may be text, bytes or a Path to read from disk. known_shas may give
+    precomputed blob SHAs (path -> sha); Path content must have one, and is only read
+    when it needs to be uploaded.
+
+    Returns a dict with the resulting 'commit_sha' and the 'added', 'modified' and
+    'unchanged' file counts.
+    """
+    return await _publish_files(repo_full_name, files, message, branch, base_snapshot, known_shas)
+
+def publish_files(repo_full_name: str, files: dict, message: str, branch: str = "main",
+                  base_snapshot: Optional[dict] = None, known_shas: Optional[dict] = None) -> dict:
+    """Synchronous wrapper around publish_files_async."""
+    return _run(publish_files_async(repo_full_name, files, message, branch, base_snapshot, known_shas))
+
+async def _publish_files(repo_full_name: str, files: dict, message: str,
+                         branch: str = "main", base_snapshot: Optional[dict] = None,
+                         known_shas: Optional[dict] = None, uploaded_blobs: Optional[dict] = None,
+                         replace: bool = False) -> dict:
+    """See publish_files_async. With replace=True the files become a new root commit that the
+    branch is force-pointed at, dropping all earlier history."""
+    known_shas = known_shas or {}
+    uploaded_blobs = uploaded_blobs or {}
+    repo_path = f"/repos/{repo_full_name}"
+    if replace:
+        base_commit_sha = base_tree_sha = None
+        current_shas = {}
+    else:
+        ref = await github_client.request("GET", f"{repo_path}/git/ref/heads/{branch}")
+        base_commit_sha = ref["object"]["sha"]
+        base_commit = await github_client.request("GET", f"{repo_path}/git/commits/{base_commit_sha}")
+        base_tree_sha = base_commit["tree"]["sha"]
+        if base_snapshot and base_snapshot.get("commit_sha") == base_commit_sha:
+            current_shas = base_snapshot["blob_shas"]
+        else:
+            current_shas = await _get_blob_shas(repo_full_name, base_tree_sha)
+
+    elements = []
+    added = modified = unchanged = 0
+    for path, content in files.items():
+        current_sha = current_shas.get(path)
+        blob_sha = known_shas.get(path) or git_blob_sha(content)
+        if current_sha == blob_sha:
+            unchanged += 1
+            continue
+        if current_sha is None:
+            added += 1
+        else:
+            modified += 1
+
+        if uploaded_blobs.get(path) == blob_sha:
+            elements.append({"path": path, "mode": "100644", "type": "blob", "sha": blob_sha})
+            continue
+
+        if isinstance(content, Path):
+            content = await asyncio.to_thread(_read_file, content)
+        if isinstance(content, bytes):
+            blob = await github_client.request("POST", f"{repo_path}/git/blobs", json={
+                "content": base64.b64encode(content).decode("ascii"),
+                "encoding": "base64",
+            })
+            metrics.GITHUB_UPLOAD_BYTES.inc(len(content))
+            elements.append({"path": path, "mode": "100644", "type": "blob", "sha": blob["sha"]})
+        else:
+            metrics.GITHUB_UPLOAD_BYTES.inc(len(content.encode("utf-8")))
+            elements.append({"path": path, "mode": "100644", "type": "blob", "content": content})
+
+    commit_sha = base_commit_sha
+    if elements:
+        tree_body = {"tree": elements}
+        if base_tree_sha:
+            tree_body["base_tree"] = base_tree_sha
+        tree = await github_client.request("POST", f"{repo_path}/git/trees", json=tree_body)
+        commit = await github_client.request("POST", f"{repo_path}/git/commits", json={
+            "message": message,
+            "tree": tree["sha"],
+            "parents": [base_commit_sha] if base_commit_sha else [],
+        })
+        try:
+            await github_client.request("PATCH", f"{repo_path}/git/refs/heads/{branch}",
+                                        json={"sha": commit["sha"], "force": replace})
+        except GitHubAPIError as e:
+            if not (replace and e.status in (404, 422)): raise
+            # The branch does not exist yet
+            await github_client.request("POST", f"{repo_path}/git/refs",
+                                        json={"ref": f"refs/heads/{branch}", "sha": commit["sha"]})
+        commit_sha = commit["sha"]
+
+    return {"commit_sha": commit_sha, "added": added, "modified": modified, "unchanged": unchanged}
+
+async def _get_blob_shas(repo_full_name: str, tree_sha: str) -> dict:
+    """Lists the git blob SHA of every file in a tree (path -> sha)."""
+    tree = await github_client.request("GET", f"/repos/{repo_full_name}/git/trees/{tree_sha}", params={"recursive": "1"})
+    return {element["path"]: element["sha"] for element in tree["tree"] if element["type"] == "blob"}
+
+async def get_repo_snapshot_async(repo_name: str) -> dict:
+    """Fetches every file on the main branch of a repository in bulk.
+
+    The whole tree is downloaded as a single tarball and cached on disk keyed by its
+    tree SHA, so a revision against an unchanged repository needs no content requests.
+
+    Returns a dict with the 'commit_sha' and 'tree_sha' of the snapshot, the UTF-8
+    'files' (path -> text), the 'binary_files' that could not be decoded as text and
+    the git 'blob_shas' (path -> sha) of every file in the tree.
+    """
+    login = await github_client.get_login()
+    repo_full_name = f"{login}/{repo_name}"
+    branch = await github_client.request("GET", f"/repos/{repo_full_name}/branches/main")
+    commit_sha = branch["commit"]["sha"]
+    tree_sha = branch["commit"]["commit"]["tree"]["sha"]
+
+    cache_path = SNAPSHOT_CACHE_DIR / f"{tree_sha}.json"
+    snapshot = await asyncio.to_thread(_read_snapshot_cache, cache_path)
+    if snapshot:
+        logger.info(f"Using cached snapshot of '{repo_name}' (tree {tree_sha}).")
+        snapshot["commit_sha"] = commit_sha
+        return snapshot
+
+    logger.info(f"Downloading snapshot of '{repo_name}' at {commit_sha}...")
+    blob_shas = await _get_blob_shas(repo_full_name, tree_sha)
+    files, binary_files = await _download_tarball_files(repo_full_name, commit_sha)
+
+    snapshot = {
+        "commit_sha": commit_sha,
+        "tree_sha": tree_sha,
+        "files": files,
+        "binary_files": binary_files,
+        "blob_shas": blob_shas,
+    }
+    await asyncio.to_thread(_write_snapshot_cache, cache_path, snapshot)
+    return snapshot
+
+def get_repo_snapshot(repo_name: str) -> dict:
+    """Synchronous wrapper around get_repo_snapshot_async."""
+    return _run(get_repo_snapshot_async(repo_name))
+
+async def _download_tarball_files(repo_full_name: str, ref: str) -> tuple:
+    """Streams the repository tarball for a ref and splits its files into text and binary."""
+    path = f"/repos/{repo_full_name}/tarball/{ref}"
+    with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as spool:
+        for attempt in range(github_client.TRANSIENT_RETRIES + 1):
+            spool.seek(0)
+            spool.truncate()
+            try:
+                await _download_tarball(path, spool)
+                break
+            except Exception as e:
+                if not github_client.is_transient(e) or attempt == github_client.TRANSIENT_RETRIES:
+                    raise
+                await github_client.transient_backoff("GET", path, attempt + 1, str(e))
+        spool.seek(0)
+        return await asyncio.to_thread(_read_tarball_files, spool)
+
+async def _download_tarball(path: str, spool):
+    # The API redirects to a pre-signed download URL; httpx drops the token on the way.
+    async with github_client.slot() as client:
+        with metrics.GITHUB_REQUEST_SECONDS.time(span="github GET tarball", method="GET",
+                                                 endpoint="/repos/{repo}/tarball/{sha}"):
+            async with client.stream("GET", path, follow_redirects=True, timeout=60) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    raise GitHubAPIError(response.status_code, response.text)
+                async for chunk in response.aiter_bytes():
+                    spool.write(chunk)
+
+def _read_tarball_files(fileobj) -> tuple:
+    files = {}
+    binary_files = []
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            # Entries are prefixed with a '<owner>-<repo>-<sha>/' directory.
+            path = member.name.split("/", 1)[-1]
+            raw = archive.extractfile(member).read()
+            if b"\0" in raw:
+                binary_files.append(path)
+                continue
             try:
-                content = repo.get_contents(element.path).decoded_content.decode('utf-8')
-                file_contents[element.path] = content
-            except (UnicodeDecodeError, GithubException):
-                pass 
-    return file_contents
+                files[path] = raw.decode("utf-8")
+            except UnicodeDecodeError:
+                binary_files.append(path)
+    return files, sorted(binary_files)
+
+def _read_snapshot_cache(cache_path: Path) -> Optional[dict]:
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        os.utime(cache_path) # Mark as recently used for pruning
+        return snapshot
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def _write_snapshot_cache(cache_path: Path, snapshot: dict):
+    """Atomically writes a snapshot to the cache and prunes the least recently used entries."""
+    try:
+        SNAPSHOT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=SNAPSHOT_CACHE_DIR, suffix=".tmp", delete=False) as f:
+            json.dump(snapshot, f)
+        os.replace(f.name, cache_path)
+
+        entries = sorted(SNAPSHOT_CACHE_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for stale in entries[SNAPSHOT_CACHE_MAX_ENTRIES:]:
+            stale.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not write snapshot cache '{cache_path}': {e}")
+
+def get_repo_contents(repo_name: str) -> dict:
+    """Returns the text files on the main branch of a repository (path -> content)."""
+    snapshot = get_repo_snapshot(repo_name)
+    if snapshot["binary_files"]:
+        logger.info(f"Skipping binary or non-UTF-8 files: {snapshot['binary_files']}")
+    return snapshot["files"]
+
+def get_mit_license_content(copyright_holder: str) -> str:
+    """Returns the text of the MIT License for the current year."""
+    year = datetime.now(timezone.utc).year
+    return f"""MIT License
+
+Copyright (c) {year} {copyright_holder}
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
 
 def get_deploy_workflow_content() -> str:
     """Returns the GitHub Actions workflow file content as a string."""
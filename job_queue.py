@@ -0,0 +1,422 @@
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import metrics
+import state_manager
+
+logger = logging.getLogger(__name__)
+
+# Builds waiting for a worker; when the queue is full new requests get a 429.
+MAX_QUEUED_JOBS = int(os.getenv("JOB_QUEUE_SIZE", "256"))
+# Workers are coroutines, so many builds can wait on the network at once; the stage
+# limits below bound how many of them actually talk to each external service.
+WORKER_COUNT = int(os.getenv("JOB_WORKERS", "64"))
+# Finished jobs kept in memory for the status endpoint.
+JOB_HISTORY_SIZE = int(os.getenv("JOB_HISTORY_SIZE", "500"))
+
+# How many jobs may be inside each external stage at the same time.
+STAGE_LIMITS = {
+    # Gemini's request and token rates are governed by llm_admission; this only bounds how
+    # many generations are in progress at once.
+    "llm": int(os.getenv("JOB_LLM_CONCURRENCY", "8")),
+    "github": int(os.getenv("JOB_GITHUB_CONCURRENCY", "4")),
+    "notify": int(os.getenv("JOB_NOTIFY_CONCURRENCY", "8")),
+}
+
+# Worker processes sharing the state database (uvicorn workers, replicas on a shared volume)
+# coordinate through task leases, see state_manager: a task is built by one process at a
+# time, its rounds run in order across processes, and rounds queued or running in a process
+# that stops heartbeating are taken over by another.
+LEASES_ENABLED = os.getenv("JOB_LEASES", "true").lower() != "false"
+# A process that has not heartbeated for this long is considered dead. Heartbeats are sent
+# every third of it.
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "30"))
+# How often a job waiting for its task's lease checks again.
+LEASE_POLL_SECONDS = float(os.getenv("JOB_LEASE_POLL_SECONDS", "1"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class JobConflictError(Exception):
+    """Raised when a different request for a task and round is already being built."""
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Job queue is full. Retry after {retry_after} seconds.")
+        self.retry_after = retry_after
+
+_queue: Optional[asyncio.Queue] = None
+_workers: list = []
+_jobs: "OrderedDict[tuple, Dict]" = OrderedDict()
+_jobs_lock = threading.Lock()
+_done_events: Dict[tuple, asyncio.Event] = {} # unfinished jobs -> set when they finish
+_stage_semaphores: Dict[str, asyncio.Semaphore] = {}
+_average_job_seconds: Optional[float] = None
+_current_job: contextvars.ContextVar = contextvars.ContextVar("current_job", default=None)
+_submit_lock: Optional[asyncio.Lock] = None # orders the database and queue updates of submissions and takeovers
+_heartbeat_task: Optional[asyncio.Task] = None
+_leased: Dict[str, Tuple[asyncio.Task, float]] = {} # task id -> (running build, when its lease was taken)
+_lost_leases: set = set()
+
+async def start(handler: Callable[[dict], Awaitable[Optional[str]]]):
+    """Starts the worker pool. Each job's data is passed to the async handler.
+
+    The handler may return the final status of the job ('succeeded' or 'failed').
+    """
+    global _queue, _heartbeat_task, _submit_lock
+    _queue = asyncio.Queue(maxsize=MAX_QUEUED_JOBS)
+    _submit_lock = asyncio.Lock()
+    for stage, limit in STAGE_LIMITS.items():
+        _stage_semaphores[stage] = asyncio.Semaphore(limit)
+    for _ in range(WORKER_COUNT):
+        _workers.append(asyncio.create_task(_worker(handler)))
+    if LEASES_ENABLED:
+        _heartbeat_task = asyncio.create_task(_heartbeat_loop())
+    logger.info(f"Job queue started with {WORKER_COUNT} workers (queue size {MAX_QUEUED_JOBS}, stage limits {STAGE_LIMITS}"
+                f"{f', worker id {WORKER_ID}' if LEASES_ENABLED else ''}).")
+
+async def stop():
+    """Cancels the worker pool. Jobs still queued are dropped; with leases they are handed back,
+    together with the interrupted running ones, for another process to take over."""
+    global _heartbeat_task
+    if _heartbeat_task:
+        _heartbeat_task.cancel()
+        await asyncio.gather(_heartbeat_task, return_exceptions=True)
+        _heartbeat_task = None
+    with _jobs_lock:
+        running = [(job["task"], job["round"]) for job in _jobs.values() if job["status"] == "running"]
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    if LEASES_ENABLED:
+        try:
+            for task_id, round_number in running:
+                await asyncio.to_thread(state_manager.record_round, task_id, round_number, "queued", owner=WORKER_ID)
+            await asyncio.to_thread(state_manager.retire_worker, WORKER_ID)
+        except Exception as e:
+            logger.warning(f"Could not hand over this worker's rounds: {e}")
+
+def lease_owner() -> Optional[str]:
+    """Returns the id this process records as the owner of its rounds, or None without leases."""
+    return WORKER_ID if LEASES_ENABLED else None
+
+async def submit(data: dict) -> Tuple[Dict, bool]:
+    """Queues a build job and returns its status record and whether a new job was created.
+
+    A repeat of a request that is queued, running or has succeeded (same task, round and
+    data["idempotency_key"]) does not start another build; the existing job is returned
+    instead, also when another worker process has it. A job waits for the unfinished
+    earlier rounds of its task before it starts.
+
+    Raises JobConflictError when a different request for the same round is unfinished,
+    and QueueFullError when no more jobs can be queued.
+    """
+    key = (data.get("task"), data.get("round", 1))
+    idempotency_key = data.get("idempotency_key")
+    async with _submit_lock:
+        existing = _find_job(key, idempotency_key)
+        if existing:
+            return existing, False
+        if _queue.full():
+            raise QueueFullError(_estimate_retry_after())
+        if LEASES_ENABLED:
+            # The stored request lets another process rebuild the round; it has no use for the secret.
+            request = {name: value for name, value in data.items() if name != "secret"}
+            record, created = await asyncio.to_thread(state_manager.enqueue_round, key[0], key[1], idempotency_key,
+                                                      request, WORKER_ID, LEASE_SECONDS)
+            if not created:
+                if record["idempotency_key"] != idempotency_key:
+                    raise JobConflictError(f"Round {key[1]} of task {key[0]} is already being built for another request.")
+                return _remote_job(record), False
+        return _enqueue(data), True
+
+def _find_job(key: tuple, idempotency_key: Optional[str]) -> Optional[Dict]:
+    """Returns a copy of this process's job for the same request, raising JobConflictError
+    when it has an unfinished one for a different request."""
+    with _jobs_lock:
+        existing = _jobs.get(key)
+        if existing and existing["status"] not in ("failed", "taken_over"):
+            if existing["idempotency_key"] == idempotency_key:
+                return _snapshot(existing)
+            if existing["finished_at"] is None:
+                raise JobConflictError(f"Round {key[1]} of task {key[0]} is already being built for another request.")
+    return None
+
+def _enqueue(data: dict) -> Dict:
+    key = (data.get("task"), data.get("round", 1))
+    with _jobs_lock:
+        earlier_rounds = sorted(other[1] for other in _done_events if other[0] == key[0] and other[1] < key[1])
+
+    job = {
+        "task": key[0],
+        "round": key[1],
+        "idempotency_key": data.get("idempotency_key"),
+        "owner": lease_owner(),
+        "status": "queued",
+        "phase": None,
+        "phases": {},
+        "queued_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "error": None,
+        "waiting_for_rounds": earlier_rounds,
+        "waiting_for_lease": False,
+        "breakdown": {}, # seconds per span (phases, GitHub and LLM calls), see metrics.track_job
+    }
+    # Jobs are taken from the queue in order, so the earlier rounds are already running
+    # by the time this one is picked up and waiting for them cannot deadlock the workers.
+    waits = [_done_events[(key[0], round_number)] for round_number in earlier_rounds]
+    try:
+        _queue.put_nowait((job, data, waits))
+    except asyncio.QueueFull:
+        raise QueueFullError(_estimate_retry_after())
+
+    with _jobs_lock:
+        _jobs.pop(key, None)
+        _jobs[key] = job
+    _done_events[key] = asyncio.Event()
+    return _snapshot(job)
+
+def get_job(task_id: str, round_number: int) -> Optional[Dict]:
+    """Returns a copy of a job's status record, or None if it is not known to this process."""
+    with _jobs_lock:
+        job = _jobs.get((task_id, round_number))
+        return _snapshot(job) if job else None
+
+def current_job_context() -> Dict:
+    """Returns the task and round of the job running in the current context, if any."""
+    job = _current_job.get()
+    return {"task": job["task"], "round": job["round"]} if job else {}
+
+def queue_depth() -> int:
+    return _queue.qsize() if _queue else 0
+
+@asynccontextmanager
+async def phase(name: str, stage: Optional[str] = None):
+    """Marks a phase of the current job as running for the duration of the block.
+
+    If a stage is given, the block also waits for a free slot under that stage's
+    concurrency limit. Outside of a job this only applies the stage limit.
+    """
+    job = _current_job.get()
+    semaphore = _stage_semaphores.get(stage)
+    if job:
+        _set_phase(job, name, "waiting")
+    if semaphore:
+        await semaphore.acquire()
+    try:
+        if job:
+            _set_phase(job, name, "running")
+        yield
+        if job:
+            _set_phase(job, name, "done")
+    except BaseException:
+        if job:
+            _set_phase(job, name, "failed")
+        raise
+    finally:
+        if semaphore:
+            semaphore.release()
+
+async def _worker(handler: Callable[[dict], Awaitable[Optional[str]]]):
+    global _average_job_seconds
+    while True:
+        job, data, waits = await _queue.get()
+        key = (job["task"], job["round"])
+        if waits:
+            logger.info(f"Task {job['task']} round {job['round']} is waiting for rounds {job['waiting_for_rounds']} to finish.")
+            await asyncio.gather(*(event.wait() for event in waits))
+        with _jobs_lock:
+            job["waiting_for_rounds"] = []
+        if LEASES_ENABLED:
+            try:
+                acquired = await _acquire_lease(job)
+            except Exception as e:
+                # The shared store failed (e.g. "database is locked"). Fail the job rather than
+                # the worker, and record it so later rounds of the task don't wait for it.
+                error = f"Could not take the task lease: {e}"
+                logger.error(f"Task {job['task']} round {job['round']}: {error}")
+                await asyncio.to_thread(state_manager.record_round, job["task"], job["round"], "failed",
+                                        details={"error": error}, owner=WORKER_ID)
+                metrics.BUILD_JOBS.inc(status="failed")
+                _finish_unstarted(job, "failed", error)
+                continue
+            if not acquired:
+                _finish_unstarted(job, "taken_over")
+                continue
+        started = time.monotonic()
+        with _jobs_lock:
+            job["status"] = "running"
+            job["started_at"] = time.time()
+        token = _current_job.set(job)
+        breakdown_token = metrics.track_job(job["breakdown"])
+        # The build runs as its own task so that it can be stopped if the lease is lost.
+        build = asyncio.create_task(handler(data))
+        if LEASES_ENABLED:
+            _leased[job["task"]] = (build, time.monotonic())
+        try:
+            status = await build
+            final_status = status or "succeeded"
+            error = None
+        except asyncio.CancelledError:
+            if job["task"] not in _lost_leases:
+                raise
+            final_status = "failed"
+            error = "Stopped after the task lease was taken over by another worker."
+        except Exception as e:
+            final_status = "failed"
+            error = str(e)
+        finally:
+            metrics.untrack_job(breakdown_token)
+            _current_job.reset(token)
+            _queue.task_done()
+            if LEASES_ENABLED:
+                _leased.pop(job["task"], None)
+                _lost_leases.discard(job["task"])
+                await _release_lease(job["task"])
+
+        elapsed = time.monotonic() - started
+        metrics.BUILD_JOBS.inc(status=final_status)
+        metrics.BUILD_SECONDS.observe(elapsed)
+        _average_job_seconds = elapsed if _average_job_seconds is None else 0.8 * _average_job_seconds + 0.2 * elapsed
+        with _jobs_lock:
+            job["status"] = final_status
+            job["error"] = error
+            job["phase"] = None
+            job["finished_at"] = time.time()
+            _prune_finished_jobs()
+        done_event = _done_events.pop(key, None)
+        if done_event:
+            done_event.set()
+
+def _finish_unstarted(job: Dict, status: str, error: Optional[str] = None):
+    """Finishes a job that never ran, releasing the later rounds waiting for it."""
+    with _jobs_lock:
+        job["status"] = status
+        job["error"] = error
+        job["waiting_for_lease"] = False
+        job["finished_at"] = time.time()
+        _prune_finished_jobs()
+    done_event = _done_events.pop((job["task"], job["round"]), None)
+    if done_event:
+        done_event.set()
+    _queue.task_done()
+
+async def _acquire_lease(job: Dict) -> bool:
+    """Waits until this process holds the lease of the job's task. Returns False if the
+    job's round was taken over by another worker in the meantime."""
+    waited = time.monotonic()
+    while True:
+        result = await asyncio.to_thread(state_manager.acquire_task_lease, job["task"], job["round"],
+                                         WORKER_ID, LEASE_SECONDS)
+        if result != "busy":
+            break
+        if not job["waiting_for_lease"]:
+            logger.info(f"Task {job['task']} round {job['round']} is waiting for its task lease "
+                        f"(another worker is building the task or an earlier round is unfinished).")
+            with _jobs_lock:
+                job["waiting_for_lease"] = True
+        await asyncio.sleep(LEASE_POLL_SECONDS)
+    with _jobs_lock:
+        job["waiting_for_lease"] = False
+    metrics.JOB_LEASE_WAIT_SECONDS.observe(time.monotonic() - waited)
+    if result == "lost":
+        logger.warning(f"Task {job['task']} round {job['round']} was taken over by another worker; not building it here.")
+    return result == "acquired"
+
+async def _release_lease(task_id: str):
+    try:
+        await asyncio.shield(asyncio.to_thread(state_manager.release_task_lease, task_id, WORKER_ID))
+    except Exception as e:
+        logger.warning(f"Could not release the lease of task {task_id}: {e}")
+
+async def _heartbeat_loop():
+    """Keeps this process's heartbeat and task leases fresh, stops builds whose lease was
+    taken over, and takes over rounds from processes that stopped heartbeating."""
+    while True:
+        try:
+            beat_started = time.monotonic()
+            held = set(await asyncio.to_thread(state_manager.heartbeat, WORKER_ID, LEASE_SECONDS))
+            for task_id, (build, leased_at) in list(_leased.items()):
+                if task_id not in held and leased_at < beat_started and not build.done():
+                    logger.error(f"Lost the lease of task {task_id} to another worker; stopping its build.")
+                    metrics.JOB_LEASES_LOST.inc()
+                    _lost_leases.add(task_id)
+                    build.cancel()
+            await _take_over()
+        except Exception as e:
+            logger.warning(f"Task lease heartbeat failed: {e}")
+        await asyncio.sleep(LEASE_SECONDS / 3)
+
+async def _take_over():
+    """Queues the unfinished rounds of dead worker processes, as far as the queue has room."""
+    async with _submit_lock:
+        free = MAX_QUEUED_JOBS - _queue.qsize()
+        if free <= 0:
+            return
+        rounds = await asyncio.to_thread(state_manager.take_over_rounds, WORKER_ID, LEASE_SECONDS, free)
+        for entry in rounds:
+            logger.warning(f"Taking over task {entry['task_id']} round {entry['round']} "
+                           f"from worker {entry['previous_owner'] or 'unknown'}.")
+            metrics.JOB_TAKEOVERS.inc()
+            _enqueue(entry["request"])
+
+def _remote_job(record: Dict) -> Dict:
+    """A status record for a round that another worker process has queued or is building."""
+    return {
+        "task": record["task_id"],
+        "round": record["round"],
+        "idempotency_key": record["idempotency_key"],
+        "owner": record["owner"],
+        "status": record["status"],
+        "phase": None,
+        "phases": {},
+        "queued_at": record["started_at"],
+        "started_at": None,
+        "finished_at": None,
+        "error": None,
+        "waiting_for_rounds": [],
+        "waiting_for_lease": False,
+        "breakdown": {},
+    }
+
+def _set_phase(job: Dict, name: str, status: str):
+    now = time.time()
+    with _jobs_lock:
+        entry = job["phases"].setdefault(name, {"status": status, "started_at": None, "finished_at": None})
+        entry["status"] = status
+        if status == "running":
+            entry["started_at"] = now
+            job["phase"] = name
+        elif status in ("done", "failed"):
+            entry["finished_at"] = now
+        elif status == "waiting":
+            job["phase"] = name
+
+def _prune_finished_jobs():
+    finished = [key for key, job in _jobs.items() if job["finished_at"] is not None]
+    for key in finished[:max(0, len(finished) - JOB_HISTORY_SIZE)]:
+        del _jobs[key]
+
+def _estimate_retry_after() -> int:
+    """Estimates how long until a queue slot frees up, from the average job duration."""
+    if _average_job_seconds is None:
+        return 30
+    return max(1, math.ceil(_average_job_seconds * queue_depth() / max(1, WORKER_COUNT)))
+
+def _snapshot(job: Dict) -> Dict:
+    copy = dict(job)
+    copy["phases"] = {name: dict(entry) for name, entry in job["phases"].items()}
+    copy["breakdown"] = metrics.copy_breakdown(job["breakdown"])
+    return copy
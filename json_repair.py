@@ -0,0 +1,151 @@
+import json
+import re
+from typing import Dict, List, Tuple
+
+# A quote followed by this is taken as the end of a string value and the start of the next
+# key, even when the model forgot to escape quotes inside the value.
+_NEXT_FILE_KEY = re.compile(r'\s*,\s*"([A-Za-z0-9_\-./ ]*[./][A-Za-z0-9_\-./ ]*)"\s*:')
+# The output stops inside or right before the next key.
+_TRUNCATED_KEY = re.compile(r'\s*,?\s*("[^"\n]*"?\s*:?\s*)?\Z')
+_OBJECT_END = re.compile(r'\s*\}')
+_VALID_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+# A closing code fence the model may append after the JSON object.
+_TRAILING_FENCE = re.compile(r"\s*```\s*\Z")
+
+def salvage_files(text: str) -> Tuple[Dict[str, str], List[str], bool]:
+    """Recovers filename -> content pairs from a malformed or truncated LLM response.
+
+    Handles code fences, trailing prose, raw newlines and control characters inside strings,
+    unescaped quotes, invalid escape sequences and output that stops in the middle of a file.
+
+    Returns the files that were recovered completely, the names of files whose content was
+    cut off, and whether the response ended before the object was closed.
+    """
+    # Anything before the object, such as an opening code fence, is skipped.
+    start = text.find("{")
+    if start == -1:
+        return {}, [], False
+
+    try:
+        parsed, _ = json.JSONDecoder().raw_decode(text[start:])
+        if isinstance(parsed, dict):
+            return {k: v for k, v in parsed.items() if isinstance(v, str)}, [], False
+    except json.JSONDecodeError:
+        pass
+
+    # The fence is stripped once, so deciding where a value ends never re-scans the rest of
+    # the response; that would make salvaging quadratic in its size.
+    fence = _TRAILING_FENCE.search(text, start)
+    if fence:
+        text = text[:fence.start()]
+    last_key = text.rfind('":')
+
+    files = {}
+    incomplete = []
+    truncated = True
+    i = start + 1
+    n = len(text)
+    while i < n:
+        # Find the next key.
+        i = _skip_whitespace_and_commas(text, i)
+        if i >= n:
+            break
+        if text[i] == "}":
+            truncated = False
+            break
+        if text[i] != '"':
+            truncated = False # Not something we can recover from, but not a cut-off either
+            break
+        key, i, closed = _read_key(text, i + 1)
+        if not closed:
+            break
+        i = _skip_whitespace(text, i)
+        if i >= n or text[i] != ":":
+            break
+        i = _skip_whitespace(text, i + 1)
+        if i >= n:
+            incomplete.append(key)
+            break
+        if text[i] != '"':
+            # A non-string value: skip it with the strict decoder if possible.
+            try:
+                _, end = json.JSONDecoder().raw_decode(text, i)
+                i = end
+                continue
+            except json.JSONDecodeError:
+                break
+        value, i, closed = _read_value(text, i + 1, last_key)
+        if not closed:
+            incomplete.append(key)
+            break
+        files[key] = value
+    return files, incomplete, truncated
+
+def _skip_whitespace(text: str, i: int) -> int:
+    while i < len(text) and text[i] in " \t\r\n":
+        i += 1
+    return i
+
+def _skip_whitespace_and_commas(text: str, i: int) -> int:
+    while i < len(text) and text[i] in " \t\r\n,":
+        i += 1
+    return i
+
+def _read_key(text: str, i: int) -> Tuple[str, int, bool]:
+    """Reads an object key starting just after its opening quote."""
+    end = text.find('"', i)
+    if end == -1:
+        return "", len(text), False
+    try:
+        return json.loads(text[i - 1:end + 1]), end + 1, True
+    except json.JSONDecodeError:
+        return text[i:end], end + 1, True
+
+def _read_value(text: str, i: int, last_key: int) -> Tuple[str, int, bool]:
+    """Leniently reads a string value starting just after its opening quote.
+
+    Returns the value, the position after it, and whether its closing quote was found.
+    """
+    out = []
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == "\\":
+            if i + 1 >= n:
+                return "".join(out), n, False
+            nxt = text[i + 1]
+            if nxt in _VALID_ESCAPES:
+                out.append(_VALID_ESCAPES[nxt])
+                i += 2
+            elif nxt == "u" and re.fullmatch(r"[0-9a-fA-F]{4}", text[i + 2:i + 6] or ""):
+                out.append(chr(int(text[i + 2:i + 6], 16)))
+                i += 6
+            else:
+                # An invalid escape such as a regex '\d': keep the backslash as written.
+                out.append("\\")
+                i += 1
+            continue
+        if c == '"':
+            if _ends_value(text, i + 1, last_key):
+                return "".join(out), i + 1, True
+            out.append(c) # An unescaped quote inside the content
+            i += 1
+            continue
+        out.append(c)
+        i += 1
+    return "".join(out), n, False
+
+def _ends_value(text: str, i: int, last_key: int) -> bool:
+    """Decides whether a quote just before position i closes the current string value.
+
+    last_key is the position of the last '":' in text (-1 if there is none). Only anchored
+    matches are made here, so the check does not depend on the length of the rest of text.
+    """
+    if _NEXT_FILE_KEY.match(text, i):
+        return True
+    end = _OBJECT_END.match(text, i)
+    if end:
+        # Only the final '}' closes the object: nothing after it may look like another key.
+        return last_key < end.end()
+    # End of input right after the quote, or after a comma and part of the next key.
+    return bool(_TRUNCATED_KEY.match(text, i))
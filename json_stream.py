@@ -0,0 +1,227 @@
+import re
+from typing import Any, Callable, Optional
+
+# Parser states
+_VALUE = 0            # expecting any value
+_VALUE_OR_END = 1     # just after '[': a value or ']'
+_KEY_OR_END = 2       # just after '{': a key or '}'
+_KEY = 3              # after ',' in an object: a key
+_COLON = 4            # after a key
+_COMMA_OR_END = 5     # after a value inside a container
+_STRING = 6
+_ESCAPE = 7
+_UNICODE = 8
+_LITERAL = 9          # numbers, true, false, null
+_DONE = 10
+
+_WHITESPACE = " \t\r\n"
+_LITERAL_CHARS = frozenset("0123456789+-.eEtruefalsn")
+_STRING_SPECIAL = re.compile(r'["\\]')
+_SURROGATE = re.compile("[\ud800-\udfff]")
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+_LITERALS = {"true": True, "false": False, "null": None}
+_MISSING = object()
+
+class JSONStreamError(ValueError):
+    """Raised when the streamed text is not valid JSON."""
+
+class IncrementalJSONParser:
+    """A push parser that builds a JSON document from text fed to it in arbitrary chunks.
+
+    on_value(path, value) is called whenever a value is complete, where path is the tuple of
+    object keys and array indexes leading to it (the root value has the path ()).
+
+    string_sink(path) is called when a string value starts. It may return an object with
+    write(text) and close() methods; the string's characters are then passed to write() as
+    they arrive instead of being buffered, and whatever close() returns becomes the value.
+    """
+
+    def __init__(self, on_value: Optional[Callable[[tuple, Any], None]] = None,
+                 string_sink: Optional[Callable[[tuple], Any]] = None,
+                 allow_trailing: bool = False):
+        self.on_value = on_value
+        self.string_sink = string_sink
+        self.allow_trailing = allow_trailing
+        self.result = _MISSING
+        self._stack = []     # frames of [container, current key or index]
+        self._state = _VALUE
+        self._buf = []
+        self._sink = None
+        self._is_key = False
+        self._unicode = ""
+
+    @property
+    def done(self) -> bool:
+        return self._state == _DONE
+
+    @property
+    def path(self) -> tuple:
+        """The path of the value currently being parsed."""
+        return tuple(frame[1] for frame in self._stack)
+
+    def feed(self, text: str):
+        i = 0
+        n = len(text)
+        while i < n:
+            state = self._state
+            if state == _STRING:
+                # Fast path: copy everything up to the next quote or backslash in one go.
+                match = _STRING_SPECIAL.search(text, i)
+                end = match.start() if match else n
+                if end > i:
+                    self._write_string(text[i:end])
+                if not match:
+                    return
+                i = end + 1
+                if text[end] == '"':
+                    self._finish_string()
+                else:
+                    self._state = _ESCAPE
+                continue
+
+            c = text[i]
+            if state == _ESCAPE:
+                if c == "u":
+                    self._unicode = ""
+                    self._state = _UNICODE
+                elif c in _ESCAPES:
+                    self._write_string(_ESCAPES[c])
+                    self._state = _STRING
+                else:
+                    raise JSONStreamError(f"Invalid escape sequence '\\{c}'")
+                i += 1
+                continue
+            if state == _UNICODE:
+                self._unicode += c
+                i += 1
+                if len(self._unicode) == 4:
+                    try:
+                        self._write_string(chr(int(self._unicode, 16)))
+                    except ValueError:
+                        raise JSONStreamError(f"Invalid unicode escape '\\u{self._unicode}'")
+                    self._state = _STRING
+                continue
+            if state == _LITERAL:
+                if c in _LITERAL_CHARS:
+                    self._buf.append(c)
+                    i += 1
+                else:
+                    self._finish_literal() # The delimiter is handled on the next pass
+                continue
+
+            if c in _WHITESPACE:
+                i += 1
+                continue
+
+            if state == _VALUE or state == _VALUE_OR_END:
+                if state == _VALUE_OR_END and c == "]":
+                    self._close_container()
+                elif c == "{":
+                    self._stack.append([{}, None])
+                    self._state = _KEY_OR_END
+                elif c == "[":
+                    self._stack.append([[], 0])
+                    self._state = _VALUE_OR_END
+                elif c == '"':
+                    self._start_string(is_key=False)
+                elif c in "-0123456789tfn":
+                    self._buf = [c]
+                    self._state = _LITERAL
+                else:
+                    raise JSONStreamError(f"Unexpected character '{c}' where a value was expected")
+            elif state == _KEY_OR_END or state == _KEY:
+                if state == _KEY_OR_END and c == "}":
+                    self._close_container()
+                elif c == '"':
+                    self._start_string(is_key=True)
+                else:
+                    raise JSONStreamError(f"Unexpected character '{c}' where an object key was expected")
+            elif state == _COLON:
+                if c != ":":
+                    raise JSONStreamError(f"Unexpected character '{c}' where ':' was expected")
+                self._state = _VALUE
+            elif state == _COMMA_OR_END:
+                container = self._stack[-1][0]
+                if c == ",":
+                    self._state = _KEY if isinstance(container, dict) else _VALUE
+                elif c == "}" and isinstance(container, dict):
+                    self._close_container()
+                elif c == "]" and isinstance(container, list):
+                    self._close_container()
+                else:
+                    raise JSONStreamError(f"Unexpected character '{c}' after a value")
+            elif state == _DONE:
+                if self.allow_trailing:
+                    return
+                raise JSONStreamError(f"Unexpected trailing character '{c}'")
+            i += 1
+
+    def close(self) -> Any:
+        """Signals the end of input and returns the parsed document."""
+        if self._state == _LITERAL and not self._stack:
+            self._finish_literal()
+        if self._state != _DONE:
+            raise JSONStreamError("Unexpected end of JSON input")
+        return self.result
+
+    def _start_string(self, is_key: bool):
+        self._is_key = is_key
+        self._buf = []
+        self._sink = None
+        if not is_key and self.string_sink:
+            self._sink = self.string_sink(self.path)
+        self._state = _STRING
+
+    def _write_string(self, text: str):
+        if self._sink is not None:
+            self._sink.write(text)
+        else:
+            self._buf.append(text)
+
+    def _finish_string(self):
+        if self._sink is not None:
+            sink, self._sink = self._sink, None
+            value = sink.close()
+        else:
+            value = "".join(self._buf)
+            if _SURROGATE.search(value):
+                # Join escaped UTF-16 surrogate pairs into single characters.
+                value = value.encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+        self._buf = []
+        if self._is_key:
+            self._stack[-1][1] = value
+            self._state = _COLON
+        else:
+            self._complete_value(value)
+
+    def _finish_literal(self):
+        token = "".join(self._buf)
+        self._buf = []
+        if token in _LITERALS:
+            value = _LITERALS[token]
+        else:
+            try:
+                value = int(token) if token.lstrip("-").isdigit() else float(token)
+            except ValueError:
+                raise JSONStreamError(f"Invalid literal '{token}'")
+        self._complete_value(value)
+
+    def _close_container(self):
+        container, _ = self._stack.pop()
+        self._complete_value(container)
+
+    def _complete_value(self, value: Any):
+        if self.on_value:
+            self.on_value(self.path, value)
+        if not self._stack:
+            self.result = value
+            self._state = _DONE
+            return
+        frame = self._stack[-1]
+        container = frame[0]
+        if isinstance(container, dict):
+            container[frame[1]] = value
+        else:
+            container.append(value)
+            frame[1] = len(container)
+        self._state = _COMMA_OR_END
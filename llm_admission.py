@@ -0,0 +1,238 @@
+import os
+import logging
+import time
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import threading
+from typing import Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Admission control in front of Gemini: every model call takes one request and its estimated
+# tokens from per-minute token buckets before it is sent. Calls that have to wait are queued
+# by priority, revisions first and then by deadline, so a burst of new tasks cannot use up
+# the quota that time-critical revisions need. Quota errors halve the admitted rates, which
+# then recover step by step while calls succeed.
+ADMISSION_ENABLED = os.getenv("LLM_ADMISSION", "true").lower() != "false"
+REQUESTS_PER_MINUTE = float(os.getenv("LLM_RPM", "1000"))
+TOKENS_PER_MINUTE = float(os.getenv("LLM_TPM", "1000000"))
+# Output tokens assumed for a call until enough calls have been seen to use their average.
+EXPECTED_OUTPUT_TOKENS = int(os.getenv("LLM_EXPECTED_OUTPUT_TOKENS", "4000"))
+# A build's deadline, counted from when its request was received.
+DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "600"))
+# Retries of a call rejected with a quota error; each goes back through the queue.
+QUOTA_RETRIES = int(os.getenv("LLM_QUOTA_RETRIES", "3"))
+# How long admissions pause after a quota error.
+QUOTA_COOLDOWN_SECONDS = float(os.getenv("LLM_QUOTA_COOLDOWN_SECONDS", "10"))
+MIN_RATE_FACTOR = 0.1
+RATE_RECOVERY_STEP = 0.05
+
+class _Bucket:
+    """A token bucket holding up to one minute of a per-minute quota."""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, factor: float):
+        now = time.monotonic()
+        capacity = self.per_minute * factor
+        self.level = min(capacity, self.level + (now - self.updated) * capacity / 60)
+        self.updated = now
+
+    def seconds_until(self, amount: float, factor: float) -> float:
+        missing = amount - self.level
+        return 0.0 if missing <= 0 else missing * 60 / (self.per_minute * factor)
+
+class Ticket:
+    """An admitted call. Pass it to release() once the call's real token usage is known."""
+
+    def __init__(self, estimated_tokens: int, priority: tuple):
+        self.estimated_tokens = estimated_tokens
+        self.priority = priority
+        self.released = False
+
+_lock = threading.Lock()
+_requests = _Bucket(REQUESTS_PER_MINUTE)
+_tokens = _Bucket(TOKENS_PER_MINUTE)
+_rate_factor = 1.0
+_paused_until = 0.0
+_output_tokens_seen = []
+_waiters = [] # heap of (priority, sequence, event)
+_sequence = itertools.count()
+_priority: contextvars.ContextVar = contextvars.ContextVar("llm_priority", default=None)
+_stats = {"admitted": 0, "waited": 0, "quota_errors": 0, "retries": 0}
+
+def priority_for(request_data: dict) -> tuple:
+    """Returns the queue priority of a build's calls: revisions first, then the earliest deadline."""
+    received_at = request_data.get("received_at") or time.time()
+    revision = request_data.get("round", 1) > 1
+    return (0 if revision else 1, received_at + DEADLINE_SECONDS)
+
+def set_priority(priority: tuple) -> contextvars.Token:
+    """Sets the priority of the model calls made in the current context (and the tasks it starts)."""
+    return _priority.set(priority)
+
+def reset_priority(token: contextvars.Token):
+    _priority.reset(token)
+
+def is_quota_error(error: Exception) -> bool:
+    """Recognises Gemini's rate-limit and quota errors (HTTP 429, ResourceExhausted)."""
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    text = str(error).lower()
+    return "429" in text or "quota" in text or "resource has been exhausted" in text
+
+async def acquire(prompt_tokens: int) -> Ticket:
+    """Waits until the buckets admit one call with a prompt of about prompt_tokens tokens."""
+    priority = _priority.get() or (1, math.inf)
+    estimated = prompt_tokens + _expected_output_tokens()
+    ticket = Ticket(estimated, priority)
+    if not ADMISSION_ENABLED:
+        return ticket
+
+    event = asyncio.Event()
+    entry = (priority, next(_sequence), event)
+    started = time.monotonic()
+    with _lock:
+        heapq.heappush(_waiters, entry)
+        _wake_head()
+    try:
+        while True:
+            event.clear()
+            with _lock:
+                wait = _try_admit(entry, estimated) if _waiters[0] is entry else None
+                if wait == 0:
+                    heapq.heappop(_waiters)
+                    _wake_head()
+                    break
+            try:
+                await asyncio.wait_for(event.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+    except BaseException:
+        with _lock:
+            if entry in _waiters:
+                _waiters.remove(entry)
+                heapq.heapify(_waiters)
+                _wake_head()
+        raise
+
+    waited = time.monotonic() - started
+    with _lock:
+        _stats["admitted"] += 1
+        _stats["waited"] += int(waited > 0.01)
+    metrics.LLM_ADMISSION_WAIT_SECONDS.observe(waited, priority="revision" if priority[0] == 0 else "new")
+    metrics.add_to_breakdown("llm admission wait", waited)
+    return ticket
+
+def release(ticket: Ticket, used_tokens: Optional[int] = None, output_tokens: Optional[int] = None,
+            succeeded: bool = False):
+    """Settles a finished call: the difference between its real and estimated tokens is taken
+    from (or returned to) the token bucket. After a successful call the admitted rates recover
+    a step."""
+    global _rate_factor
+    if ticket.released:
+        return
+    ticket.released = True
+    with _lock:
+        if used_tokens is not None:
+            _tokens.level -= used_tokens - ticket.estimated_tokens
+        if output_tokens is not None:
+            _output_tokens_seen.append(output_tokens)
+            del _output_tokens_seen[:-50]
+        if succeeded:
+            _rate_factor = min(1.0, _rate_factor + RATE_RECOVERY_STEP)
+        _wake_head()
+
+def report_quota_error(ticket: Ticket):
+    """Backs off after a quota error: halves the admitted rates, empties the buckets and
+    pauses admissions for a while."""
+    global _rate_factor, _paused_until
+    ticket.released = True
+    with _lock:
+        _stats["quota_errors"] += 1
+        now = time.monotonic()
+        # Calls sent before the pause fail together; they count as one signal.
+        if now >= _paused_until:
+            _rate_factor = max(MIN_RATE_FACTOR, _rate_factor / 2)
+        _paused_until = now + QUOTA_COOLDOWN_SECONDS
+        _requests.level = min(_requests.level, 0.0)
+        _tokens.level = min(_tokens.level, 0.0)
+        factor = _rate_factor
+    logger.warning(f"Gemini quota error. Admitting calls at {factor:.0%} of the configured rates "
+                   f"after a {QUOTA_COOLDOWN_SECONDS:g}s pause.")
+
+async def call(send, prompt_tokens: int):
+    """Runs send() once admitted, retrying it through the queue when it hits a quota error.
+
+    send is an async function returning (result, used_tokens, output_tokens); the token
+    counts may be None when the response did not report them.
+    """
+    attempt = 0
+    while True:
+        ticket = await acquire(prompt_tokens)
+        try:
+            result, used_tokens, output_tokens = await send()
+        except Exception as e:
+            if not (ADMISSION_ENABLED and is_quota_error(e)):
+                release(ticket)
+                raise
+            report_quota_error(ticket)
+            if attempt >= QUOTA_RETRIES:
+                raise
+            attempt += 1
+            with _lock:
+                _stats["retries"] += 1
+            continue
+        except BaseException:
+            release(ticket)
+            raise
+        release(ticket, used_tokens, output_tokens, succeeded=True)
+        return result
+
+def stats() -> dict:
+    """Returns the admission counters and the current bucket levels and rates."""
+    with _lock:
+        result = dict(_stats)
+        result["queued"] = len(_waiters)
+        result["rate_factor"] = _rate_factor
+        result["requests_per_minute"] = REQUESTS_PER_MINUTE * _rate_factor
+        result["tokens_per_minute"] = TOKENS_PER_MINUTE * _rate_factor
+        result["request_bucket"] = round(_requests.level, 2)
+        result["token_bucket"] = round(_tokens.level)
+        result["expected_output_tokens"] = _expected_output_tokens()
+    return result
+
+def _expected_output_tokens() -> int:
+    if len(_output_tokens_seen) < 5:
+        return EXPECTED_OUTPUT_TOKENS
+    return int(sum(_output_tokens_seen) / len(_output_tokens_seen))
+
+def _try_admit(entry: tuple, estimated: int) -> float:
+    """Takes a call's share from the buckets if both have it. Returns 0 when admitted,
+    otherwise the seconds until they should. Called with _lock held."""
+    now = time.monotonic()
+    if now < _paused_until:
+        return _paused_until - now
+    _requests.refill(_rate_factor)
+    _tokens.refill(_rate_factor)
+    # A prompt larger than a whole minute of quota is admitted once the bucket is full.
+    needed = min(estimated, _tokens.per_minute * _rate_factor)
+    wait = max(_requests.seconds_until(1, _rate_factor), _tokens.seconds_until(needed, _rate_factor))
+    if wait > 0:
+        return wait
+    _requests.level -= 1
+    _tokens.level -= estimated
+    return 0
+
+def _wake_head():
+    """Wakes the waiter at the head of the queue so it re-checks the buckets. Called with _lock held."""
+    if _waiters:
+        _waiters[0][2].set()
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Generated files are cached by a digest of everything that goes into the prompt, so a
+# retried or redeployed request skips generation. An in-memory LRU sits in front of a
+# size-bounded directory of JSON files that survives restarts.
+CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() != "false"
+CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR", "/tmp/llm_deployer_llm_cache"))
+MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "64"))
+DISK_MAX_BYTES = int(os.getenv("LLM_CACHE_DISK_MAX_BYTES", str(256 * 1024 * 1024)))
+
+_memory: "OrderedDict[str, dict]" = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypassed": 0}
+
+def make_key(model_name: str, system_prompt: str, brief: str, checks: list,
+             attachment_hashes: list, existing_code_hash: str, is_revision: bool) -> str:
+    """Builds the cache key for one generation request."""
+    material = json.dumps({
+        "model": model_name,
+        "system_prompt": system_prompt,
+        "brief": brief,
+        "checks": checks,
+        "attachments": attachment_hashes,
+        "existing_code": existing_code_hash,
+        "revision": is_revision,
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def hash_existing_code(existing_code: Optional[dict], binary_files: Optional[list] = None) -> str:
+    """Digests the files of a revision's existing code."""
+    material = json.dumps({"files": existing_code or {}, "binary_files": binary_files or []}, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def get(key: str) -> Optional[Dict]:
+    """Returns the cached generated files for a key, or None on a miss."""
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            _stats["hits"] += 1
+            _stats["memory_hits"] += 1
+            return dict(_memory[key])
+
+    path = CACHE_DIR / f"{key}.json"
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            files = json.load(f)
+        os.utime(path) # Mark as recently used for pruning
+    except (OSError, json.JSONDecodeError):
+        with _lock:
+            _stats["misses"] += 1
+        return None
+
+    with _lock:
+        _remember(key, files)
+        _stats["hits"] += 1
+        _stats["disk_hits"] += 1
+    return dict(files)
+
+def put(key: str, files: Dict):
+    """Stores generated files under a key in both tiers."""
+    with _lock:
+        _remember(key, files)
+        _stats["stores"] += 1
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=CACHE_DIR, suffix=".tmp", delete=False) as f:
+            json.dump(files, f)
+        os.replace(f.name, CACHE_DIR / f"{key}.json")
+        _prune_disk()
+    except OSError as e:
+        logger.warning(f"Could not write LLM cache entry {key}: {e}")
+
+def record_bypass():
+    with _lock:
+        _stats["bypassed"] += 1
+
+def stats() -> Dict:
+    """Returns the hit/miss counters."""
+    with _lock:
+        return dict(_stats)
+
+def _remember(key: str, files: Dict):
+    _memory[key] = dict(files)
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+
+def _prune_disk():
+    """Deletes the least recently used entries until the cache directory fits its budget."""
+    entries = []
+    for path in CACHE_DIR.glob("*.json"):
+        stat = path.stat()
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= DISK_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
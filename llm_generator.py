@@ -1,18 +1,86 @@
 import os
+import logging
 import json
-import google.generativeai as genai
-
-# Your existing Gemini initialization code...
-try:
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        raise ValueError("GOOGLE_API_KEY not found in environment variables.")
-    genai.configure(api_key=api_key)
-    # Using a modern, capable model
-    model = genai.GenerativeModel('gemini-2.5-flash')
-except Exception as e:
-    print(f"Error initializing Gemini client: {e}")
-    model = None
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+import attachment_manager
+import context_builder
+import json_repair
+import llm_admission
+import llm_cache
+import metrics
+from json_stream import IncrementalJSONParser, JSONStreamError
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'gemini-2.5-flash'
+# Stream completions and parse them as they arrive, handing off each finished file early.
+STREAMING_ENABLED = os.getenv("LLM_STREAMING", "true").lower() != "false"
+# Follow-up calls made to fetch files missing from a malformed or truncated response.
+REPAIR_MAX_FOLLOWUPS = int(os.getenv("LLM_REPAIR_MAX_FOLLOWUPS", "1"))
+REQUIRED_FILES = ("index.html", "README.md")
+
+# Hedging against slow or invalid responses: "deadline" fires another request when the first
+# has not produced a valid result within a latency percentile, "parallel" starts several
+# candidates at once. The first valid result wins and the other candidates are cancelled.
+HEDGE_MODE = os.getenv("LLM_HEDGE_MODE", "off").lower()
+HEDGE_CANDIDATES = int(os.getenv("LLM_HEDGE_CANDIDATES", "2"))
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+# Deadline used until enough latencies have been observed to compute the percentile.
+HEDGE_DEFAULT_DEADLINE_SECONDS = float(os.getenv("LLM_HEDGE_DEADLINE_SECONDS", "90"))
+HEDGE_MIN_SAMPLES = 20
+
+_latencies = deque(maxlen=200)
+_hedge_stats = {
+    "requests": 0, "hedged_requests": 0, "candidates": 0, "hedge_wins": 0,
+    "failed_candidates": 0, "cancelled_candidates": 0,
+    "wasted_prompt_tokens": 0, "wasted_output_tokens": 0,
+}
+
+# The Gemini client is heavy to import, so it is created on first use (see get_model()).
+model = None
+_model_lock = threading.Lock()
+_client_state = {"status": "not_loaded", "init_seconds": None, "error": None}
+
+def get_model():
+    """Returns the Gemini model, importing and configuring the client on first use.
+
+    Returns None if the client could not be initialized.
+    """
+    global model
+    if model is not None or _client_state["status"] == "failed":
+        return model
+    with _model_lock:
+        if model is None and _client_state["status"] != "failed":
+            started = time.perf_counter()
+            try:
+                api_key = os.getenv("GOOGLE_API_KEY")
+                if not api_key:
+                    raise ValueError("GOOGLE_API_KEY not found in environment variables.")
+                import google.generativeai as genai
+                genai.configure(api_key=api_key)
+                # Using a modern, capable model
+                model = genai.GenerativeModel(MODEL_NAME)
+                _client_state["status"] = "loaded"
+            except Exception as e:
+                logger.warning(f"Error initializing Gemini client: {e}")
+                _client_state["status"] = "failed"
+                _client_state["error"] = str(e)
+            _client_state["init_seconds"] = round(time.perf_counter() - started, 4)
+            if model is not None:
+                logger.info(f"Gemini client initialized in {_client_state['init_seconds']}s.")
+    return model
+
+def client_state() -> dict:
+    """Returns whether the Gemini client is loaded and how long its initialization took."""
+    state = dict(_client_state)
+    if model is not None and state["status"] == "not_loaded":
+        state["status"] = "loaded" # Set directly, e.g. by the benchmark
+    return state
 
 def _create_attachment_summary_for_prompt(saved_files_meta: list) -> str:
     """Creates a text summary of attachments for the LLM prompt."""
@@ -27,8 +95,7 @@ def _create_attachment_summary_for_prompt(saved_files_meta: list) -> str:
 
         if is_text_based:
             try:
-                with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                    preview = f.read(500)
+                preview = attachment_manager.get_text_preview(meta, 500)
                 summary += f"- Filename: '{name}'. Content preview: '{preview}...'\n"
             except Exception as e:
                 summary += f"- Filename: '{name}'. (Could not read preview: {e})\n"
@@ -36,16 +103,8 @@ def _create_attachment_summary_for_prompt(saved_files_meta: list) -> str:
             summary += f"- Filename: '{name}'. (This is a binary image file. You MUST reference it in your HTML using an <img> tag, for example: <img src=\"{name}\" alt=\"Logo\">)\n"
     return summary
 
-def generate_app_code(request_data: dict, saved_attachments_meta: list) -> dict:
-    if not model:
-        raise ConnectionError("Gemini client is not initialized.")
-
-    brief = request_data.get("brief", "")
-    checks = request_data.get("checks", [])
-    round_number = request_data.get("round", 1)
-
-    # This prompt is the 'System Prompt' and sets the rules for the AI
-    full_prompt = """
+# This prompt is the 'System Prompt' and sets the rules for the AI
+SYSTEM_PROMPT = """
 You are an expert full-stack web developer. Your task is to generate or modify the complete code for a web app based on a given brief.
 You MUST return your response as a single, valid JSON object. The JSON object must have filenames as keys and the file content as string values.
 Do not include any explanations or markdown formatting outside of the JSON object itself.
@@ -66,6 +125,16 @@ Do not include any explanations or markdown formatting outside of the JSON objec
 The README.md must be professional and complete.
 ---
 """
+
+def _build_prompt(request_data: dict, saved_attachments_meta: list) -> tuple:
+    """Builds the full prompt (system prompt plus task details) for a build request.
+
+    Returns the prompt and the revision context statistics (None for a first round).
+    """
+    brief = request_data.get("brief", "")
+    checks = request_data.get("checks", [])
+    round_number = request_data.get("round", 1)
+
     # First, format the checks string outside of the main f-string.
     checks_text = "\n- ".join(checks) if checks else "None specified"
     
@@ -82,69 +151,440 @@ The README.md must be professional and complete.
     {_create_attachment_summary_for_prompt(saved_attachments_meta)}
     """
 
+    context_stats = None
     # Add revision-specific instructions
     if round_number > 1:
         existing_code = request_data.get("existing_code")
         if existing_code and isinstance(existing_code, dict):
-            code_to_show = {k: v for k, v in existing_code.items() if not k.startswith('.github')}
-            # --- START: NEW, IMPROVED CODE ---
+            # Pack the most relevant files into the token budget; large or unrelated files are summarized.
+            existing_context, context_stats = context_builder.build_revision_context(existing_code, brief, checks)
             user_prompt += "\n"
             user_prompt += "**This is a revision request. Please modify the following existing code based on the new brief.**\n"
             user_prompt += "**Crucially, you MUST also update the README.md to describe the new features and changes.**\n"
-            user_prompt += "**Your response must include ALL necessary files for the project, including any unchanged files.**\n\n"
+            user_prompt += "**Your response must include index.html, README.md and every file you create or change, each in full.**\n"
+            user_prompt += "**Files you leave out of your response are kept as they are. Never return a file that is shown SUMMARIZED unless you rewrite it completely.**\n\n"
             user_prompt += "### EXISTING CODE TO REVISE ###\n"
-
-            # Instead of json.dumps, loop through the files and present them cleanly.
-            for filename, content in code_to_show.items():
-                user_prompt += f"--- START FILE: {filename} ---\n"
-                user_prompt += f"{content}\n"
-                user_prompt += f"--- END FILE: {filename} ---\n\n"
-            # --- END: NEW, IMPROVED CODE ---
+            user_prompt += existing_context
+            binary_files = [f for f in request_data.get("existing_binary_files", []) if not context_builder.is_excluded(f)]
+            if binary_files:
+                user_prompt += "The repository also contains these binary files, which are kept as-is unless the brief says otherwise:\n"
+                user_prompt += "".join(f"- {filename}\n" for filename in binary_files)
             user_prompt += "\n"
     
-    full_prompt += user_prompt
+    return SYSTEM_PROMPT + user_prompt, context_stats
 
-    print("--- Sending Prompt to Gemini ---")
-    print(full_prompt)
-    print("--------------------------------")
+def _parse_generated_files(response_content: str) -> dict:
+    """Extracts and validates the filename -> content JSON object from an LLM response."""
+    # --- NEW: More robust JSON cleaning and parsing ---
+    # Find the start of the JSON object '{'
+    json_start_index = response_content.find('{')
+    if json_start_index != -1:
+        json_str = response_content[json_start_index:]
+        # Use raw_decode which can handle trailing characters or truncated responses
+        try:
+            decoder = json.JSONDecoder()
+            generated_files, _ = decoder.raw_decode(json_str)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to decode JSON. Error: {e}")
+            logger.debug(f"--- Problematic String ---:\n{json_str}\n--------------------")
+            raise ValueError("LLM response could not be parsed as JSON.") from e
+    else:
+        # If no JSON object is found at all, raise an error
+        logger.debug(f"--- Invalid Response ---:\n{response_content}\n--------------------")
+        raise ValueError("LLM response did not contain a valid JSON object.")
 
-    try:
-        generation_config = genai.types.GenerationConfig(
-            response_mime_type="application/json"
-        )
-        
-        # --- START: MODIFIED CODE ---
-        completion = model.generate_content(
+    return _validate_generated_files(generated_files)
+
+def _validate_generated_files(generated_files) -> dict:
+    if not isinstance(generated_files, dict) or any(name not in generated_files for name in REQUIRED_FILES):
+         raise ValueError("LLM response is invalid. It must be a JSON object containing at least 'index.html' and 'README.md'.")
+
+    return generated_files
+
+class _StreamingFileParser:
+    """Parses a streamed LLM response incrementally and reports each file as soon as its
+    content string is complete."""
+
+    def __init__(self, on_file: Optional[Callable[[str, str], None]]):
+        self.on_file = on_file
+        self.failed = False
+        self._started = False
+        self._parser = IncrementalJSONParser(on_value=self._on_value, allow_trailing=True)
+
+    def feed(self, text: str):
+        if self.failed:
+            return
+        if not self._started:
+            # Skip anything before the JSON object, such as a code fence.
+            start = text.find('{')
+            if start == -1:
+                return
+            text = text[start:]
+            self._started = True
+        try:
+            self._parser.feed(text)
+        except JSONStreamError as e:
+            logger.warning(f"Streaming JSON parse failed ({e}). Falling back to parsing the full response.")
+            self.failed = True
+
+    @property
+    def result(self) -> Optional[dict]:
+        if self.failed or not self._parser.done:
+            return None
+        return self._parser.result
+
+    def _on_value(self, path: tuple, value):
+        if len(path) == 1 and isinstance(value, str) and self.on_file:
+            try:
+                self.on_file(path[0], value)
+            except Exception as e:
+                logger.warning(f"Early hand-off of '{path[0]}' failed: {e}")
+
+async def _generate_streaming(full_prompt: str, generation_config, on_file: Optional[Callable[[str, str], None]],
+                              usage: Optional[dict] = None) -> tuple:
+    """Streams a completion, handing each file to on_file as soon as it has been generated.
+
+    If a usage dict is given, its 'output_tokens_estimated' is kept up to date as text arrives.
+    Returns the parsed JSON object (None if the response did not parse), the full response
+    text and the response's usage metadata.
+    """
+    async def send():
+        response = await get_model().generate_content_async(
             full_prompt,
+            generation_config=generation_config,
+            stream=True
+        )
+        parser = _StreamingFileParser(on_file)
+        chunks = []
+        received = 0
+        async for chunk in response:
+            text = chunk.text
+            chunks.append(text)
+            parser.feed(text)
+            received += len(text)
+            if usage is not None:
+                usage["output_tokens_estimated"] = (received + 3) // 4 # About four characters per token
+
+        usage_metadata = getattr(response, "usage_metadata", None)
+        return (parser.result, "".join(chunks), usage_metadata), *_token_counts(usage_metadata)
+
+    return await llm_admission.call(send, context_builder.estimate_tokens(full_prompt))
+
+async def _generate_completion(prompt: str, generation_config):
+    """Makes one non-streaming request through the admission controller and returns the completion."""
+    async def send():
+        completion = await get_model().generate_content_async(
+            prompt,
             generation_config=generation_config
         )
+        return completion, *_token_counts(getattr(completion, "usage_metadata", None))
 
-        response_content = completion.text
+    return await llm_admission.call(send, context_builder.estimate_tokens(prompt))
 
-        # --- NEW: More robust JSON cleaning and parsing ---
-        # Find the start of the JSON object '{'
-        json_start_index = response_content.find('{')
-        if json_start_index != -1:
-            json_str = response_content[json_start_index:]
-            # Use raw_decode which can handle trailing characters or truncated responses
-            try:
-                decoder = json.JSONDecoder()
-                generated_files, _ = decoder.raw_decode(json_str)
-            except json.JSONDecodeError as e:
-                print(f"ERROR: Failed to decode JSON. Error: {e}")
-                print(f"--- Problematic String ---:\n{json_str}\n--------------------")
-                raise ValueError("LLM response could not be parsed as JSON.") from e
+def _token_counts(usage_metadata) -> tuple:
+    """Returns the total and output token counts reported for a response, if any."""
+    if usage_metadata is None:
+        return None, None
+    return (usage_metadata.prompt_token_count + usage_metadata.candidates_token_count,
+            usage_metadata.candidates_token_count)
+
+# The follow-up for a broken response only needs the output format rules.
+FOLLOWUP_SYSTEM_PROMPT = """
+You are an expert full-stack web developer completing a web app whose files you have partly generated already.
+You MUST return your response as a single, valid JSON object. The JSON object must have filenames as keys and the file content as string values.
+All string values MUST be properly escaped JSON: newlines as `\\n`, double quotes as `\\"` and backslashes as `\\\\`.
+Do not include any explanations or markdown formatting outside of the JSON object itself.
+"""
+
+def _build_followup_prompt(request_data: dict, received: list, missing: list) -> str:
+    """Builds a small prompt asking only for the files a broken response did not deliver.
+
+    Unlike the full prompt it leaves out the attachment previews and the existing code,
+    except for the current version of each missing file in a revision.
+    """
+    checks = request_data.get("checks", [])
+    checks_text = "\n- ".join(checks) if checks else "None specified"
+    followup = FOLLOWUP_SYSTEM_PROMPT
+    followup += f"\n**Project Brief:**\n{request_data.get('brief', '')}\n"
+    followup += f"\n**Evaluation Checks (Your code must satisfy these):**\n- {checks_text}\n"
+    followup += "\n**Your previous response was cut off or was not valid JSON.**\n"
+    if received:
+        followup += "These files were received completely and MUST NOT be returned again: " + ", ".join(received) + "\n"
+    if missing:
+        followup += "Return ONLY these files: " + ", ".join(missing) + ", plus any other file the app needs that is not in the list above.\n"
+    else:
+        followup += "Return ONLY the files the app needs that are not in the list above.\n"
+    followup += "Respond with a single JSON object mapping filenames to their full content.\n"
+    existing_code = request_data.get("existing_code")
+    if isinstance(existing_code, dict):
+        for name in missing:
+            if isinstance(existing_code.get(name), str):
+                followup += f"\n### EXISTING {name} TO REVISE ###\n{existing_code[name]}\n"
+    return followup
+
+def _missing_files(files: dict, incomplete: list) -> list:
+    missing = [name for name in REQUIRED_FILES if name not in files]
+    return missing + [name for name in incomplete if name not in files and name not in missing]
+
+async def _repair_response(response_text: str, request_data: dict, generation_config, usage: dict) -> dict:
+    """Recovers the files of a malformed response and re-requests only the ones that are missing."""
+    files, incomplete, truncated = await asyncio.to_thread(json_repair.salvage_files, response_text)
+    missing = _missing_files(files, incomplete)
+    usage["salvaged_files"] = len(files)
+    logger.info(f"Salvaged {len(files)} file(s) from the malformed response (truncated: {truncated}). Missing or cut off: {missing or 'none'}")
+
+    followups = 0
+    # A truncated response may have been about to write files we cannot name, so ask for the rest.
+    while (missing or truncated) and followups < REPAIR_MAX_FOLLOWUPS:
+        followups += 1
+        metrics.LLM_REPAIR_CALLS.inc()
+        completion = await _generate_completion(
+            _build_followup_prompt(request_data, sorted(files), missing), generation_config
+        )
+        more_files, incomplete, truncated = await asyncio.to_thread(json_repair.salvage_files, completion.text)
+        # Files recovered completely in the first response are kept as they were.
+        for name, content in more_files.items():
+            files.setdefault(name, content)
+        missing = _missing_files(files, incomplete)
+        usage_metadata = getattr(completion, "usage_metadata", None)
+        if usage_metadata is not None:
+            usage["repair_output_tokens"] = usage.get("repair_output_tokens", 0) + usage_metadata.candidates_token_count
+            metrics.LLM_TOKENS.inc(usage_metadata.prompt_token_count, kind="prompt")
+            metrics.LLM_TOKENS.inc(usage_metadata.candidates_token_count, kind="output")
+    usage["repair_calls"] = followups
+
+    if missing:
+        logger.warning(f"Files still missing after repair: {missing}")
+    return _validate_generated_files(files)
+
+async def _generate_candidate(full_prompt: str, request_data: dict, generation_config,
+                              on_file: Optional[Callable[[str, str], None]], usage: dict) -> dict:
+    """Makes one generation request and returns its validated files, repairing a broken response."""
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        generated_files = await _request_candidate(full_prompt, request_data, generation_config, on_file, usage)
+        outcome = "repaired" if usage.get("repair_calls") or usage.get("salvaged_files") else "ok"
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        metrics.LLM_REQUEST_SECONDS.observe(elapsed, outcome=outcome)
+        metrics.add_to_breakdown(f"llm request {outcome}", elapsed)
+    _latencies.append(elapsed)
+    return generated_files
+
+async def _request_candidate(full_prompt: str, request_data: dict, generation_config,
+                             on_file: Optional[Callable[[str, str], None]], usage: dict) -> dict:
+    usage.setdefault("prompt_tokens_estimated", context_builder.estimate_tokens(full_prompt))
+    if STREAMING_ENABLED:
+        parsed, response_text, usage_metadata = await _generate_streaming(full_prompt, generation_config, on_file, usage)
+    else:
+        completion = await _generate_completion(full_prompt, generation_config)
+        parsed, response_text = None, completion.text
+        usage_metadata = getattr(completion, "usage_metadata", None)
+
+    if usage_metadata is not None:
+        usage["prompt_tokens"] = usage_metadata.prompt_token_count
+        usage["output_tokens"] = usage_metadata.candidates_token_count
+        metrics.LLM_TOKENS.inc(usage_metadata.prompt_token_count, kind="prompt")
+        metrics.LLM_TOKENS.inc(usage_metadata.candidates_token_count, kind="output")
+    else:
+        usage["prompt_tokens"] = usage["prompt_tokens_estimated"]
+
+    try:
+        if parsed is not None:
+            generated_files = _validate_generated_files(parsed)
         else:
-            # If no JSON object is found at all, raise an error
-            print(f"--- Invalid Response ---:\n{response_content}\n--------------------")
-            raise ValueError("LLM response did not contain a valid JSON object.")
-        # --- END: MODIFIED CODE ---
+            generated_files = _parse_generated_files(response_text)
+    except ValueError as e:
+        # Truncated output, stray quotes or newlines: keep every complete file and ask
+        # for the rest in a small follow-up call instead of failing the whole round.
+        logger.warning(f"{e} Attempting to repair the response.")
+        generated_files = await _repair_response(response_text, request_data, generation_config, usage)
+    return generated_files
+
+def _hedge_deadline() -> float:
+    """Returns how long to wait for a candidate before firing a hedge request."""
+    if len(_latencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DEADLINE_SECONDS
+    ordered = sorted(_latencies)
+    return ordered[min(len(ordered) - 1, int(HEDGE_PERCENTILE * len(ordered)))]
+
+def _wasted_tokens(candidate_usage: dict) -> tuple:
+    output_tokens = candidate_usage.get("output_tokens", candidate_usage.get("output_tokens_estimated", 0))
+    return candidate_usage.get("prompt_tokens", candidate_usage.get("prompt_tokens_estimated", 0)), output_tokens
+
+async def _generate_hedged(full_prompt: str, request_data: dict, generation_config,
+                           on_file: Optional[Callable[[str, str], None]], usage: dict) -> dict:
+    """Runs up to HEDGE_CANDIDATES generation requests and returns the first valid result.
+
+    In deadline mode a new candidate is started whenever the running ones miss the hedge
+    deadline or all of them have failed; in parallel mode all candidates start at once.
+    Files are only handed to on_file while a single candidate is running, since the files of
+    a candidate that loses would otherwise be uploaded for nothing.
+    """
+    parallel = HEDGE_MODE == "parallel"
+    handoff_open = not parallel
+
+    def handoff(filename: str, content: str):
+        if handoff_open:
+            on_file(filename, content)
+
+    candidates = {} # task -> the candidate's own usage dict
+    def launch():
+        candidate_usage = {"prompt_tokens_estimated": usage["prompt_tokens_estimated"]}
+        task = asyncio.create_task(_generate_candidate(
+            full_prompt, request_data, generation_config, handoff if on_file else None, candidate_usage
+        ))
+        candidates[task] = candidate_usage
+
+    for _ in range(HEDGE_CANDIDATES if parallel else 1):
+        launch()
+    deadline = _hedge_deadline()
+    pending = set(candidates)
+    winner = None
+    generated_files = None
+    last_error = None
+    failed = 0
+    try:
+        while pending and winner is None:
+            can_hedge = not parallel and len(candidates) < HEDGE_CANDIDATES
+            done, pending = await asyncio.wait(
+                pending, timeout=deadline if can_hedge else None, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                logger.info(f"No valid LLM response after {deadline:.1f}s. Firing a hedge request.")
+                handoff_open = False
+                launch()
+                pending = {task for task in candidates if not task.done()}
+                continue
+            for task in done:
+                try:
+                    generated_files = task.result()
+                    winner = task
+                    break
+                except Exception as e:
+                    logger.warning(f"LLM candidate failed: {e}")
+                    last_error = e
+                    failed += 1
+            if winner is None and not pending and can_hedge:
+                # Replace a failed candidate straight away instead of waiting out the deadline.
+                handoff_open = False
+                launch()
+                pending = {task for task in candidates if not task.done()}
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    wasted_prompt = wasted_output = 0
+    for task, candidate_usage in candidates.items():
+        if task is not winner:
+            prompt_tokens, output_tokens = _wasted_tokens(candidate_usage)
+            wasted_prompt += prompt_tokens
+            wasted_output += output_tokens
+    hedged = len(candidates) > 1
+    _hedge_stats["requests"] += 1
+    _hedge_stats["hedged_requests"] += int(hedged)
+    _hedge_stats["candidates"] += len(candidates)
+    _hedge_stats["hedge_wins"] += int(winner is not None and winner is not next(iter(candidates)))
+    _hedge_stats["failed_candidates"] += failed
+    _hedge_stats["cancelled_candidates"] += len(pending)
+    _hedge_stats["wasted_prompt_tokens"] += wasted_prompt
+    _hedge_stats["wasted_output_tokens"] += wasted_output
+
+    if winner is None:
+        raise last_error or RuntimeError("No LLM candidate produced a result.")
+    usage.update(candidates[winner])
+    usage["candidates"] = len(candidates)
+    usage["wasted_tokens"] = wasted_prompt + wasted_output
+    return generated_files
+
+def hedge_stats() -> dict:
+    """Returns the hedging counters, including the share of requests that needed a hedge."""
+    stats = dict(_hedge_stats)
+    stats["hedge_rate"] = stats["hedged_requests"] / stats["requests"] if stats["requests"] else 0.0
+    stats["deadline_seconds"] = _hedge_deadline()
+    return stats
+
+def _cache_key(request_data: dict, saved_attachments_meta: list) -> str:
+    """Digests everything the prompt is built from into an LLM cache key."""
+    attachment_hashes = sorted([meta["name"], meta.get("sha256")] for meta in saved_attachments_meta)
+    existing_code_hash = llm_cache.hash_existing_code(
+        request_data.get("existing_code"), request_data.get("existing_binary_files")
+    )
+    return llm_cache.make_key(
+        MODEL_NAME,
+        SYSTEM_PROMPT,
+        request_data.get("brief", ""),
+        request_data.get("checks", []),
+        attachment_hashes,
+        existing_code_hash,
+        request_data.get("round", 1) > 1,
+    )
+
+async def generate_app_code_async(request_data: dict, saved_attachments_meta: list, bypass_cache: bool = False,
+                                  usage: Optional[dict] = None,
+                                  on_file: Optional[Callable[[str, str], None]] = None) -> dict:
+    """Generates the app's files with Gemini, serving repeated requests from the LLM cache.
+
+    Pass bypass_cache=True to always call the model; the fresh result still refreshes the cache.
+    If a usage dict is given, it is filled with the prompt token count and context statistics.
+    In streaming mode, on_file(filename, content) is called for each file as soon as it has been
+    generated, so later phases can start on it while the model is still writing other files.
+    """
+    if usage is None:
+        usage = {}
+    use_cache = llm_cache.CACHE_ENABLED
+    cache_key = None
+    if use_cache:
+        cache_key = await asyncio.to_thread(_cache_key, request_data, saved_attachments_meta)
+        if bypass_cache:
+            llm_cache.record_bypass()
+        else:
+            cached_files = await asyncio.to_thread(llm_cache.get, cache_key)
+            if cached_files:
+                logger.info(f"LLM cache hit ({cache_key[:12]}). Skipping generation.")
+                usage["cache_hit"] = True
+                return cached_files
+
+    if not await asyncio.to_thread(get_model):
+        raise ConnectionError("Gemini client is not initialized.")
+
+    full_prompt, context_stats = await asyncio.to_thread(_build_prompt, request_data, saved_attachments_meta)
+    usage["prompt_tokens_estimated"] = context_builder.estimate_tokens(full_prompt)
+    if context_stats:
+        usage["context"] = {key: len(value) if isinstance(value, list) else value for key, value in context_stats.items()}
+
+    # The prompt can be very large on revisions, so it is only logged in full at DEBUG level.
+    logger.info(f"Sending prompt to Gemini ({len(full_prompt)} characters).")
+    logger.debug("Full prompt:\n%s", full_prompt)
+
+    # Calls for revisions and builds close to their deadline are admitted first under load.
+    priority_token = llm_admission.set_priority(llm_admission.priority_for(request_data))
+    try:
+        # A plain dict is accepted as a GenerationConfig.
+        generation_config = {"response_mime_type": "application/json"}
         
-        if not isinstance(generated_files, dict) or "index.html" not in generated_files or "README.md" not in generated_files:
-             raise ValueError("LLM response is invalid. It must be a JSON object containing at least 'index.html' and 'README.md'.")
+        if HEDGE_MODE in ("deadline", "parallel") and HEDGE_CANDIDATES > 1:
+            generated_files = await _generate_hedged(full_prompt, request_data, generation_config, on_file, usage)
+        else:
+            generated_files = await _generate_candidate(full_prompt, request_data, generation_config, on_file, usage)
+        logger.info(f"Prompt tokens: {usage['prompt_tokens']}")
 
+        if cache_key:
+            await asyncio.to_thread(llm_cache.put, cache_key, generated_files)
         return generated_files
 
     except Exception as e:
-        print(f"ERROR: An unexpected error occurred with the Gemini API: {e}")
+        logger.error(f"An unexpected error occurred with the Gemini API: {e}")
         return {"error.txt": f"An API error occurred: {e}"}
+    finally:
+        llm_admission.reset_priority(priority_token)
+
+def generate_app_code(request_data: dict, saved_attachments_meta: list, bypass_cache: bool = False,
+                      usage: Optional[dict] = None) -> dict:
+    """Synchronous wrapper around generate_app_code_async."""
+    return asyncio.run(generate_app_code_async(request_data, saved_attachments_meta, bypass_cache, usage))
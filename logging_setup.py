@@ -0,0 +1,54 @@
+import json
+import logging
+from typing import Callable, Optional
+
+class _JSONFormatter(logging.Formatter):
+    """Formats each record as one JSON object per line."""
+
+    def __init__(self, context: Optional[Callable[[], dict]] = None):
+        super().__init__()
+        self.context = context
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if self.context:
+            entry.update(self.context() or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class _ContextFilter(logging.Filter):
+    """Prefixes messages with the context (e.g. the current task and round) when there is one."""
+
+    def __init__(self, context: Callable[[], dict]):
+        super().__init__()
+        self.context = context
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        values = self.context() or {}
+        record.context = "".join(f"[{key}={value}] " for key, value in values.items())
+        return True
+
+def configure_logging(level: str = "INFO", json_format: bool = False,
+                      context: Optional[Callable[[], dict]] = None):
+    """Sends the service's log records to stderr at the given level, as text or JSON lines.
+
+    context, if given, returns extra fields attached to every record.
+    """
+    handler = logging.StreamHandler()
+    if json_format:
+        handler.setFormatter(_JSONFormatter(context))
+    else:
+        handler.addFilter(_ContextFilter(context or dict))
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(context)s%(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    # httpx logs every request at INFO; that is only useful when debugging.
+    if logging.getLevelName(level) != logging.DEBUG:
+        logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -1,79 +1,205 @@
 # In main.py
 # This is a test comment to create a new commit.
+import time
+_import_started = time.perf_counter()
 import os
-import json
-from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
+import logging
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
 from dotenv import load_dotenv
 
 # Load environment variables FIRST
 load_dotenv()
 
+import logging_setup
+
+# DEBUG also logs full prompts and notification payloads. LOG_FORMAT=json writes one JSON
+# object per line, tagged with the task and round being processed.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# "prewarm" (default) starts serving at once and creates the Gemini and GitHub clients in
+# the background, "lazy" creates them on first use, "eager" before the server starts.
+BOOT_MODE = os.getenv("BOOT_MODE", "prewarm").lower()
+
 # Import your modules
 import llm_generator
 import github_manager
+import github_client
 import notifier
 import state_manager 
 import attachment_manager
+import job_queue
+import llm_admission
+import llm_cache
+import metrics
+from pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+logging_setup.configure_logging(LOG_LEVEL, json_format=LOG_FORMAT == "json", context=job_queue.current_job_context)
+
+metrics.register_collector("llm_hedge", llm_generator.hedge_stats)
+metrics.register_collector("llm_cache", llm_cache.stats)
+metrics.register_collector("llm_admission", llm_admission.stats)
+metrics.register_collector("github_client", github_client.stats)
+metrics.register_collector("job_queue", lambda: {"queued_jobs": job_queue.queue_depth()})
+
+# Startup timings, reported by /ready and at /metrics so cold-start regressions are visible.
+_boot = {"import_seconds": None, "startup_seconds": None, "warmup_seconds": None,
+         "first_build_request_seconds": None, "first_build_request_after_start_seconds": None}
+_boot_state = {"started_at": None, "warmup": None, "first_build_request": False}
+metrics.register_collector("boot", lambda: {
+    **{key: value for key, value in _boot.items() if value is not None},
+    "llm_client_init_seconds": llm_generator.client_state()["init_seconds"] or 0,
+})
 
-app = FastAPI()
+async def _warm_up():
+    """Creates the clients a first build needs, so it does not pay for their setup."""
+    started = time.perf_counter()
+    await asyncio.to_thread(llm_generator.get_model)
+    if os.getenv("GITHUB_PAT"):
+        try:
+            await github_client.get_login()
+        except Exception as e:
+            logger.warning(f"GitHub warm-up failed: {e}")
+    _boot["warmup_seconds"] = round(time.perf_counter() - started, 4)
+    logger.info(f"Warm-up finished in {_boot['warmup_seconds']}s.")
 
-def process_build_request(data: dict):
-    """The core logic for the entire build and deploy process."""
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    if BOOT_MODE == "eager":
+        await _warm_up()
+    await job_queue.start(process_build_request_async)
+    if notifier.OUTBOX_ENABLED:
+        await notifier.start()
+    if BOOT_MODE == "prewarm":
+        # Runs once the server is accepting connections; /ready reports when it is done.
+        _boot_state["warmup"] = asyncio.create_task(_warm_up())
+    _boot["startup_seconds"] = round(time.perf_counter() - started, 4)
+    _boot_state["started_at"] = time.perf_counter()
+    logger.info(f"Service started in {_boot['startup_seconds']}s (imports took {_boot['import_seconds']}s, boot mode {BOOT_MODE}).")
+    yield
+    warmup = _boot_state["warmup"]
+    if warmup and not warmup.done():
+        warmup.cancel()
+        await asyncio.gather(warmup, return_exceptions=True)
+    await job_queue.stop()
+    if notifier.OUTBOX_ENABLED:
+        await notifier.stop()
+    await github_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+async def process_build_request_async(data: dict) -> str:
+    """The core logic for the entire build and deploy process. Returns the final status.
+
+    The phases run as a dependency graph, so independent ones overlap: attachments are
+    decoded while a revision's code is fetched, and a first round's repository is created
+    and Pages enabled while the code is still being generated.
+    """
     task_id = data.get("task")
     round_number = data.get("round", 1)
-    print("--------------------------------------------------")
-    print(f"BACKGROUND: Starting processing for task: {task_id}, round: {round_number}")
+    logger.info(f"BACKGROUND: Starting processing for task: {task_id}, round: {round_number}")
     saved_attachments_meta = [] # Keep track of saved files for cleanup
+    timings = {} # Seconds spent in each phase, recorded in the round history
+    status = "failed"
+    commit_sha = None
+    round_details = None
+    llm_usage = {}
+    await asyncio.to_thread(state_manager.record_round, task_id, round_number, "running",
+                            idempotency_key=data.get("idempotency_key"), owner=job_queue.lease_owner())
 
-    try:
-        if round_number > 1:
-            print("PHASE 0: Retrieving state for revision...")
-            task_state = state_manager.get_task_state(task_id)
-            if not task_state or "repo_name" not in task_state:
-                print(f"ERROR: No previous state found for task {task_id}. Cannot perform revision.")
-                return 
-
-            repo_name = task_state["repo_name"]
-            print(f"PHASE 0: Fetching existing code from '{repo_name}'...")
-            existing_code = github_manager.get_repo_contents(repo_name)
-            if not existing_code:
-                print(f"Warning: Could not fetch code from repo '{repo_name}'.")
-            
-                print(f"ERROR: Could not fetch code from repo '{repo_name}'. Cannot perform revision.")
-                return
-
-            data["existing_code"] = existing_code
-            data["repo_name"] = repo_name 
+    pipeline = Pipeline(timings)
 
+    async def load_state():
+        logger.info("PHASE 0: Retrieving state for revision...")
+        task_state = await asyncio.to_thread(state_manager.get_task_state, task_id)
+        if not task_state or "repo_name" not in task_state:
+            raise RuntimeError(f"No previous state found for task {task_id}. Cannot perform revision.")
+        data["repo_name"] = task_state["repo_name"]
+
+    async def fetch_code():
+        repo_name = data["repo_name"]
+        logger.info(f"PHASE 0: Fetching existing code from '{repo_name}'...")
+        snapshot = await github_manager.get_repo_snapshot_async(repo_name)
+        existing_code = snapshot["files"]
+        if snapshot["binary_files"]:
+            logger.info(f"PHASE 0: Binary or non-UTF-8 files not shown to the LLM: {snapshot['binary_files']}")
+        if not existing_code:
+            raise RuntimeError(f"Could not fetch code from repo '{repo_name}'. Cannot perform revision.")
+
+        data["existing_code"] = existing_code
+        data["existing_binary_files"] = snapshot["binary_files"]
+        data["base_snapshot"] = {"commit_sha": snapshot["commit_sha"], "blob_shas": snapshot["blob_shas"]}
+
+    async def save_attachments():
+        nonlocal saved_attachments_meta
         # --- NEW: Handle attachments first ---
-        print("PHASE 0.5: Processing attachments...")
-        attachments = data.get("attachments", [])
-        saved_attachments_meta = attachment_manager.save_attachments_to_disk(attachments)
-        print(f"PHASE 0.5: Saved {len(saved_attachments_meta)} attachments to disk.")
+        logger.info("PHASE 0.5: Processing attachments...")
+        # Attachments streamed to disk during ingestion are already decoded and stored.
+        saved_attachments_meta = list(data.get("spooled_attachments") or [])
+        spooled_names = {meta["name"] for meta in saved_attachments_meta}
+        attachments = [att for att in data.get("attachments", []) if att.get("name") not in spooled_names]
+        saved_attachments_meta += await attachment_manager.save_attachments_to_disk_async(attachments, task_id, round_number)
+        await asyncio.to_thread(attachment_manager.write_manifest, task_id, round_number, saved_attachments_meta)
+        logger.info(f"PHASE 0.5: Saved {len(saved_attachments_meta)} attachments to disk.")
+
+    async def provision_repo():
+        logger.info("PHASE 2a: Provisioning GitHub repository...")
+        return await github_manager.provision_repo_async(data)
 
-        print("PHASE 1: Generating code with LLM...")
-        generated_files = llm_generator.generate_app_code(data, saved_attachments_meta)
+    async def generate_code():
+        logger.info("PHASE 1: Generating code with LLM...")
+        # Changed files are uploaded as blobs while the model is still generating the rest,
+        # once the repository is ready.
+        blob_uploader = None
+        if llm_generator.STREAMING_ENABLED:
+            blob_uploader = github_manager.BlobUploader(
+                github_manager.get_repo_name(data), data.get("base_snapshot"),
+                skip_paths=[meta["name"] for meta in saved_attachments_meta],
+                ready=pipeline.task("provision")
+            )
+        try:
+            generated_files = await llm_generator.generate_app_code_async(
+                data, saved_attachments_meta, usage=llm_usage,
+                on_file=blob_uploader.submit if blob_uploader else None
+            )
+        finally:
+            uploaded_blobs = await blob_uploader.finish() if blob_uploader else None
         if "error.txt" in generated_files:
-            print("ERROR: LLM generation failed. Stopping process.")
-            return
-        
-        print(f"PHASE 1: Code generation complete. Files: {list(generated_files.keys())}")
-
-        print("PHASE 2: Managing GitHub repository...")
-        repo_details = github_manager.create_or_update_repo(
-            request_data=data, 
-            generated_files=generated_files, 
-            attachment_meta=saved_attachments_meta
+            raise RuntimeError("LLM generation failed. Stopping process.")
+        logger.info(f"PHASE 1: Code generation complete. Files: {list(generated_files.keys())}")
+        return generated_files, uploaded_blobs
+
+    async def publish_code():
+        nonlocal commit_sha, round_details
+        generated_files, uploaded_blobs = await pipeline.result("llm")
+        logger.info("PHASE 2: Managing GitHub repository...")
+        repo_details = await github_manager.publish_to_repo_async(
+            data, await pipeline.result("provision"), generated_files, saved_attachments_meta,
+            uploaded_blobs=uploaded_blobs
         )
-        print(f"PHASE 2: GitHub management complete. URL: {repo_details.get('repo_url')}")
-        
+        commit_sha = repo_details.get("commit_sha")
+        round_details = {key: repo_details.get(key) for key in ("repo_name", "repo_url", "pages_url", "changes")}
+        round_details["llm_usage"] = llm_usage
+        logger.info(f"PHASE 2: GitHub management complete. URL: {repo_details.get('repo_url')}")
+        if repo_details.get("changes"):
+            logger.info(f"PHASE 2: Files added: {repo_details['changes']['added']}, "
+                        f"modified: {repo_details['changes']['modified']}, "
+                        f"unchanged: {repo_details['changes']['unchanged']}")
+
         if round_number == 1:
-            state_manager.save_task_state(task_id, {
+            await asyncio.to_thread(state_manager.save_task_state, task_id, {
                 "repo_name": repo_details.get("repo_name"),
                 "repo_url": repo_details.get("repo_url")
             })
+        return repo_details
 
-        print("PHASE 3: Notifying evaluation server...")
+    async def notify():
+        repo_details = await pipeline.result("github")
+        logger.info("PHASE 3: Notifying evaluation server...")
         notification_payload = {
             "email": data.get("email"),
             "task": data.get("task"),
@@ -84,33 +210,178 @@ def process_build_request(data: dict):
             "pages_url": repo_details.get("pages_url"),
         }
         evaluation_url = data.get("evaluation_url")
-        notifier.send_notification(evaluation_url, notification_payload)
-        print("PHASE 3: Notification sent successfully.")
+        if notifier.OUTBOX_ENABLED:
+            # Delivered in the background with retries; the worker is free right away.
+            await notifier.enqueue_notification_async(evaluation_url, notification_payload, task_id, round_number)
+            logger.info("PHASE 3: Notification queued.")
+        else:
+            await notifier.send_notification_async(evaluation_url, notification_payload)
+            logger.info("PHASE 3: Notification sent successfully.")
 
-        print(f"BACKGROUND: Successfully processed task: {task_id}")
-        print("--------------------------------------------------")
+    if round_number > 1:
+        pipeline.add("state", load_state)
+        pipeline.add("fetch", fetch_code, depends_on=["state"], stage="github")
+        pipeline.add("provision", provision_repo, depends_on=["state"], stage="github")
+        code_ready = ["fetch", "attachments"]
+    else:
+        pipeline.add("provision", provision_repo, stage="github")
+        code_ready = ["attachments"]
+    pipeline.add("attachments", save_attachments)
+    pipeline.add("llm", generate_code, depends_on=code_ready, stage="llm")
+    pipeline.add("github", publish_code, depends_on=["llm", "provision"], stage="github")
+    pipeline.add("notify", notify, depends_on=["github"], stage="notify")
+
+    try:
+        await pipeline.run()
+        status = "succeeded"
+        logger.info(f"BACKGROUND: Successfully processed task: {task_id}")
 
     except Exception as e:
-        print(f"BACKGROUND: An error occurred during processing task {task_id}: {e}")
+        logger.error(f"BACKGROUND: An error occurred during processing task {task_id}: {e}")
     finally:
         # --- NEW: Always clean up temporary files ---
-        attachment_manager.cleanup_attachments(saved_attachments_meta)
+        await attachment_manager.cleanup_attachments_async(saved_attachments_meta)
+        await asyncio.to_thread(state_manager.record_round, task_id, round_number, status,
+                                commit_sha=commit_sha, timings=timings, details=round_details,
+                                owner=job_queue.lease_owner())
+    return status
+
+def process_build_request(data: dict) -> str:
+    """Synchronous wrapper around process_build_request_async."""
+    return asyncio.run(process_build_request_async(data))
 
 @app.post("/api/build")
-async def handle_build_request(request: Request, background_tasks: BackgroundTasks):
+async def handle_build_request(request: Request):
+    if _boot_state["first_build_request"]:
+        return await _handle_build_request(request)
+    # Time the first build request, which pays for anything not set up yet.
+    _boot_state["first_build_request"] = True
+    started = time.perf_counter()
     try:
-        data = await request.json()
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+        return await _handle_build_request(request)
+    finally:
+        _boot["first_build_request_seconds"] = round(time.perf_counter() - started, 4)
+        if _boot_state["started_at"] is not None:
+            _boot["first_build_request_after_start_seconds"] = round(started - _boot_state["started_at"], 4)
+        logger.info(f"First build request answered in {_boot['first_build_request_seconds']}s.")
 
+async def _handle_build_request(request: Request):
     expected_secret = os.getenv("MY_SHARED_SECRET")
-    if not expected_secret or data.get("secret") != expected_secret:
-        raise HTTPException(status_code=403, detail="Invalid secret provided")
+    try:
+        # Parse the body as it streams in, decoding attachments straight to disk. The secret
+        # is checked as soon as it is parsed, so unauthenticated requests are rejected before
+        # their attachments are stored.
+        data, spooled_attachments = await attachment_manager.read_build_request(
+            request.stream(), authorize=lambda secret: bool(expected_secret) and secret == expected_secret)
+    except attachment_manager.UnauthorizedError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except attachment_manager.PayloadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    data["spooled_attachments"] = spooled_attachments
+    data["received_at"] = time.time() # The build's deadline is counted from here
+
+    logger.info(f"SUCCESS: Valid secret received for task: {data.get('task')}, round: {data.get('round')}")
+    task_id, round_number = data.get("task"), data.get("round", 1)
+    job_url = f"/api/jobs/{task_id}/{round_number}"
+    # Retries of the same request (same task, round and nonce, or the same Idempotency-Key
+    # header) must not start a second build.
+    data["idempotency_key"] = request.headers.get("Idempotency-Key") or f"{task_id}:{round_number}:{data.get('nonce')}"
+
+    # A round that already succeeded, possibly before a restart, is answered from its record.
+    recorded = await asyncio.to_thread(state_manager.get_round, task_id, round_number)
+    if recorded and recorded["status"] == "succeeded" and recorded["idempotency_key"] == data["idempotency_key"]:
+        metrics.BUILD_REQUESTS.inc(outcome="completed")
+        logger.info(f"Duplicate request for task {task_id}, round {round_number}: already completed.")
+        await attachment_manager.cleanup_attachments_async(spooled_attachments)
+        return {
+            "status": "Request already completed.",
+            "job_url": job_url,
+            "commit_sha": recorded["commit_sha"],
+            "repo_url": recorded["details"].get("repo_url"),
+            "pages_url": recorded["details"].get("pages_url"),
+        }
 
-    print(f"SUCCESS: Valid secret received for task: {data.get('task')}, round: {data.get('round')}")
-    background_tasks.add_task(process_build_request, data)
-    return {"status": "Request received. Processing in background."}
+    try:
+        job, created = await job_queue.submit(data)
+    except job_queue.JobConflictError as e:
+        metrics.BUILD_REQUESTS.inc(outcome="conflict")
+        await attachment_manager.cleanup_attachments_async(spooled_attachments)
+        raise HTTPException(status_code=409, detail=str(e))
+    except job_queue.QueueFullError as e:
+        logger.warning(f"Rejecting task {data.get('task')}: {e}")
+        metrics.BUILD_REQUESTS.inc(outcome="queue_full")
+        await attachment_manager.cleanup_attachments_async(spooled_attachments)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    metrics.BUILD_REQUESTS.inc(outcome="queued" if created else "attached")
+    if not created:
+        logger.info(f"Duplicate request for task {task_id}, round {round_number}: attached to the existing job.")
+        await attachment_manager.cleanup_attachments_async(spooled_attachments)
+        return {
+            "status": f"Duplicate request. Attached to the existing job ({job['status']}).",
+            "job_url": job_url,
+        }
+    return {
+        "status": "Request received. Processing in background.",
+        "job_url": job_url,
+    }
+
+@app.get("/api/jobs/{task_id}/{round_number}")
+def get_job_status(task_id: str, round_number: int, breakdown: bool = False):
+    """Returns a job's status. With ?breakdown=true it includes the seconds spent per span:
+    each phase, GitHub route and LLM request."""
+    job = job_queue.get_job(task_id, round_number)
+    if job and not breakdown:
+        del job["breakdown"]
+    if not job:
+        # Jobs from before a restart, or queued in another worker process, are only known
+        # through the round history.
+        round_state = state_manager.get_round(task_id, round_number)
+        if not round_state:
+            raise HTTPException(status_code=404, detail="Job not found")
+        job = {
+            "task": task_id,
+            "round": round_number,
+            "status": round_state["status"],
+            "phase": None,
+            "owner": round_state["owner"],
+            "timings": round_state["timings"],
+            "commit_sha": round_state["commit_sha"],
+        }
+    notification = state_manager.get_notification(task_id, round_number)
+    if notification:
+        job["notification"] = {key: notification[key] for key in ("status", "attempts", "last_error", "updated_at")}
+    return job
+
+@app.get("/api/workers")
+def get_workers():
+    """Lists the worker processes sharing the state database, with their heartbeats and task leases."""
+    return {"worker_id": job_queue.lease_owner(), "workers": state_manager.list_workers()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 def read_root():
     return {"status": "API is running"}
+
+@app.get("/ready")
+def read_ready():
+    """Readiness probe: 200 once the job queue is running and, in prewarm mode, the clients
+    have been created. Unlike /, this fails while the service cannot take builds quickly."""
+    warmup = _boot_state["warmup"]
+    warming_up = warmup is not None and not warmup.done()
+    ready = _boot_state["started_at"] is not None and not warming_up
+    body = {
+        "ready": ready,
+        "boot_mode": BOOT_MODE,
+        "warming_up": warming_up,
+        "llm_client": llm_generator.client_state(),
+        "queued_jobs": job_queue.queue_depth(),
+        "boot": _boot,
+    }
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+_boot["import_seconds"] = round(time.perf_counter() - _import_started, 4)
@@ -0,0 +1,174 @@
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# A small Prometheus registry rendered in the text exposition format at /metrics. Counters
+# and histograms are defined next to the code they measure, in this module, so every series
+# the service exports is listed in one place.
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_metrics = []
+_collectors = []
+# Seconds spent per span in the job being processed, for the per-job timing breakdown.
+_job_breakdown: contextvars.ContextVar = contextvars.ContextVar("job_breakdown", default=None)
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, object] = {}
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_text(self, key: Tuple, extra: Tuple = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render(self) -> list:
+        return [f"{self.name}{self._label_text(key)} {_number(value)}" for key, value in self._values.items()]
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, span: Optional[str] = None, **labels):
+        """Observes how long the block takes. With a span name, the time is also added to
+        the current job's timing breakdown."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self.observe(elapsed, **labels)
+            if span:
+                add_to_breakdown(span, elapsed)
+
+    def _render(self) -> list:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else _number(bound)
+                lines.append(f"{self.name}_bucket{self._label_text(key, (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+def register_collector(prefix: str, collect: Callable[[], Dict]):
+    """Exports the numeric values of a stats dictionary as gauges named <prefix>_<key>,
+    read each time /metrics is scraped."""
+    with _lock:
+        _collectors.append((prefix, collect))
+
+def track_job(breakdown: Dict) -> contextvars.Token:
+    """Collects span timings of the current context (and the tasks it starts) into breakdown."""
+    return _job_breakdown.set(breakdown)
+
+def untrack_job(token: contextvars.Token):
+    _job_breakdown.reset(token)
+
+def add_to_breakdown(span: str, seconds: float):
+    breakdown = _job_breakdown.get()
+    if breakdown is None:
+        return
+    with _lock:
+        entry = breakdown.setdefault(span, {"count": 0, "seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] = round(entry["seconds"] + seconds, 4)
+
+def copy_breakdown(breakdown: Dict) -> Dict:
+    with _lock:
+        return {span: dict(entry) for span, entry in breakdown.items()}
+
+def render() -> str:
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric._render())
+        collectors = list(_collectors)
+    for prefix, collect in collectors:
+        try:
+            values = collect()
+        except Exception:
+            continue
+        for key, value in sorted(values.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.append(f"# TYPE {prefix}_{key} gauge")
+            lines.append(f"{prefix}_{key} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+def _number(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+# --- Builds ---
+BUILD_JOBS = Counter("build_jobs_total", "Build jobs finished, by final status.", ["status"])
+BUILD_SECONDS = Histogram("build_duration_seconds", "Time from a build job starting to finishing.")
+BUILD_REQUESTS = Counter("build_requests_total", "Requests to /api/build, by how they were handled.", ["outcome"])
+PHASE_SECONDS = Histogram("build_phase_seconds", "Time spent in each build phase, including stage waits.", ["phase", "status"])
+JOB_LEASE_WAIT_SECONDS = Histogram("build_job_lease_wait_seconds", "Time build jobs waited for their task's lease.")
+JOB_TAKEOVERS = Counter("build_job_takeovers_total", "Unfinished rounds taken over from workers that stopped heartbeating.")
+JOB_LEASES_LOST = Counter("build_job_leases_lost_total", "Running builds stopped because their task lease was taken over.")
+
+# --- LLM ---
+LLM_REQUEST_SECONDS = Histogram("llm_request_seconds", "Latency of single Gemini generation requests.", ["outcome"])
+LLM_TOKENS = Counter("llm_tokens_total", "Gemini tokens used, by kind.", ["kind"])
+LLM_ADMISSION_WAIT_SECONDS = Histogram("llm_admission_wait_seconds", "Time Gemini calls waited for the admission controller.", ["priority"])
+LLM_REPAIR_CALLS = Counter("llm_repair_calls_total", "Follow-up calls made to repair malformed responses.")
+
+# --- GitHub ---
+GITHUB_REQUEST_SECONDS = Histogram("github_request_seconds", "Latency of GitHub API calls.", ["method", "endpoint"])
+GITHUB_REQUESTS = Counter("github_requests_total", "GitHub API responses, by status code.", ["method", "endpoint", "status"])
+GITHUB_RETRIES = Counter("github_retries_total", "GitHub API calls retried after a rate limit.")
+GITHUB_TRANSIENT_RETRIES = Counter("github_transient_retries_total", "Idempotent GitHub API calls retried after a 5xx or connection error.")
+GITHUB_UPLOAD_BYTES = Counter("github_upload_bytes_total", "Bytes of file content uploaded to GitHub as blobs.")
+GITHUB_PAGES_SECONDS = Histogram("github_pages_enable_seconds", "Time taken to enable GitHub Pages on a repository.")
+
+# --- Notifications ---
+NOTIFY_ATTEMPTS = Counter("notification_attempts_total", "Notification delivery attempts, by outcome.", ["outcome"])
+NOTIFY_SECONDS = Histogram("notification_attempt_seconds", "Latency of notification delivery attempts.")
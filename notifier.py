@@ -1,8 +1,38 @@
-import requests
+import os
+import logging
 import time
+import random
+import asyncio
+import httpx
 import json
+from typing import Optional
+from urllib.parse import urlsplit
 
-def send_notification(url: str, payload: dict):
+import metrics
+import state_manager
+
+logger = logging.getLogger(__name__)
+
+# Notifications go through a persistent outbox: the build enqueues the payload and moves on,
+# and a delivery loop sends it in the background with jittered exponential backoff until it
+# succeeds or its deadline passes. Pending notifications survive restarts.
+OUTBOX_ENABLED = os.getenv("NOTIFY_OUTBOX", "true").lower() != "false"
+DELIVERY_DEADLINE_SECONDS = float(os.getenv("NOTIFY_DEADLINE_SECONDS", "600"))
+PER_HOST_CONCURRENCY = int(os.getenv("NOTIFY_PER_HOST_CONCURRENCY", "4"))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("NOTIFY_RETRY_BASE_DELAY_SECONDS", "1"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("NOTIFY_RETRY_MAX_DELAY_SECONDS", "60"))
+# A claimed notification becomes due again after this long if its delivery never finishes.
+CLAIM_LEASE_SECONDS = 60
+CLAIM_BATCH_SIZE = 32
+IDLE_POLL_SECONDS = 5
+
+_wakeup: Optional[asyncio.Event] = None
+_loop_task: Optional[asyncio.Task] = None
+_client: Optional[httpx.AsyncClient] = None
+_host_semaphores = {}
+_in_flight = {} # notification id -> delivery task
+
+async def send_notification_async(url: str, payload: dict):
     """
     Sends a POST request to the evaluation URL with retry logic.
     """
@@ -11,24 +41,142 @@ def send_notification(url: str, payload: dict):
     # Delays will be 1, 2, 4, 8, 16 seconds
     delays = [2**i for i in range(max_retries)]
 
-    for attempt, delay in enumerate(delays):
+    async with httpx.AsyncClient(timeout=15) as client:
+        for attempt, delay in enumerate(delays):
+            try:
+                logger.info(f"Attempting to send notification to {url}...")
+                logger.debug(f"Payload: {json.dumps(payload, indent=2)}")
+
+                with metrics.NOTIFY_SECONDS.time(span="notify attempt"):
+                    response = await client.post(url, json=payload, headers=headers)
+
+                # Raise an exception for bad status codes (4xx or 5xx)
+                response.raise_for_status()
+
+                logger.info(f"Notification successful! Status code: {response.status_code}")
+                metrics.NOTIFY_ATTEMPTS.inc(outcome="delivered")
+                return # Exit the function on success
+
+            except httpx.HTTPError as e:
+                logger.warning(f"Attempt {attempt + 1}/{max_retries} failed: {e}")
+                metrics.NOTIFY_ATTEMPTS.inc(outcome="retry" if attempt < max_retries - 1 else "failed")
+                if attempt < max_retries - 1:
+                    logger.info(f"Retrying in {delay} seconds...")
+                    await asyncio.sleep(delay)
+                else:
+                    logger.error("All notification attempts failed.")
+                    raise # Re-raise the final exception to be caught in main.py
+
+def send_notification(url: str, payload: dict):
+    """Synchronous wrapper around send_notification_async."""
+    asyncio.run(send_notification_async(url, payload))
+
+def enqueue_notification(url: str, payload: dict, task_id: Optional[str] = None,
+                         round_number: Optional[int] = None) -> int:
+    """Stores a notification in the outbox for background delivery and returns its id."""
+    notification_id = state_manager.enqueue_notification(
+        url, payload, time.time() + DELIVERY_DEADLINE_SECONDS, task_id, round_number
+    )
+    logger.info(f"Queued notification {notification_id} to {url}.")
+    return notification_id
+
+async def enqueue_notification_async(url: str, payload: dict, task_id: Optional[str] = None,
+                                     round_number: Optional[int] = None) -> int:
+    """Async version of enqueue_notification that also wakes the delivery loop."""
+    notification_id = await asyncio.to_thread(enqueue_notification, url, payload, task_id, round_number)
+    if _wakeup is not None:
+        _wakeup.set()
+    return notification_id
+
+async def start():
+    """Starts the outbox delivery loop, which also resumes notifications left by an earlier run."""
+    global _wakeup, _loop_task, _client
+    _wakeup = asyncio.Event()
+    _client = httpx.AsyncClient(timeout=15)
+    _loop_task = asyncio.create_task(_delivery_loop())
+
+async def stop():
+    """Stops the delivery loop. Undelivered notifications stay in the outbox."""
+    global _wakeup, _loop_task, _client
+    if _loop_task:
+        _loop_task.cancel()
+        await asyncio.gather(_loop_task, return_exceptions=True)
+    for task in list(_in_flight.values()):
+        task.cancel()
+    await asyncio.gather(*_in_flight.values(), return_exceptions=True)
+    _in_flight.clear()
+    _host_semaphores.clear()
+    if _client:
+        await _client.aclose()
+    _wakeup = _loop_task = _client = None
+
+async def _delivery_loop():
+    while True:
         try:
-            print(f"Attempting to send notification to {url}...")
-            print(f"Payload: {json.dumps(payload, indent=2)}")
-            
-            response = requests.post(url, json=payload, headers=headers, timeout=15)
-            
-            # Raise an exception for bad status codes (4xx or 5xx)
-            response.raise_for_status()
-
-            print(f"Notification successful! Status code: {response.status_code}")
-            return # Exit the function on success
-
-        except requests.exceptions.RequestException as e:
-            print(f"Attempt {attempt + 1}/{max_retries} failed: {e}")
-            if attempt < max_retries - 1:
-                print(f"Retrying in {delay} seconds...")
-                time.sleep(delay)
-            else:
-                print("All notification attempts failed.")
-                raise # Re-raise the final exception to be caught in main.py
\ No newline at end of file
+            due = await asyncio.to_thread(state_manager.claim_due_notifications, CLAIM_BATCH_SIZE, CLAIM_LEASE_SECONDS)
+            for notification in due:
+                if notification["id"] not in _in_flight:
+                    task = asyncio.create_task(_deliver(notification))
+                    _in_flight[notification["id"]] = task
+                    task.add_done_callback(lambda _, nid=notification["id"]: _in_flight.pop(nid, None))
+            if len(due) == CLAIM_BATCH_SIZE:
+                continue # More may be due already
+            next_due = await asyncio.to_thread(state_manager.next_notification_due_at)
+        except Exception as e:
+            logger.error(f"Notification outbox loop failed: {e}")
+            next_due = None
+
+        timeout = IDLE_POLL_SECONDS if next_due is None else min(IDLE_POLL_SECONDS, max(0.0, next_due - time.time()))
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def _deliver(notification: dict):
+    """Makes one delivery attempt and records its outcome in the outbox."""
+    url = notification["url"]
+    host = urlsplit(url).netloc
+    semaphore = _host_semaphores.setdefault(host, asyncio.Semaphore(PER_HOST_CONCURRENCY))
+    attempts = notification["attempts"]
+    if time.time() > notification["deadline"]:
+        logger.error(f"Notification {notification['id']} to {url} missed its deadline after {attempts} attempts.")
+        await asyncio.to_thread(state_manager.update_notification, notification["id"], "failed", attempts,
+                                None, notification["last_error"] or "Deadline passed")
+        metrics.NOTIFY_ATTEMPTS.inc(outcome="expired")
+        return
+    attempts += 1
+    error = None
+    retryable = True
+    async with semaphore:
+        try:
+            with metrics.NOTIFY_SECONDS.time():
+                response = await _client.post(url, json=notification["payload"])
+            if response.is_success:
+                metrics.NOTIFY_ATTEMPTS.inc(outcome="delivered")
+                logger.info(f"Notification {notification['id']} delivered to {url} (attempt {attempts}). Status code: {response.status_code}")
+                await asyncio.to_thread(state_manager.update_notification, notification["id"], "delivered", attempts)
+                return
+            error = f"HTTP {response.status_code}: {response.text[:200]}"
+            # Client errors other than timeouts and throttling will not succeed on a retry.
+            retryable = response.status_code >= 500 or response.status_code in (408, 425, 429)
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+        except asyncio.CancelledError:
+            # Shutting down: make the notification due again right away for the next run.
+            state_manager.update_notification(notification["id"], "pending", notification["attempts"],
+                                              time.time(), notification["last_error"])
+            raise
+
+    delay = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (attempts - 1)))
+    next_attempt_at = time.time() + delay
+    if not retryable or next_attempt_at > notification["deadline"]:
+        logger.error(f"Notification {notification['id']} to {url} failed for good after {attempts} attempts: {error}")
+        metrics.NOTIFY_ATTEMPTS.inc(outcome="failed")
+        await asyncio.to_thread(state_manager.update_notification, notification["id"], "failed", attempts, None, error)
+        return
+    metrics.NOTIFY_ATTEMPTS.inc(outcome="retry")
+    logger.warning(f"Notification {notification['id']} attempt {attempts} failed ({error}). Retrying in {delay:.1f}s.")
+    await asyncio.to_thread(state_manager.update_notification, notification["id"], "pending", attempts, next_attempt_at, error)
+    if _wakeup is not None:
+        _wakeup.set()
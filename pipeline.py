@@ -0,0 +1,74 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+import job_queue
+import metrics
+
+class Pipeline:
+    """Runs the phases of a build as a small dependency graph.
+
+    Each phase starts as soon as the phases it depends on have finished, so phases that do
+    not depend on each other run concurrently. Every phase is tracked on the current job
+    through job_queue.phase() and its duration is recorded in timings. If any phase fails,
+    the phases still running are cancelled and run() raises the error.
+    """
+
+    def __init__(self, timings: Optional[Dict[str, float]] = None):
+        self.timings = timings if timings is not None else {}
+        self._phases = []
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def add(self, name: str, func: Callable[[], Awaitable], depends_on: Iterable[str] = (),
+            stage: Optional[str] = None):
+        """Adds a phase. Dependencies must have been added before it."""
+        depends_on = tuple(depends_on)
+        known = {phase[0] for phase in self._phases}
+        for dependency in depends_on:
+            if dependency not in known:
+                raise ValueError(f"Phase '{name}' depends on unknown phase '{dependency}'")
+        self._phases.append((name, func, depends_on, stage))
+
+    async def result(self, name: str):
+        """Waits for a phase to finish and returns its result."""
+        return await asyncio.shield(self._tasks[name])
+
+    def task(self, name: str) -> asyncio.Task:
+        """Returns the task running a phase, for code that only needs to wait for it."""
+        return self._tasks[name]
+
+    async def run(self) -> Dict[str, object]:
+        """Runs every phase and returns their results by name."""
+        for name, func, depends_on, stage in self._phases:
+            self._tasks[name] = asyncio.create_task(self._run_phase(name, func, depends_on, stage))
+        tasks = list(self._tasks.values())
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception():
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return {name: task.result() for name, task in self._tasks.items()}
+
+    async def _run_phase(self, name: str, func: Callable[[], Awaitable], depends_on: tuple,
+                         stage: Optional[str]):
+        if depends_on:
+            await asyncio.gather(*(self._tasks[dependency] for dependency in depends_on))
+        started = time.monotonic()
+        status = "failed"
+        try:
+            async with job_queue.phase(name, stage=stage):
+                result = await func()
+            status = "done"
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.PHASE_SECONDS.observe(elapsed, phase=name, status=status)
+            metrics.add_to_breakdown(f"phase {name}", elapsed)
+        self.timings[name] = elapsed
+        return result
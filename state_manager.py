@@ -1,27 +1,117 @@
 import json
+import logging
 import os
-from typing import Optional, Dict
+import sqlite3
+import threading
+import time
+from typing import Optional, Dict, List, Tuple
 
+logger = logging.getLogger(__name__)
+
+# Task state lives in SQLite (WAL mode), which gives keyed lookups, atomic writes and
+# safe concurrent access from several threads and uvicorn worker processes.
+STATE_DB = os.getenv("STATE_DB_PATH", "/tmp/repo_state.db")
+
+# Legacy whole-file JSON store, migrated into the database on first use.
 STATE_FILE = "/tmp/repo_state.json"
 
-def save_task_state(task_id: str, details: Dict):
-    """Saves the repository details for a given task ID."""
-    state = load_all_states()
-    state[task_id] = details
+_local = threading.local()
+
+def _connect() -> sqlite3.Connection:
+    """Returns this thread's connection to the state database, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _init_schema(conn)
+        _local.conn = conn
+    return conn
+
+def _init_schema(conn: sqlite3.Connection):
+    """Creates the tables if needed and migrates the legacy JSON state file once."""
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
-        print(f"Saved state for task: {task_id}")
-    except IOError as e:
-        print(f"Error saving state to {STATE_FILE}: {e}")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                details TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rounds (
+                task_id TEXT NOT NULL,
+                round INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                commit_sha TEXT,
+                timings TEXT,
+                details TEXT,
+                idempotency_key TEXT,
+                started_at REAL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (task_id, round)
+            )""")
+        round_columns = {row["name"] for row in conn.execute("PRAGMA table_info(rounds)")}
+        if "idempotency_key" not in round_columns:
+            conn.execute("ALTER TABLE rounds ADD COLUMN idempotency_key TEXT")
+        # The request a queued or running round was submitted with, and the worker process
+        # that owns it, so another process can take the round over if that one dies.
+        if "request" not in round_columns:
+            conn.execute("ALTER TABLE rounds ADD COLUMN request TEXT")
+        if "owner" not in round_columns:
+            conn.execute("ALTER TABLE rounds ADD COLUMN owner TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS rounds_status ON rounds (status)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                started_at REAL NOT NULL,
+                heartbeat_at REAL NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS task_leases (
+                task_id TEXT PRIMARY KEY,
+                round INTEGER NOT NULL,
+                owner TEXT NOT NULL,
+                acquired_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT,
+                round INTEGER,
+                url TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                deadline REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
 
-def get_task_state(task_id: str) -> Optional[Dict]:
-    """Loads the repository details for a specific task ID."""
-    state = load_all_states()
-    return state.get(task_id)
+        migrated = conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone()
+        if not migrated:
+            legacy_states = _load_legacy_json()
+            now = time.time()
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (task_id, details, updated_at) VALUES (?, ?, ?)",
+                [(task_id, json.dumps(details), now) for task_id, details in legacy_states.items()],
+            )
+            conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(now),))
+            if legacy_states:
+                logger.info(f"Migrated {len(legacy_states)} task states from {STATE_FILE} to {STATE_DB}")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
 
-def load_all_states() -> Dict:
-    """Loads the entire state file from disk."""
+def _load_legacy_json() -> Dict:
+    """Loads the legacy JSON state file, if there is one."""
     if not os.path.exists(STATE_FILE):
         return {}
     try:
@@ -33,5 +123,334 @@ def load_all_states() -> Dict:
     except (json.JSONDecodeError, IOError):
         return {}
 
+def save_task_state(task_id: str, details: Dict):
+    """Saves the repository details for a given task ID."""
+    try:
+        _connect().execute(
+            """INSERT INTO tasks (task_id, details, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT (task_id) DO UPDATE SET details = excluded.details, updated_at = excluded.updated_at""",
+            (task_id, json.dumps(details), time.time()),
+        )
+        logger.info(f"Saved state for task: {task_id}")
+    except sqlite3.Error as e:
+        logger.error(f"Error saving state to {STATE_DB}: {e}")
+
+def get_task_state(task_id: str) -> Optional[Dict]:
+    """Loads the repository details for a specific task ID."""
+    row = _connect().execute("SELECT details FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+    return json.loads(row["details"]) if row else None
+
+def load_all_states() -> Dict:
+    """Loads the repository details of every task."""
+    rows = _connect().execute("SELECT task_id, details FROM tasks").fetchall()
+    return {row["task_id"]: json.loads(row["details"]) for row in rows}
+
+def record_round(task_id: str, round_number: int, status: str, commit_sha: Optional[str] = None,
+                 timings: Optional[Dict] = None, details: Optional[Dict] = None,
+                 idempotency_key: Optional[str] = None, owner: Optional[str] = None):
+    """Creates or updates the history entry for one round of a task.
+
+    Fields passed as None keep their previously recorded value. When owner is given, an
+    entry that belongs to another worker is left alone, so a worker whose round was taken
+    over can't overwrite the new owner's progress.
+    """
+    now = time.time()
+    try:
+        _connect().execute(
+            """INSERT INTO rounds (task_id, round, status, commit_sha, timings, details, idempotency_key, owner, started_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (task_id, round) DO UPDATE SET
+                   status = excluded.status,
+                   commit_sha = COALESCE(excluded.commit_sha, rounds.commit_sha),
+                   timings = COALESCE(excluded.timings, rounds.timings),
+                   details = COALESCE(excluded.details, rounds.details),
+                   idempotency_key = COALESCE(excluded.idempotency_key, rounds.idempotency_key),
+                   owner = COALESCE(rounds.owner, excluded.owner),
+                   updated_at = excluded.updated_at
+               WHERE excluded.owner IS NULL OR rounds.owner IS NULL OR rounds.owner = excluded.owner""",
+            (task_id, round_number, status, commit_sha,
+             json.dumps(timings) if timings is not None else None,
+             json.dumps(details) if details is not None else None,
+             idempotency_key, owner, now, now),
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Error recording round {round_number} of task {task_id}: {e}")
+
+def get_round(task_id: str, round_number: int) -> Optional[Dict]:
+    """Returns the history entry for one round of a task."""
+    row = _connect().execute(
+        "SELECT * FROM rounds WHERE task_id = ? AND round = ?", (task_id, round_number)
+    ).fetchone()
+    return _round_from_row(row) if row else None
+
+def get_round_history(task_id: str) -> List[Dict]:
+    """Returns the history entries of every round of a task, oldest first."""
+    rows = _connect().execute(
+        "SELECT * FROM rounds WHERE task_id = ? ORDER BY round", (task_id,)
+    ).fetchall()
+    return [_round_from_row(row) for row in rows]
+
+def _round_from_row(row: sqlite3.Row) -> Dict:
+    return {
+        "task_id": row["task_id"],
+        "round": row["round"],
+        "status": row["status"],
+        "commit_sha": row["commit_sha"],
+        "timings": json.loads(row["timings"]) if row["timings"] else {},
+        "details": json.loads(row["details"]) if row["details"] else {},
+        "idempotency_key": row["idempotency_key"],
+        "owner": row["owner"],
+        "started_at": row["started_at"],
+        "updated_at": row["updated_at"],
+    }
+
+# --- Task leases ---
+# Worker processes (uvicorn workers and replicas sharing this database) coordinate through
+# these tables. Every process heartbeats its row in 'workers'. A submitted round is stored as
+# 'queued' together with its request and owner; a process whose heartbeat is older than the
+# lease is considered dead and its unfinished rounds are taken over by another. A round is
+# only built while its process holds the task's lease, and only after every earlier round of
+# the task has finished, so two processes never build the same task at once.
+
+_PENDING = ("queued", "running")
+
+def enqueue_round(task_id: str, round_number: int, idempotency_key: Optional[str], request: Dict,
+                  owner: str, lease_seconds: float) -> Tuple[Dict, bool]:
+    """Records a round as queued for owner, unless a live worker already has it queued or running.
+
+    Returns the round's entry and whether it was queued for owner.
+    """
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            """SELECT rounds.*, workers.heartbeat_at FROM rounds LEFT JOIN workers ON workers.worker_id = rounds.owner
+               WHERE task_id = ? AND round = ?""", (task_id, round_number)
+        ).fetchone()
+        if (row and row["status"] in _PENDING and row["owner"] != owner
+                and row["heartbeat_at"] is not None and row["heartbeat_at"] > now - lease_seconds):
+            conn.execute("COMMIT")
+            return _round_from_row(row), False
+        conn.execute(
+            """INSERT INTO rounds (task_id, round, status, idempotency_key, request, owner, started_at, updated_at)
+               VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)
+               ON CONFLICT (task_id, round) DO UPDATE SET
+                   status = 'queued', idempotency_key = excluded.idempotency_key, request = excluded.request,
+                   owner = excluded.owner, started_at = excluded.started_at, updated_at = excluded.updated_at""",
+            (task_id, round_number, idempotency_key, json.dumps(request), owner, now, now),
+        )
+        row = conn.execute("SELECT * FROM rounds WHERE task_id = ? AND round = ?", (task_id, round_number)).fetchone()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return _round_from_row(row), True
+
+def acquire_task_lease(task_id: str, round_number: int, owner: str, lease_seconds: float) -> str:
+    """Tries to take the task's lease for building one of its rounds.
+
+    Returns 'acquired', 'busy' while another worker holds the lease or an earlier round of
+    the task is unfinished, or 'lost' when the round no longer belongs to owner.
+    """
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT status, owner FROM rounds WHERE task_id = ? AND round = ?",
+                           (task_id, round_number)).fetchone()
+        if not row or row["owner"] != owner or row["status"] not in _PENDING:
+            result = "lost"
+        elif conn.execute(
+            "SELECT 1 FROM rounds WHERE task_id = ? AND round < ? AND status IN ('queued', 'running') LIMIT 1",
+            (task_id, round_number),
+        ).fetchone():
+            result = "busy"
+        else:
+            cursor = conn.execute(
+                """INSERT INTO task_leases (task_id, round, owner, acquired_at, expires_at) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (task_id) DO UPDATE SET
+                       round = excluded.round, owner = excluded.owner,
+                       acquired_at = excluded.acquired_at, expires_at = excluded.expires_at
+                   WHERE task_leases.owner = excluded.owner OR task_leases.expires_at <= ?""",
+                (task_id, round_number, owner, now, now + lease_seconds, now),
+            )
+            result = "acquired" if cursor.rowcount else "busy"
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return result
+
+def release_task_lease(task_id: str, owner: str):
+    """Gives up the task's lease, if owner holds it."""
+    _connect().execute("DELETE FROM task_leases WHERE task_id = ? AND owner = ?", (task_id, owner))
+
+def heartbeat(owner: str, lease_seconds: float) -> List[str]:
+    """Marks owner as alive and extends its task leases. Returns the tasks it still leases."""
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            """INSERT INTO workers (worker_id, started_at, heartbeat_at) VALUES (?, ?, ?)
+               ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at""",
+            (owner, now, now),
+        )
+        conn.execute("UPDATE task_leases SET expires_at = ? WHERE owner = ?", (now + lease_seconds, owner))
+        rows = conn.execute("SELECT task_id FROM task_leases WHERE owner = ?", (owner,)).fetchall()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return [row["task_id"] for row in rows]
+
+def take_over_rounds(owner: str, lease_seconds: float, limit: int) -> List[Dict]:
+    """Claims up to limit unfinished rounds whose worker has stopped heartbeating.
+
+    Returns the claimed rounds with their request in 'request', earliest rounds first.
+    Unfinished rounds without a stored request (recorded before leases existed) can't be
+    rebuilt and are marked failed instead.
+    """
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            """SELECT rounds.* FROM rounds LEFT JOIN workers ON workers.worker_id = rounds.owner
+                WHERE rounds.status IN ('queued', 'running') AND (rounds.owner IS NULL OR rounds.owner != ?)
+                  AND (workers.heartbeat_at IS NULL OR workers.heartbeat_at <= ?)
+                ORDER BY rounds.round, rounds.started_at""",
+            (owner, now - lease_seconds),
+        ).fetchall()
+        orphans = [row for row in rows if row["request"] is None]
+        claimed = [row for row in rows if row["request"] is not None][:max(0, limit)]
+        conn.executemany(
+            """UPDATE rounds SET status = 'failed', details = ?, updated_at = ? WHERE task_id = ? AND round = ?""",
+            [(json.dumps({"error": "Interrupted by a worker restart."}), now, row["task_id"], row["round"])
+             for row in orphans],
+        )
+        conn.executemany(
+            "UPDATE rounds SET status = 'queued', owner = ?, updated_at = ? WHERE task_id = ? AND round = ?",
+            [(owner, now, row["task_id"], row["round"]) for row in claimed],
+        )
+        conn.execute(
+            "DELETE FROM workers WHERE heartbeat_at <= ? AND worker_id != ?", (now - 10 * lease_seconds, owner)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    rounds = []
+    for row in claimed:
+        entry = _round_from_row(row)
+        entry["previous_owner"] = entry["owner"]
+        entry["owner"] = owner
+        entry["request"] = json.loads(row["request"])
+        rounds.append(entry)
+    return rounds
+
+def retire_worker(owner: str):
+    """Removes owner's heartbeat and leases on shutdown, so its unfinished rounds are taken over
+    right away instead of after the lease runs out."""
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM task_leases WHERE owner = ?", (owner,))
+        conn.execute("DELETE FROM workers WHERE worker_id = ?", (owner,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def list_workers() -> List[Dict]:
+    """Returns the known worker processes with their last heartbeat and the tasks they lease."""
+    conn = _connect()
+    workers = {
+        row["worker_id"]: {"worker_id": row["worker_id"], "started_at": row["started_at"],
+                           "heartbeat_at": row["heartbeat_at"], "leases": []}
+        for row in conn.execute("SELECT * FROM workers ORDER BY started_at")
+    }
+    for row in conn.execute("SELECT * FROM task_leases"):
+        if row["owner"] in workers:
+            workers[row["owner"]]["leases"].append({"task": row["task_id"], "round": row["round"],
+                                                    "expires_at": row["expires_at"]})
+    return list(workers.values())
+
+# --- Notification outbox ---
+# Notifications are written here before delivery, so they survive restarts. A row is
+# 'pending' until it is 'delivered' or has 'failed' for good.
+
+def enqueue_notification(url: str, payload: Dict, deadline: float, task_id: Optional[str] = None,
+                         round_number: Optional[int] = None) -> int:
+    """Adds a notification to the outbox, due immediately. Returns its id."""
+    now = time.time()
+    cursor = _connect().execute(
+        """INSERT INTO outbox (task_id, round, url, payload, status, next_attempt_at, deadline, created_at, updated_at)
+           VALUES (?, ?, ?, ?, 'pending', ?, ?, ?, ?)""",
+        (task_id, round_number, url, json.dumps(payload), now, deadline, now, now),
+    )
+    return cursor.lastrowid
+
+def claim_due_notifications(limit: int, lease_seconds: float) -> List[Dict]:
+    """Claims up to limit pending notifications that are due.
+
+    A claimed notification is not due again until lease_seconds have passed, so if the
+    process dies mid-delivery another delivery loop picks it up after the lease.
+    """
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            """SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?
+               ORDER BY next_attempt_at LIMIT ?""",
+            (now, limit),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE outbox SET next_attempt_at = ?, updated_at = ? WHERE id = ?",
+            [(now + lease_seconds, now, row["id"]) for row in rows],
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return [_notification_from_row(row) for row in rows]
+
+def next_notification_due_at() -> Optional[float]:
+    """Returns when the earliest pending notification is due, or None if there is none."""
+    row = _connect().execute("SELECT MIN(next_attempt_at) AS due FROM outbox WHERE status = 'pending'").fetchone()
+    return row["due"]
+
+def update_notification(notification_id: int, status: str, attempts: int,
+                        next_attempt_at: Optional[float] = None, error: Optional[str] = None):
+    """Records the outcome of a delivery attempt."""
+    now = time.time()
+    _connect().execute(
+        """UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = COALESCE(?, next_attempt_at),
+               last_error = ?, updated_at = ? WHERE id = ?""",
+        (status, attempts, next_attempt_at, error, now, notification_id),
+    )
 
+def get_notification(task_id: str, round_number: int) -> Optional[Dict]:
+    """Returns the latest notification queued for one round of a task."""
+    row = _connect().execute(
+        "SELECT * FROM outbox WHERE task_id = ? AND round = ? ORDER BY id DESC LIMIT 1", (task_id, round_number)
+    ).fetchone()
+    return _notification_from_row(row) if row else None
 
+def _notification_from_row(row: sqlite3.Row) -> Dict:
+    return {
+        "id": row["id"],
+        "task_id": row["task_id"],
+        "round": row["round"],
+        "url": row["url"],
+        "payload": json.loads(row["payload"]),
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "next_attempt_at": row["next_attempt_at"],
+        "deadline": row["deadline"],
+        "last_error": row["last_error"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
@@ -0,0 +1,79 @@
+import asyncio
+
+import httpx
+import pytest
+
+import github_client
+
+@pytest.fixture
+def github(monkeypatch):
+    """Routes the pooled client of each test's event loop to a handler the test sets."""
+    routes = {"handler": None, "calls": 0}
+
+    async def handle(request):
+        routes["calls"] += 1
+        await asyncio.sleep(0.01)
+        return routes["handler"](request)
+
+    def new_client(token):
+        return httpx.AsyncClient(base_url="https://api.test", transport=httpx.MockTransport(handle))
+
+    monkeypatch.setattr(github_client, "_new_client", new_client)
+    monkeypatch.setattr(github_client, "_logins", {})
+    monkeypatch.setattr(github_client, "_rate_limits", {})
+    return routes
+
+def test_concurrent_login_lookups_share_one_request(github):
+    github["handler"] = lambda request: httpx.Response(200, json={"login": "octocat"})
+
+    async def main():
+        return await asyncio.gather(*[github_client.get_login("t") for _ in range(20)])
+
+    assert asyncio.run(main()) == ["octocat"] * 20
+    assert github["calls"] == 1
+
+def test_failed_login_lookup_is_retried(github):
+    github["handler"] = lambda request: httpx.Response(401, text="Bad credentials")
+
+    async def main():
+        results = await asyncio.gather(*[github_client.get_login("t") for _ in range(5)], return_exceptions=True)
+        assert all(isinstance(r, github_client.GitHubAPIError) for r in results)
+        github["handler"] = lambda request: httpx.Response(200, json={"login": "octocat"})
+        return await github_client.get_login("t")
+
+    assert asyncio.run(main()) == "octocat"
+    assert github["calls"] == 2
+
+def test_etag_cache_is_capped_by_size(github, monkeypatch):
+    monkeypatch.setattr(github_client, "_etags", github_client.OrderedDict())
+    monkeypatch.setattr(github_client, "_etag_bytes", 0)
+    monkeypatch.setattr(github_client, "ETAG_CACHE_MAX_BYTES", 4000)
+    github["handler"] = lambda request: httpx.Response(
+        200, headers={"ETag": '"e"'}, json={"data": "x" * int(request.url.params["size"])})
+
+    async def main():
+        for i in range(5):
+            await github_client.request("GET", "/items", token="t", params={"size": 900, "page": i})
+        await github_client.request("GET", "/items", token="t", params={"size": 2000})
+
+    asyncio.run(main())
+    assert github_client._etag_bytes <= 4000
+    assert github_client._etag_bytes == sum(entry[2] for entry in github_client._etags.values())
+    assert len(github_client._etags) == 4 # The oversized body is not cached
+    assert all("size=900" in url for _, url in github_client._etags)
+
+def test_pacing_does_not_hold_a_request_slot(github, monkeypatch):
+    monkeypatch.setattr(github_client, "MAX_CONCURRENT_REQUESTS", 1)
+    github["handler"] = lambda request: httpx.Response(200, json={})
+
+    async def main():
+        github_client._rate_limits["slow"] = {"remaining": 1, "reset": github_client.time.time() + 0.5,
+                                              "blocked_until": 0.0}
+        paced = asyncio.ensure_future(github_client.request("GET", "/a", token="slow"))
+        await asyncio.sleep(0.05)
+        # The call is waiting for the rate limit; the only slot must still be free.
+        state = github_client._state("slow")
+        assert not state.semaphore.locked()
+        await paced
+
+    asyncio.run(main())
@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+import github_client
+import github_manager
+from github_client import GitHubAPIError
+
+@pytest.mark.parametrize("errors, enabled, attempts", [
+    ([GitHubAPIError(422, '{"message": "The main branch must exist before GitHub Pages can be built."}')], True, 2),
+    ([GitHubAPIError(404, '{"message": "Not Found"}'), GitHubAPIError(502, "Bad Gateway")], True, 3),
+    ([GitHubAPIError(422, '{"message": "GitHub Pages is already enabled."}')], True, 1),
+    ([GitHubAPIError(422, '{"message": "Invalid request. The source path must be / or /docs."}')], False, 1),
+])
+def test_enable_pages_retries_only_while_the_branch_is_missing(monkeypatch, errors, enabled, attempts):
+    calls = []
+
+    async def request(method, path, token=None, **kwargs):
+        calls.append(path)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return {}
+
+    async def no_sleep(delay):
+        pass
+
+    warnings = []
+    monkeypatch.setattr(github_client, "request", request)
+    monkeypatch.setattr(github_manager.asyncio, "sleep", no_sleep)
+    monkeypatch.setattr(github_manager.logger, "warning", warnings.append)
+    asyncio.run(github_manager._enable_github_pages("tester/app"))
+    assert len(calls) == attempts
+    assert (not warnings) == enabled
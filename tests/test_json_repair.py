@@ -0,0 +1,52 @@
+import time
+
+import json_repair
+
+def test_valid_json_is_returned_as_is():
+    files, incomplete, truncated = json_repair.salvage_files('{"index.html": "<p>hi</p>", "app.js": "x"}')
+    assert files == {"index.html": "<p>hi</p>", "app.js": "x"}
+    assert incomplete == [] and truncated is False
+
+def test_unescaped_quotes_and_raw_newlines():
+    text = '{"index.html": "<a href="x.html">\nlink</a>", "README.md": "# Title"}'
+    files, incomplete, truncated = json_repair.salvage_files(text)
+    assert files == {"index.html": '<a href="x.html">\nlink</a>', "README.md": "# Title"}
+    assert incomplete == [] and truncated is False
+
+def test_code_fences_are_ignored():
+    text = '```json\n{"index.html": "<div class="a"></div>", "app.js": "let s = "q";"}\n```\n'
+    files, incomplete, truncated = json_repair.salvage_files(text)
+    assert files == {"index.html": '<div class="a"></div>', "app.js": 'let s = "q";'}
+    assert truncated is False
+
+def test_truncated_inside_a_value():
+    text = '{"index.html": "<p class="x">done</p>", "app.js": "function f() { return 1; }\nfunction g('
+    files, incomplete, truncated = json_repair.salvage_files(text)
+    assert files == {"index.html": '<p class="x">done</p>'}
+    assert incomplete == ["app.js"]
+    assert truncated is True
+
+def test_truncated_inside_the_next_key():
+    files, incomplete, truncated = json_repair.salvage_files('{"index.html": "<p id="a"></p>", "READ')
+    assert files == {"index.html": '<p id="a"></p>'}
+    assert incomplete == [] and truncated is True
+
+def test_truncated_before_a_fence():
+    files, incomplete, truncated = json_repair.salvage_files('{"index.html": "<p id="a"></p>",\n```')
+    assert files == {"index.html": '<p id="a"></p>'}
+    assert truncated is True
+
+def test_missing_files_are_not_invented():
+    files, incomplete, truncated = json_repair.salvage_files('{"README.md": "# "quoted" title"}')
+    assert files == {"README.md": '# "quoted" title'}
+    assert "index.html" not in files and incomplete == []
+
+def test_large_quote_heavy_response_is_salvaged_quickly():
+    row = '<div class="row" id="r"><a href="x.html" title="t">link</a></div>\n'
+    html = row * (400 * 1024 // len(row))
+    text = '```json\n{"index.html": "' + html + '", "README.md": "# App"}\n```'
+    started = time.perf_counter()
+    files, incomplete, truncated = json_repair.salvage_files(text)
+    assert time.perf_counter() - started < 2
+    assert files == {"index.html": html, "README.md": "# App"}
+    assert incomplete == [] and truncated is False
@@ -12,4 +12,4 @@ def decode_attachment(attachment: dict) -> Optional[Tuple[str, bytes]]:
     header, encoded = data_uri.split(",", 1)
     decoded_content = base64.b64decode(encoded)
 
-    return file_name, decoded_content
\ No newline at end of file
+    return file_name, decoded_content